@@ -0,0 +1,165 @@
+'''
+hold runs back until the output dir has room for their fastq and the node
+has memory for another bcl2fastq
+
+output size and peak memory are estimated from RunInfo.xml and the InterOp
+tile metrics, what runs already admitted have still to write and the memory
+they will use is reserved until they finish
+'''
+import time
+import os
+import glob
+import logging
+from odybcl2fastq import util
+from odybcl2fastq import resources
+from odybcl2fastq import transfer
+from odybcl2fastq.parsers.parse_runinfoxml import get_readinfo_from_runinfo, get_flowcell_layout
+from odybcl2fastq.parsers.parse_interop import get_cluster_counts
+
+# gzipped fastq bytes per base, sequence and quality, after binning
+BYTES_PER_BASE = float(os.getenv('ODYBCL2FASTQ_FASTQ_BYTES_PER_BASE', 0.7))
+# read name and separator lines per read before compression
+RECORD_OVERHEAD = 20
+# bcl2fastq holds a tile's bases and qualities in each processing thread,
+# run.py's default processing threads unless runs size their own
+PROC_THREADS = int(os.getenv('ODYBCL2FASTQ_ADMIT_THREADS', 8))
+AUTO_THREADS = bool(os.getenv('ODYBCL2FASTQ_AUTO_THREADS'))
+BASE_MEM = 2**30
+# leave this fraction of the output filesystem free
+DISK_RESERVE = float(os.getenv('ODYBCL2FASTQ_DISK_RESERVE', 0.05))
+# seconds an admitted run's written bytes are reused, a dispatch pass checks
+# every candidate against the same walk of the running runs' output
+WRITTEN_CACHE = int(os.getenv('ODYBCL2FASTQ_WRITTEN_CACHE', 60))
+
+def estimate_run(run_dir, threads=PROC_THREADS):
+    '''
+    estimated output bytes and peak memory bytes of demultiplexing the run
+    with threads processing threads, and the memory of each thread, None
+    where there is nothing to estimate from
+    '''
+    reads = get_readinfo_from_runinfo(run_dir + 'RunInfo.xml').values()
+    cycles = sum(int(r['NumCycles']) for r in reads)
+    # index reads are not written as fastq
+    fastq_cycles = [int(r['NumCycles']) for r in reads if r.get('IsIndexedRead') != 'Y']
+    estimate = {'output_bytes': None, 'mem_bytes': None, 'thread_mem_bytes': None}
+    tile_metrics = run_dir + 'InterOp/TileMetricsOut.bin'
+    if not os.path.exists(tile_metrics):
+        return estimate
+    counts = get_cluster_counts(tile_metrics)
+    estimate['output_bytes'] = int(counts['pf_clusters'] *
+            sum(c * BYTES_PER_BASE + RECORD_OVERHEAD for c in fastq_cycles))
+    estimate['thread_mem_bytes'] = int(counts['max_tile_clusters'] * cycles * 2)
+    estimate['mem_bytes'] = BASE_MEM + estimate['thread_mem_bytes'] * threads
+    return estimate
+
+def written_bytes(output_dir, run_dir):
+    # bytes the run has written so far, to its output dir and those of its masks
+    run = os.path.basename(os.path.normpath(run_dir))
+    written = 0
+    for path in glob.glob(os.path.join(output_dir, run) + '*'):
+        if os.path.isdir(path):
+            written += transfer.tree_size(transfer.catalogue(path)[1])
+    return written
+
+class AdmissionController(object):
+
+    def __init__(self, output_dir, disk_reserve=DISK_RESERVE, threads=None):
+        self.output_dir = output_dir
+        self.disk_reserve = disk_reserve
+        # processing threads each run will use, sized per run if unset
+        self.threads = threads
+        self.estimates = {}
+        self.admitted = {}
+        self.deferred = {}
+        # run dir to when its written bytes were counted and how many
+        self.written = {}
+
+    def estimate(self, run_dir):
+        # a run's RunInfo and InterOp are final once it is ready
+        if run_dir not in self.estimates:
+            try:
+                self.estimates[run_dir] = estimate_run(run_dir)
+            except Exception as e:
+                logging.warning('Could not estimate %s, admitting without limits: %s\n' % (run_dir, e))
+                self.estimates[run_dir] = {'output_bytes': None, 'mem_bytes': None,
+                        'thread_mem_bytes': None}
+        return self.estimates[run_dir]
+
+    def run_threads(self, run_dir):
+        '''
+        processing threads the run's bcl2fastq will use, with auto threads
+        sized as run.py sizes them alongside the runs already admitted
+        '''
+        if self.threads:
+            return self.threads
+        if not AUTO_THREADS:
+            return PROC_THREADS
+        try:
+            lanes = get_flowcell_layout(run_dir + 'RunInfo.xml')['LaneCount']
+        except Exception:
+            lanes = 1
+        return resources.auto_bcl2fastq_threads(lanes, 1, len(self.admitted) + 1)['processing']
+
+    def mem_needed(self, run_dir):
+        estimate = self.estimate(run_dir)
+        if not estimate['thread_mem_bytes']:
+            return None
+        return BASE_MEM + estimate['thread_mem_bytes'] * self.run_threads(run_dir)
+
+    def unwritten(self, run_dir):
+        # free space already counts what an admitted run has written
+        output_bytes = self.admitted[run_dir]['output_bytes'] or 0
+        if not output_bytes:
+            return 0
+        counted, written = self.written.get(run_dir, (None, 0))
+        if counted is None or time.time() - counted >= WRITTEN_CACHE:
+            written = written_bytes(self.output_dir, run_dir)
+            self.written[run_dir] = (time.time(), written)
+        return max(0, output_bytes - written)
+
+    def check(self, run_dir):
+        '''
+        return None if the run fits now or the resource it is short of and
+        why
+        '''
+        estimate = self.estimate(run_dir)
+        reserved_mem = sum(e['mem_bytes'] or 0 for e in self.admitted.values())
+        if estimate['output_bytes']:
+            reserved_disk = sum(self.unwritten(d) for d in self.admitted)
+            total, used, free = util.disk_usage(self.output_dir)
+            available = free - reserved_disk - total * self.disk_reserve
+            if estimate['output_bytes'] > available:
+                return 'disk', ('needs %.1f GB of output space, %.1f GB free after %.1f GB reserved for running runs' %
+                        (estimate['output_bytes'] / 1e9, free / 1e9, reserved_disk / 1e9))
+        mem_bytes = self.mem_needed(run_dir)
+        if mem_bytes:
+            # memory available already leaves out what running runs hold, so
+            # their reservations come off the total, not off what is left
+            free = resources.mem_available()
+            available = min(free, resources.mem_total() - reserved_mem)
+            if mem_bytes > available and self.admitted:
+                return 'memory', ('needs %.1f GB of memory, %.1f GB available, %.1f GB reserved for running runs' %
+                        (mem_bytes / 1e9, free / 1e9, reserved_mem / 1e9))
+        return None
+
+    def admit(self, run_dir):
+        '''
+        reserve the run's disk and memory if it fits, why it was deferred is
+        logged whenever the resource it is short of changes
+        '''
+        short = self.check(run_dir)
+        if short:
+            resource, reason = short
+            if self.deferred.get(run_dir) != resource:
+                logging.info('Deferring %s: %s\n' % (run_dir, reason))
+            self.deferred[run_dir] = resource
+            return False
+        if self.deferred.pop(run_dir, None):
+            logging.info('Admitting %s, deferred until now\n' % run_dir)
+        self.admitted[run_dir] = dict(self.estimate(run_dir), mem_bytes=self.mem_needed(run_dir))
+        return True
+
+    def release(self, run_dir):
+        self.admitted.pop(run_dir, None)
+        self.estimates.pop(run_dir, None)
+        self.written.pop(run_dir, None)
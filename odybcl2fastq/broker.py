@@ -0,0 +1,169 @@
+'''
+node wide ledger of the cpus and memory leased by heavy child processes like
+bcl2fastq, fastqc and centrifuge, every run.py and centrifuge job on a node
+takes a lease before starting one so concurrent runs queue in the order they
+asked instead of oversubscribing the node
+
+the ledger is a json file guarded by flock, leases held by processes that
+have died are pruned whenever the ledger is read
+'''
+import os
+import json
+import time
+import errno
+import fcntl
+import socket
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from odybcl2fastq import constants as const
+from odybcl2fastq import resources
+
+# pids are only meaningful on this host so each host has its own ledger
+LEDGER_FILE = os.getenv('ODYBCL2FASTQ_LEDGER',
+        '%sodybcl2fastq.leases.%s.json' % (const.ROOT_DIR, socket.gethostname()))
+CPUS = int(os.getenv('ODYBCL2FASTQ_NODE_CPUS', 0)) or resources.cpu_count()
+MEM_MB = int(os.getenv('ODYBCL2FASTQ_NODE_MEM_MB', 0)) or resources.mem_total() // 2**20
+ENABLED = os.getenv('ODYBCL2FASTQ_BROKER', '1') != '0'
+POLL_INTERVAL = 5
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class ResourceBroker(object):
+
+    def __init__(self, path=LEDGER_FILE, cpus=CPUS, mem_mb=MEM_MB, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.cpus = cpus
+        self.mem_mb = mem_mb
+        self.poll_interval = poll_interval
+        self.ids = itertools.count(1)
+        self.id_lock = threading.Lock()
+
+    @contextmanager
+    def ledger(self):
+        '''
+        hold the ledger lock, yield the ledger with dead leases pruned and
+        write it back when the block exits
+        '''
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                ledger = self.load()
+                ledger['leases'] = [l for l in ledger['leases'] if pid_alive(l['pid'])]
+                yield ledger
+                tmp_path = '%s.%i.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as fh:
+                    json.dump(ledger, fh, indent=4)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {'ticket': 0, 'leases': []}
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except ValueError:
+            logging.warning('Resetting unreadable lease ledger %s' % self.path)
+            return {'ticket': 0, 'leases': []}
+
+    def _grantable(self, ledger, lease):
+        # first come first served, only the oldest waiting lease can start
+        waiting = [l for l in ledger['leases'] if not l['granted']]
+        if min(waiting, key=lambda l: l['ticket']) is not lease:
+            return False
+        held = [l for l in ledger['leases'] if l['granted']]
+        cpus = sum(l['cpus'] for l in held) + lease['cpus']
+        mem_mb = sum(l['mem_mb'] for l in held) + lease['mem_mb']
+        return cpus <= self.cpus and mem_mb <= self.mem_mb
+
+    def acquire(self, name, cpus, mem_mb=0):
+        '''
+        queue for cpus and memory, block until granted and return the lease
+        id, requests bigger than the node are cut down so they run alone
+        '''
+        with self.id_lock:
+            lease_id = '%i-%i-%i' % (os.getpid(), threading.current_thread().ident or 0, next(self.ids))
+        with self.ledger() as ledger:
+            ledger['ticket'] += 1
+            ledger['leases'].append({
+                'id': lease_id,
+                'pid': os.getpid(),
+                'name': name,
+                'cpus': max(1, min(int(cpus), self.cpus)),
+                'mem_mb': max(0, min(int(mem_mb), self.mem_mb)),
+                'ticket': ledger['ticket'],
+                'granted': False,
+                'requested': time.time()
+            })
+        waiting = False
+        try:
+            while True:
+                with self.ledger() as ledger:
+                    lease = [l for l in ledger['leases'] if l['id'] == lease_id][0]
+                    if self._grantable(ledger, lease):
+                        lease['granted'] = True
+                        lease['started'] = time.time()
+                        break
+                if not waiting:
+                    logging.info('%s waiting for %i cpus and %i MB\n' % (name, lease['cpus'], lease['mem_mb']))
+                    waiting = True
+                time.sleep(self.poll_interval)
+        except BaseException:
+            self.release(lease_id)
+            raise
+        if waiting:
+            logging.info('%s granted %i cpus and %i MB after %.0fs\n' % (name,
+                lease['cpus'], lease['mem_mb'], lease['started'] - lease['requested']))
+        return lease_id
+
+    def release(self, lease_id):
+        with self.ledger() as ledger:
+            ledger['leases'] = [l for l in ledger['leases'] if l['id'] != lease_id]
+
+    @contextmanager
+    def lease(self, name, cpus, mem_mb=0):
+        lease_id = self.acquire(name, cpus, mem_mb)
+        try:
+            yield lease_id
+        finally:
+            self.release(lease_id)
+
+    def active_pids(self, name):
+        # other processes holding or waiting for leases of name
+        with self.ledger() as ledger:
+            return set(l['pid'] for l in ledger['leases']
+                    if l['name'] == name and l['pid'] != os.getpid())
+
+_broker = None
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = ResourceBroker()
+    return _broker
+
+@contextmanager
+def lease(name, cpus, mem_mb=0):
+    '''
+    hold a lease on the node ledger for the block, a no op with
+    ODYBCL2FASTQ_BROKER=0
+    '''
+    if not ENABLED:
+        yield None
+        return
+    with get_broker().lease(name, cpus, mem_mb) as lease_id:
+        yield lease_id
+
+def active_runs(name):
+    # processes on the node with leases of name, including this one
+    if not ENABLED:
+        return 1
+    return len(get_broker().active_pids(name)) + 1
@@ -0,0 +1,171 @@
+'''
+classify several samples of a run in one centrifuge process so the index is
+loaded once for all of them
+
+the reads of every sample are streamed to centrifuge through fifos with their
+names tagged by the sample's place in the batch, then the classifications are
+split back out by tag and a krona report made for each sample
+'''
+import os
+import gzip
+import shutil
+import logging
+import threading
+from odybcl2fastq import subproc
+
+CENTRIFUGE = os.getenv('ODYBCL2FASTQ_CENTRIFUGE_BIN', 'centrifuge')
+# site options added to every centrifuge cmd
+CENTRIFUGE_OPTS = os.getenv('ODYBCL2FASTQ_CENTRIFUGE_OPTS', '')
+# krona reading centrifuge's classification, read id and tax id columns
+KRONA = os.getenv('ODYBCL2FASTQ_KRONA_CMD', 'ktImportTaxonomy -q 1 -t 3')
+TAG_SEP = b'|'
+CLASSIFICATION_FILE = 'classification.tsv'
+
+def report_cmd(classification, outfile):
+    # the cmd making a sample's krona report, batched or not
+    return '%s %s -o %s' % (KRONA, classification, outfile)
+
+def tag_reads(paths, tag, out):
+    # write the fastq records of paths to out with each read name tagged
+    prefix = b'@' + tag + TAG_SEP
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as fh:
+            for i, line in enumerate(fh):
+                if i % 4 == 0:
+                    line = prefix + line[1:]
+                out.write(line)
+
+def feed(fifo, inputs):
+    '''
+    stream the tagged reads of inputs, a list of tag and files, into fifo,
+    centrifuge exiting early breaks the pipe and ends the feed
+    '''
+    try:
+        with open(fifo, 'wb') as out:
+            for tag, paths in inputs:
+                tag_reads(paths, tag, out)
+    except (IOError, OSError) as e:
+        logging.warning('Stopped feeding %s: %s\n' % (fifo, e))
+
+def unblock(fifo):
+    # a feed still waiting for centrifuge to open its fifo is let through
+    try:
+        os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+def split_classification(path, outputs):
+    '''
+    split centrifuge's classification into a file per tag with the tags
+    removed, outputs maps each tag to its file, every file keeps the header
+    '''
+    files = dict((tag, open(out, 'wb')) for tag, out in outputs.items())
+    try:
+        with open(path, 'rb') as fh:
+            header = fh.readline()
+            for f in files.values():
+                f.write(header)
+            for line in fh:
+                tag, sep, rest = line.partition(TAG_SEP)
+                if sep and tag in files:
+                    files[tag].write(rest)
+                else:
+                    logging.warning('Untagged classification in %s: %s\n' % (path, line[:80]))
+    finally:
+        for f in files.values():
+            f.close()
+
+class Batch(object):
+    '''
+    samples maps each sample to its read 1 files and read 2 files or None,
+    outfiles to its report, work_dir holds the fifos and classifications
+    while the batch runs
+    '''
+
+    def __init__(self, samples, outfiles, work_dir, index, procs, mm=None):
+        self.samples = samples
+        self.outfiles = outfiles
+        self.work_dir = work_dir
+        self.tags = dict((sample, str(i).encode('ascii')) for i, sample in enumerate(sorted(samples)))
+        self.streams = {}
+        paired = [s for s in sorted(samples) if samples[s][1]]
+        unpaired = [s for s in sorted(samples) if not samples[s][1]]
+        if paired:
+            self.streams['-1'] = [(self.tags[s], samples[s][0]) for s in paired]
+            self.streams['-2'] = [(self.tags[s], samples[s][1]) for s in paired]
+        if unpaired:
+            self.streams['-U'] = [(self.tags[s], samples[s][0]) for s in unpaired]
+        self.classification = os.path.join(work_dir, CLASSIFICATION_FILE)
+        cmd_lst = [CENTRIFUGE, '-x', index, '-p', str(procs)]
+        if mm:
+            cmd_lst.append('--mm')
+        if CENTRIFUGE_OPTS:
+            cmd_lst.append(CENTRIFUGE_OPTS)
+        for switch in sorted(self.streams):
+            cmd_lst.extend([switch, self.fifo(switch)])
+        cmd_lst.extend(['-S', self.classification,
+            '--report-file', os.path.join(work_dir, 'centrifuge_report.tsv')])
+        self.cmd = ' '.join(cmd_lst)
+
+    def fifo(self, switch):
+        return os.path.join(self.work_dir, 'reads%s.fastq' % switch)
+
+    def classify(self):
+        # run centrifuge on the tagged reads, return its result
+        feeds = []
+        for switch, inputs in self.streams.items():
+            os.mkfifo(self.fifo(switch))
+            thread = threading.Thread(target=feed, args=(self.fifo(switch), inputs))
+            thread.daemon = True
+            thread.start()
+            feeds.append(thread)
+        try:
+            ret_code, std_out, std_err, usage = subproc.run(self.cmd, name='centrifuge')
+        finally:
+            # a feed may not have opened its fifo yet if centrifuge failed early
+            for thread in feeds:
+                while thread.is_alive():
+                    for switch in self.streams:
+                        unblock(self.fifo(switch))
+                    thread.join(1)
+        usage['batch_size'] = len(self.samples)
+        return ret_code, std_out, std_err, self.cmd, usage
+
+    def report(self, sample, classification):
+        '''
+        write the sample's report, by rename once complete so a report is
+        never left half written, return the report cmd's result
+        '''
+        tmp = self.outfiles[sample] + '.tmp'
+        cmd = report_cmd(classification, tmp)
+        ret_code, std_out, std_err, usage = subproc.run(cmd, name='krona')
+        if ret_code == 0 and os.path.exists(tmp):
+            os.rename(tmp, self.outfiles[sample])
+        elif ret_code == 0:
+            ret_code = 1
+            std_err += ('no report written to %s\n' % tmp).encode('utf-8')
+        return ret_code, std_out, std_err
+
+    def run(self):
+        '''
+        classify the batch and report each sample, return centrifuge's
+        result and the result of each sample's report, samples have no
+        report results if centrifuge failed
+        '''
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        os.makedirs(self.work_dir)
+        try:
+            result = self.classify()
+            reports = {}
+            if result[0] == 0:
+                classifications = dict((sample, os.path.join(self.work_dir, '%s.tsv' % self.tags[sample].decode('ascii')))
+                        for sample in self.samples)
+                split_classification(self.classification,
+                        dict((self.tags[s], path) for s, path in classifications.items()))
+                for sample in sorted(self.samples):
+                    reports[sample] = self.report(sample, classifications[sample])
+            return result, reports
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
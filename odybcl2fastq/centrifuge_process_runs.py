@@ -15,11 +15,24 @@ import os, glob, time, re
 import logging
 import subprocess
 import json
+import traceback
+from functools import partial
+from collections import OrderedDict
 from datetime import datetime
 from multiprocessing import Pool
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 from odybcl2fastq import config
 from odybcl2fastq import constants as const
 import odybcl2fastq.util as util
+from odybcl2fastq import discovery
+from odybcl2fastq import run_state
+from odybcl2fastq import broker
+from odybcl2fastq import exporter
+from odybcl2fastq import centrifuge_batch
+from odybcl2fastq.metrics import RunMetrics
 from odybcl2fastq.emailbuilder.emailbuilder import buildmessage
 from odybcl2fastq.run import COMPLETE_FILE as DEMULTIPLEX_COMPLETE_FILE
 from odybcl2fastq.run import FINAL_DIR_PERMISSIONS, FINAL_FILE_PERMISSIONS
@@ -29,8 +42,17 @@ PROCESSED_FILE = 'centrifuge.processed'
 COMPLETE_FILE = 'centrifuge.complete'
 SKIP_FILE = 'centrifuge.skip'
 FASTQLIST = 'centrifuge_fastqlist.txt'
+METRICS_FILE = 'centrifuge.metrics.json'
+REQUIRED_FILES = [DEMULTIPLEX_COMPLETE_FILE]
 DAYS_TO_SEARCH = 4
 PROC_NUM = int(os.getenv('ODYBCL2FASTQ_PROC_NUM', 2))
+# serve prometheus metrics on this local port, off if unset
+METRICS_PORT = int(os.getenv('ODYBCL2FASTQ_CENTRIFUGE_METRICS_PORT', 0))
+METRICS = exporter.DaemonMetrics('centrifuge')
+SAMPLES_QUEUED = METRICS.gauge('samples_queued', 'Samples of started runs waiting for a slot.')
+# samples of a run classified by one centrifuge process, which loads the
+# index once for all of them, 1 classifies each sample alone
+BATCH_SIZE = int(os.getenv('ODYBCL2FASTQ_CENTRIFUGE_BATCH', 1))
 
 FREQUENCY = 60
 
@@ -72,27 +94,23 @@ def need_to_process(dir):
     if ((now - m_time).days) > DAYS_TO_SEARCH:
         return False
     # filter out if tagged as processed
-    if os.path.isfile(dir + PROCESSED_FILE):
+    if run_state.has(dir, PROCESSED_FILE):
         return False
-    # filter out if tagged as skip
+    # filter out if tagged as skip, skip files are made by hand so the file
+    # is checked rather than the run state db
     if os.path.isfile(dir + SKIP_FILE):
         return False
     # filter out if run never completed to get transfered to ngsdata
     if not os.path.exists(config.FINAL_DIR + run):
         return False
     # filter out if run never completed demultiplexing
-    if not os.path.exists(dir + DEMULTIPLEX_COMPLETE_FILE ):
+    if not run_state.has(dir, DEMULTIPLEX_COMPLETE_FILE):
         return False
     return True
 
-def find_runs(filter):
-    # get all subdirectories
-    dirs = sorted(glob.glob(config.OUTPUT_DIR + '*/'))
-    runs = []
-    for dir in dirs:
-        if filter(dir):
-            runs.append(dir)
-    return runs
+def find_runs(filter, rescan=True):
+    # subdirectories that pass filter, only changed dirs are checked again
+    return discovery.get_watcher(config.OUTPUT_DIR, REQUIRED_FILES).find_runs(filter, rescan)
 
 def get_fastq_files(dir):
     # check if we are limiting to a list of fastq files
@@ -141,115 +159,294 @@ def group_fastq_files(run_dir, files):
         grps[grp][read][lane] = path
     return grps
 
-def get_centrifuge_cmd(run_dir, grp, read1, read2):
-    run = os.path.basename(os.path.normpath(run_dir))
+def get_outfile(run_dir, grp):
     # create centrifuge dir
     centrifuge_dir = run_dir + 'centrifuge'
-    outfile = centrifuge_dir + '/' + grp + '.html'
     if not os.path.exists(centrifuge_dir):
         subprocess.call('mkdir %s' % (centrifuge_dir) ,shell=True)
-    script = config.CENTRIFUGE_DIR + 'centrifuge.sh'
-    cmd_lst = ['bash -e', script, ','.join(read1)]
-    if read2:
-        cmd_lst.append(','.join(read2))
-    else:
-        cmd_lst.append('None')
-    cmd_lst.append(outfile)
-
-    # Add optionals
-    cmd_lst.append(config.CENTRIFUGE_INDEX)
-    cmd_lst.append(config.CENTRIFUGE_PROC)
-    if config.CENTRIFUGE_MM:
-        cmd_lst.append(config.CENTRIFUGE_MM)
-
-    cmd = ' '.join(cmd_lst)
-    logging.info('Using centrifuge command: %s' % cmd)
-    return cmd, outfile
-
-def run_centrifuge(cmd):
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-    std_out, std_err = proc.communicate()
-    return (proc.returncode, std_out, std_err, cmd)
-
-def process_runs(pool, proc_num):
-    runs_found = find_runs(need_to_process)
-    if runs_found:
-        run_dir = runs_found[0]
-        util.touch(run_dir, PROCESSED_FILE)
-        logging.info("Found %s runs: %s\nprocessing the first:\n%s\n" % (len(runs_found), json.dumps(runs_found),
-            run_dir))
-        results = {}
-        run = os.path.basename(os.path.normpath(run_dir))
-        logging.info("Centrifuge processing %s\n" % (run))
-        # we run centrifuge per sample
-        fastq_files = get_fastq_files(run_dir)
-        grps = group_fastq_files(run_dir, fastq_files)
-        logging.info("Found %s samples to run on centrifuge\n" % (len(grps)))
-        for sample, files in grps.items():
-            read1 = [files[1][i] for i in sorted(files[1])]
-            if 2 in files:
-                read2 = [files[2][i] for i in sorted(files[2])]
-            else:
-                read2 = None
-            cmd, output_dir = get_centrifuge_cmd(run_dir, sample, read1, read2)
-            centrifuge_dir = run_dir + 'centrifuge'
-            logging.info("Queueing centrifuge cmd for %s:\n%s\n" % (sample, cmd))
-            results[sample] = pool.apply_async(run_centrifuge, (cmd,))
-        failed_samples = []
-        success_samples = []
-        for sample, result in results.items():
-            ret_code, std_out, std_err, cmd = result.get()
-            output = std_out + std_err
-            if ret_code == 0:
-                success_samples.append(sample)
-                message = 'sample %s completed successfully\nsee logs here: %s\n' % (sample, output)
-                status = 'success'
+    return centrifuge_dir + '/' + grp + '.html'
+
+def get_batch_cmd(batch, reads):
+    '''
+    the work for a batch of (run dir, sample) of one run and their reads,
+    return its cmd, the report of each sample and the centrifuge_batch.Batch
+    classifying them, a lone sample is a batch of one so every report is
+    made the same way
+    '''
+    run_dir = batch[0][0]
+    samples = dict((item[1], r) for item, r in zip(batch, reads))
+    outfiles = dict((sample, get_outfile(run_dir, sample)) for sample in samples)
+    work = centrifuge_batch.Batch(samples, outfiles, run_dir + 'centrifuge/batch.' + min(samples),
+            config.CENTRIFUGE_INDEX, config.CENTRIFUGE_PROC, config.CENTRIFUGE_MM)
+    logging.info('Using centrifuge batch command for %i samples: %s' % (len(samples), work.cmd))
+    return work.cmd, outfiles, work
+
+def get_index_mem_mb():
+    # centrifuge holds its whole index in memory
+    index_files = glob.glob(config.CENTRIFUGE_INDEX + '*.cf')
+    return sum(os.path.getsize(path) for path in index_files) // 2**20
+
+def run_batch(cmd, outfiles, work):
+    '''
+    run a batch's work holding the node's lease, return the result of each
+    sample
+    '''
+    # a report left by an earlier attempt must not pass for this one's
+    for outfile in outfiles.values():
+        if os.path.exists(outfile):
+            os.remove(outfile)
+    try:
+        with broker.lease('centrifuge', int(config.CENTRIFUGE_PROC), get_index_mem_mb()):
+            result, reports = work.run()
+    except Exception:
+        # always return a result so the samples' runs can finish
+        result, reports = error_result(cmd, traceback.format_exc()), {}
+    return split_results(result, reports, outfiles)
+
+def split_results(result, reports, samples):
+    '''
+    one result per sample of a batch from centrifuge's result and the result
+    of each sample's report, a sample succeeded only if centrifuge exited 0
+    and its report was written
+    '''
+    ret_code, std_out, std_err, cmd, usage = result
+    # wall time and bytes read are shared evenly so the stage totals count
+    # the batch once
+    share = OrderedDict(usage)
+    for key in ('wall_seconds', 'bytes_read'):
+        if share.get(key) is not None:
+            share[key] = share[key] / float(len(samples))
+    share['batch_size'] = len(samples)
+    results = {}
+    for sample in samples:
+        code, out, err = reports.get(sample, (ret_code or 1, b'', b''))
+        results[sample] = (ret_code or code, std_out + out, std_err + err, cmd, OrderedDict(share))
+    return results
+
+def error_result(cmd, tb):
+    usage = OrderedDict([('name', 'centrifuge'), ('cmd', cmd), ('exit_status', 1),
+        ('wall_seconds', 0), ('bytes_read', None)])
+    return (1, b'', tb.encode('utf-8'), cmd, usage)
+
+def get_sample_reads(run_dir):
+    # we run centrifuge per sample, read 1 and read 2 files of each in lane order
+    fastq_files = get_fastq_files(run_dir)
+    grps = group_fastq_files(run_dir, fastq_files)
+    logging.info("Found %s samples to run on centrifuge\n" % (len(grps)))
+    reads = {}
+    for sample, files in grps.items():
+        read1 = [files[1][i] for i in sorted(files[1])]
+        if 2 in files:
+            read2 = [files[2][i] for i in sorted(files[2])]
+        else:
+            read2 = None
+        reads[sample] = (read1, read2)
+    return reads
+
+def start_run(run_dir):
+    # mark the run processed and return the reads of each sample
+    run_state.mark(run_dir, PROCESSED_FILE)
+    run = os.path.basename(os.path.normpath(run_dir))
+    logging.info("Centrifuge processing %s\n" % (run))
+    return get_sample_reads(run_dir)
+
+class SampleQueue(object):
+    '''
+    samples of every started run waiting for or in the pool, oldest run
+    first, a run is done when its last sample finishes, samples are started
+    in batches of the same run
+    '''
+
+    def __init__(self):
+        self.pending = []
+        self.inputs = {}
+        self.remaining = {}
+        self.results = {}
+
+    def add_run(self, run_dir, inputs):
+        self.remaining[run_dir] = len(inputs)
+        self.results[run_dir] = {}
+        for sample in sorted(inputs):
+            self.pending.append((run_dir, sample))
+            self.inputs[(run_dir, sample)] = inputs[sample]
+
+    def batches(self, size):
+        # waiting samples in tuples of at most size, each from one run
+        batches = []
+        for item in self.pending:
+            if batches and len(batches[-1]) < size and batches[-1][0][0] == item[0]:
+                batches[-1].append(item)
             else:
-                failed_samples.append(sample)
-                message = 'sample %s failed\n see logs here: %s\n' % (sample, output)
-                status = 'failure'
-                # failures from bcl2fastq will be emailed from inner job
-                # inner job passes ret code 9 on fail from bcl2fastq
-                # only email from outer job if error is from inner job itself
-                # not the bcl2fastq subprocess
-            logging.info('message = %s' % message)
-
-        if failed_samples:
-            failure_email(run, cmd, ret_code, std_out, std_err)
-            # success or failure of individual run will be logged from run.py to capture
-            # manual runs for the status log
+                batches.append([item])
+        return [tuple(batch) for batch in batches]
+
+    def take(self, item):
+        # a (run dir, sample) leaving the queue for the pool, return its inputs
+        self.pending.remove(item)
+        return self.inputs[item]
+
+    def finished(self, item, result):
+        '''
+        record the result of a sample, return the results of all its run's
+        samples if it was the last, None otherwise
+        '''
+        run_dir, sample = item
+        self.inputs.pop(item, None)
+        self.results[run_dir][sample] = result
+        self.remaining[run_dir] -= 1
+        if self.remaining[run_dir]:
+            return None
+        del self.remaining[run_dir]
+        return self.results.pop(run_dir)
+
+def fill_queue(samples, slots, rescan=True):
+    '''
+    start runs that need processing until at least slots samples are
+    waiting, return the run dirs started
+    '''
+    started = []
+    runs_found = [d for d in find_runs(need_to_process, rescan) if d not in samples.remaining]
+    for run_dir in runs_found:
+        if len(samples.pending) >= slots:
+            break
+        reads = start_run(run_dir)
+        started.append(run_dir)
+        if reads:
+            samples.add_run(run_dir, reads)
         else:
-            # copy html files to final dir
-            dest_dir = config.FINAL_DIR + run + '/centrifuge/'
-            centrifuge_dir = run_dir + 'centrifuge'
-            html_files = glob.glob(centrifuge_dir + '/*.html')
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            for hf in html_files:
-                html_name = hf.split('/')[-1]
-                util.copy(hf, dest_dir + html_name)
-            util.chmod_rec(dest_dir, FINAL_DIR_PERMISSIONS, FINAL_FILE_PERMISSIONS)
-            util.touch(run_dir, COMPLETE_FILE)
-            success_email(run, centrifuge_dir, cmd, ret_code, std_out, std_err)
-        logging.info("Completed centrifuge for run %s with %i samples %i success %s and %i failures %s\n\n\n" %
-                (run, len(results), len(success_samples), json.dumps(success_samples), len(failed_samples), json.dumps(failed_samples)))
+            finish_run(run_dir, {})
+    METRICS.queue_depth.set(len(runs_found) - len(started))
+    METRICS.in_flight.set(len(samples.remaining))
+    SAMPLES_QUEUED.set(len(samples.pending))
+    if started:
+        logging.info("Found %s runs: %s\nstarted %s:\n%s\n" % (len(runs_found), json.dumps(runs_found),
+            len(started), json.dumps(started)))
+    return started
+
+def sample_finished(samples, item, result):
+    # record a sample, once it is the run's last the run is finished
+    results = samples.finished(item, result)
+    if results is not None:
+        finish_run(item[0], results)
+
+def batch_finished(samples, batch, results):
+    # results maps each sample of the batch to its result
+    for item in batch:
+        sample_finished(samples, item, results[item[1]])
+
+def finish_run(run_dir, results):
+    '''
+    once every sample of the run has finished copy the reports to the final
+    dir and email, results maps each sample to what run_batch returned,
+    return true if every sample succeeded
+    '''
+    run = os.path.basename(os.path.normpath(run_dir))
+    failed_samples = []
+    success_samples = []
+    failed = None
+    metrics = RunMetrics(run, run_dir + 'centrifuge/' + METRICS_FILE)
+    for sample, result in sorted(results.items()):
+        ret_code, std_out, std_err, cmd, usage = result
+        usage['sample'] = sample
+        metrics.add_child(usage)
+        METRICS.observe_stage('centrifuge', usage['wall_seconds'], usage['bytes_read'])
+        output = std_out + std_err
+        if ret_code == 0:
+            success_samples.append(sample)
+            message = 'sample %s completed successfully\nsee logs here: %s\n' % (sample, output)
+        else:
+            failed_samples.append(sample)
+            failed = result
+            message = 'sample %s failed\n see logs here: %s\n' % (sample, output)
+        logging.info('message = %s' % message)
+    if failed_samples:
+        METRICS.finished.inc(status='failure')
+        METRICS.failures.inc(len(failed_samples), reason='sample')
+        ret_code, std_out, std_err, cmd, usage = failed
+        failure_email(run, cmd, ret_code, std_out, std_err)
+    else:
+        # copy html files to final dir
+        dest_dir = config.FINAL_DIR + run + '/centrifuge/'
+        centrifuge_dir = run_dir + 'centrifuge'
+        html_files = glob.glob(centrifuge_dir + '/*.html')
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        for hf in html_files:
+            html_name = hf.split('/')[-1]
+            util.copy(hf, dest_dir + html_name)
+        util.chmod_rec(dest_dir, FINAL_DIR_PERMISSIONS, FINAL_FILE_PERMISSIONS)
+        run_state.mark(run_dir, COMPLETE_FILE)
+        METRICS.finished.inc(status='success')
+        cmd = results[sorted(results)[-1]][3] if results else ''
+        success_email(run, centrifuge_dir, cmd, 0, '', '')
+    logging.info('Writing centrifuge metrics to %s\n' % metrics.write())
+    logging.info("Completed centrifuge for run %s with %i samples %i success %s and %i failures %s\n\n\n" %
+            (run, len(results), len(success_samples), json.dumps(success_samples), len(failed_samples), json.dumps(failed_samples)))
+    return not failed_samples
+
+def start_batch(samples, batch):
+    # take a batch from the queue, return its cmd, reports and batch work
+    cmd, outfiles, work = get_batch_cmd(batch, [samples.take(item) for item in batch])
+    logging.info("Queueing centrifuge cmd for %s:\n%s\n" % (', '.join(sorted(outfiles)), cmd))
+    return cmd, outfiles, work
+
+def run_finished(finished, waker, batch, results):
+    # called from the pool's result thread, the main loop handles the results
+    finished.put((batch, results))
+    if waker:
+        waker.set()
+
+def handle_finished(samples, running, finished):
+    while True:
+        try:
+            batch, results = finished.get_nowait()
+        except Empty:
+            break
+        running.discard(batch)
+        batch_finished(samples, batch, results)
+
+def dispatch_samples(pool, proc_num, samples, running, finished, waker=None,
+        batch_size=BATCH_SIZE):
+    # fill free slots with batches of waiting samples, whichever run they are from
+    for batch in samples.batches(batch_size):
+        if len(running) >= proc_num:
+            break
+        cmd, outfiles, work = start_batch(samples, batch)
+        running.add(batch)
+        pool.apply_async(run_batch, (cmd, outfiles, work), callback=partial(run_finished, finished, waker, batch))
+    SAMPLES_QUEUED.set(len(samples.pending))
+
+def process_runs(pool, proc_num, samples, running, finished, waker=None):
+    # samples from the next runs start as soon as slots free rather than
+    # after every sample of the current run
+    handle_finished(samples, running, finished)
+    fill_queue(samples, (proc_num - len(running)) * BATCH_SIZE)
+    dispatch_samples(pool, proc_num, samples, running, finished, waker)
 
 if __name__ == "__main__":
     try:
         setup_logging()
+        exporter.start(METRICS, METRICS_PORT)
         proc_num = PROC_NUM
         # create pool and call process_runs to apply_async jobs
         pool = Pool(proc_num)
+        samples = SampleQueue()
+        running = set()
+        finished = Queue()
+        # finished samples wake the loop so their slot is refilled right away
+        waker = discovery.Waker()
         # run continuously
         while True:
-            # queue new runs for demultiplexing with bcl2fastq2
-            process_runs(pool, proc_num)
+            # queue samples of new runs for centrifuge
+            with METRICS.loop():
+                process_runs(pool, proc_num, samples, running, finished, waker)
             # wait before checking for more runs to process
             frequency = os.getenv('ODYBCL2FASTQ_FREQUENCY', FREQUENCY)
             if frequency != FREQUENCY:
                 logging.info("Frequency is not default: %i\n" % frequency)
-            time.sleep(frequency)
+            # returns early if a run finishes writing its required files or
+            # a sample finishes
+            discovery.get_watcher(config.OUTPUT_DIR, REQUIRED_FILES).wait(frequency, waker)
         pool.close()
     except Exception as e:
         logging.exception(e)
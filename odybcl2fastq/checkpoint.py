@@ -0,0 +1,78 @@
+'''
+per stage checkpoint records kept in the output dir so a rerun skips the
+stages that already completed with the same inputs
+'''
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+CHECKPOINT_FILE = 'odybcl2fastq.checkpoints.json'
+
+def fingerprint(*inputs):
+    # stable hash of any json serializable inputs
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+def file_fingerprint(path):
+    # identify a small input file, like a sample sheet, by its content
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+class Checkpoints(object):
+
+    def __init__(self, output_dir, enabled=True):
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.records = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except ValueError:
+            logging.warning('Ignoring unreadable checkpoints %s' % self.path)
+            return {}
+
+    def save(self):
+        out_dir = os.path.dirname(self.path)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.records, fh, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def is_done(self, stage, fp):
+        # a stage is done if it completed with the same input fingerprint
+        if not self.enabled:
+            return False
+        record = self.records.get(stage)
+        return bool(record and record['fingerprint'] == fp)
+
+    def token(self, stage):
+        '''
+        identifies one completion of a stage, downstream stages include it
+        in their fingerprint so they rerun whenever stage reruns
+        '''
+        record = self.records.get(stage)
+        if not record:
+            return None
+        return '%s:%s' % (record['fingerprint'], record['completed'])
+
+    def mark(self, stage, fp):
+        with self.lock:
+            self.records[stage] = {'fingerprint': fp, 'completed': time.time()}
+            self.save()
+
+    def clear(self, stage):
+        with self.lock:
+            if self.records.pop(stage, None):
+                self.save()
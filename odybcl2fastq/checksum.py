@@ -0,0 +1,180 @@
+'''
+checksum demultiplexed fastq files with a pool of workers, computing every
+requested digest in a single read of each file
+'''
+import os
+import json
+import hashlib
+import logging
+from glob import glob
+from multiprocessing.pool import ThreadPool
+
+# md5 is always computed, users verify deliveries with md5sum -c
+DEFAULT_ALGORITHM = 'md5'
+# manifest file per algorithm, formats match the coreutils *sum -c tools
+MANIFEST_FILES = {
+    'md5': 'md5sum.txt',
+    'sha1': 'sha1sum.txt',
+    'sha256': 'sha256sum.txt',
+    'blake2b': 'b2sum.txt'
+}
+# per output dir cache of digests so reruns only hash new or changed files
+CACHE_FILE = 'odybcl2fastq.checksums.json'
+BUFFER_SIZE = 2**23
+THREADS = int(os.getenv('ODYBCL2FASTQ_CHECKSUM_THREADS', 4))
+ALGORITHMS = os.getenv('ODYBCL2FASTQ_CHECKSUM_ALGORITHMS', DEFAULT_ALGORITHM)
+
+def get_algorithms(algorithms=None):
+    # parse a comma separated list of algorithms, md5 is always first
+    if algorithms is None:
+        algorithms = ALGORITHMS
+    if not isinstance(algorithms, (list, tuple)):
+        algorithms = algorithms.split(',')
+    algs = [DEFAULT_ALGORITHM]
+    for alg in algorithms:
+        alg = alg.strip().lower()
+        if not alg or alg in algs:
+            continue
+        if alg not in MANIFEST_FILES:
+            raise ValueError('unsupported checksum algorithm: %s' % alg)
+        try:
+            hashlib.new(alg)
+        except ValueError:
+            # blake2 is not available on older pythons
+            logging.warning('checksum algorithm %s is not available, skipping' % alg)
+            continue
+        algs.append(alg)
+    return algs
+
+def find_fastq(output_dir):
+    # fastq are either in sample project dirs or at the root of output
+    sample_proj_path = '%s/*/*.fastq.gz' % output_dir
+    file_path = '%s/*.fastq.gz' % output_dir
+    file_lst = glob(sample_proj_path)
+    file_lst.extend(glob(file_path))
+    return file_lst
+
+def is_fastq(rel):
+    # the files find_fastq globs, at the root or in a sample project dir
+    return rel.endswith('.fastq.gz') and rel.count('/') <= 1
+
+def hash_file(path, algorithms=None, buffer_size=BUFFER_SIZE):
+    '''
+    read a file once, updating a hasher for each algorithm, return dict of
+    algorithm to hex digest
+    '''
+    hashers = [(alg, hashlib.new(alg)) for alg in get_algorithms(algorithms)]
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(buffer_size)
+            if not data:
+                break
+            for alg, hasher in hashers:
+                hasher.update(data)
+    return dict((alg, hasher.hexdigest()) for alg, hasher in hashers)
+
+def _hash_file_worker(job):
+    path, algorithms, buffer_size = job
+    return path, hash_file(path, algorithms, buffer_size)
+
+def hash_files(paths, algorithms=None, threads=THREADS, buffer_size=BUFFER_SIZE):
+    '''
+    hash files concurrently, hashlib releases the gil while digesting large
+    buffers so threads keep several disks busy, return dict of path to
+    digests
+    '''
+    algorithms = get_algorithms(algorithms)
+    jobs = [(path, algorithms, buffer_size) for path in paths]
+    if threads <= 1 or len(jobs) <= 1:
+        return dict(_hash_file_worker(job) for job in jobs)
+    pool = ThreadPool(min(threads, len(jobs)))
+    try:
+        return dict(pool.imap_unordered(_hash_file_worker, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+def relative_path(root, path):
+    # put relative path in the checksum file so it can be run from
+    # the root even if the user copies the data somewhere else
+    return path.replace(root.rstrip('/') + '/', '', 1)
+
+def write_manifests(output_dir, digests, algorithms=None):
+    '''
+    write one manifest per algorithm to output_dir, digests is a dict of
+    relative path to a dict of algorithm to hex digest
+    '''
+    manifests = []
+    for alg in get_algorithms(algorithms):
+        path = os.path.join(output_dir, MANIFEST_FILES[alg])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            for rel in sorted(digests):
+                fh.write(digests[rel][alg] + '  ' + rel + '\n')
+        os.rename(tmp_path, path)
+        manifests.append(path)
+    return manifests
+
+def stat_key(st):
+    # a file is unchanged if it is the same inode with the same size and mtime
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+    return [st.st_ino, st.st_size, mtime_ns]
+
+def load_cache(output_dir):
+    path = os.path.join(output_dir, CACHE_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except ValueError:
+        # a corrupt cache only costs a rehash
+        logging.warning('Ignoring unreadable checksum cache %s' % path)
+        return {}
+
+def save_cache(output_dir, cache):
+    path = os.path.join(output_dir, CACHE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(cache, fh)
+    os.rename(tmp_path, path)
+
+def cached_digests(cache, rel, key, algorithms):
+    # return cached digests if the file is unchanged and has every algorithm
+    entry = cache.get(rel)
+    if not entry or entry['key'] != key:
+        return None
+    if any(alg not in entry['digests'] for alg in algorithms):
+        return None
+    return entry['digests']
+
+def checksum_dir(output_dir, algorithms=None, threads=THREADS):
+    '''
+    checksum all fastq in output_dir and write manifests, md5sum.txt is
+    always written, files unchanged since the last call are not reread
+    '''
+    algorithms = get_algorithms(algorithms)
+    cache = load_cache(output_dir)
+    new_cache = {}
+    digests = {}
+    to_hash = {}
+    for path in find_fastq(output_dir):
+        rel = relative_path(output_dir, path)
+        key = stat_key(os.stat(path))
+        cached = cached_digests(cache, rel, key, algorithms)
+        if cached:
+            digests[rel] = cached
+            new_cache[rel] = cache[rel]
+        else:
+            to_hash[path] = (rel, key)
+    logging.info('Checksumming %i fastq files in %s with %s using %i threads, %i unchanged files from cache' %
+            (len(to_hash), output_dir, ', '.join(algorithms), threads, len(digests)))
+    hashed = hash_files(list(to_hash), algorithms, threads)
+    for path, d in hashed.items():
+        rel, key = to_hash[path]
+        digests[rel] = d
+        new_cache[rel] = {'key': key, 'digests': d}
+    save_cache(output_dir, new_cache)
+    return write_manifests(output_dir, digests, algorithms)
@@ -0,0 +1,149 @@
+'''
+claim a run folder so only one process_runs, on any host sharing the source
+dir, starts it
+
+a claim is an odybcl2fastq.claim file created with O_EXCL holding the
+claimant's host, pid and a random token.  the claimant touches it every
+HEARTBEAT seconds, a claim not touched for TIMEOUT seconds is stale and can
+be taken over by whichever worker creates the takeover lock
+'''
+import os
+import json
+import time
+import uuid
+import errno
+import socket
+import logging
+import threading
+
+CLAIM_FILE = 'odybcl2fastq.claim'
+HEARTBEAT = int(os.getenv('ODYBCL2FASTQ_CLAIM_HEARTBEAT', 60))
+TIMEOUT = int(os.getenv('ODYBCL2FASTQ_CLAIM_TIMEOUT', 600))
+
+def get_path(run_dir):
+    return run_dir + CLAIM_FILE
+
+def read_claim(path):
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+def is_stale(path, timeout=TIMEOUT):
+    try:
+        return time.time() - os.stat(path).st_mtime > timeout
+    except OSError:
+        return False
+
+def is_orphaned(run_dir, timeout=TIMEOUT):
+    # a run whose claimant stopped heart beating, most likely its host died
+    return is_stale(get_path(run_dir), timeout)
+
+def _create(path):
+    token = uuid.uuid4().hex
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return None
+        raise
+    with os.fdopen(fd, 'w') as fh:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(),
+            'token': token, 'claimed': time.time()}, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return token
+
+def _take_over(path, timeout):
+    '''
+    remove a stale claim, only the worker holding the takeover lock may so a
+    claim made after the stale one was removed is never removed too
+    '''
+    lock = path + '.takeover'
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        # left by a worker that died while taking over
+        if is_stale(lock, timeout):
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+        return False
+    try:
+        if not is_stale(path, timeout):
+            return False
+        stale = read_claim(path) or {}
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        logging.warning('Took over stale claim on %s from %s pid %s\n' % (path,
+            stale.get('host'), stale.get('pid')))
+        return True
+    finally:
+        os.remove(lock)
+
+def claim(run_dir, timeout=TIMEOUT):
+    '''
+    return a token if this process now holds the run, None if another live
+    claimant does
+    '''
+    path = get_path(run_dir)
+    token = _create(path)
+    if token is None and is_stale(path, timeout) and _take_over(path, timeout):
+        token = _create(path)
+    return token
+
+def holds(run_dir, token):
+    found = read_claim(get_path(run_dir))
+    return bool(found and found.get('token') == token)
+
+def release(run_dir, token):
+    if holds(run_dir, token):
+        os.remove(get_path(run_dir))
+
+class Heartbeat(threading.Thread):
+    '''
+    keep the claims of this process fresh while their runs are processed
+    '''
+
+    def __init__(self, interval=HEARTBEAT):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.claims = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add(self, run_dir, token):
+        with self.lock:
+            self.claims[run_dir] = token
+
+    def remove(self, run_dir):
+        with self.lock:
+            return self.claims.pop(run_dir, None)
+
+    def beat(self):
+        with self.lock:
+            claims = list(self.claims.items())
+        for run_dir, token in claims:
+            if holds(run_dir, token):
+                try:
+                    os.utime(get_path(run_dir), None)
+                except OSError as e:
+                    logging.warning('Could not renew claim on %s: %s\n' % (run_dir, e))
+            else:
+                logging.warning('Lost claim on %s, another worker took it over\n' % run_dir)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,311 @@
+'''
+find run folders without sweeping the whole source dir every loop
+
+run dirs are listed again only when the parent dir changes and a filter is
+re-run on a run dir only when its mtime changes or every recheck interval, so
+a steady state loop costs one stat per run dir.  where inotify is available
+the daemons also wake as soon as a run writes its last required file rather
+than at the next poll, changes made by other hosts over nfs are not seen by
+inotify so the scan is always kept as the source of truth
+'''
+import os
+import time
+import errno
+import fcntl
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+RECHECK_INTERVAL = int(os.getenv('ODYBCL2FASTQ_RECHECK_INTERVAL', 3600))
+USE_INOTIFY = os.getenv('ODYBCL2FASTQ_INOTIFY', '1') != '0'
+# runs not modified for this long are not watched
+WATCH_DAYS = 7
+# a dir modified this recently may change again within its mtime resolution
+MTIME_SLACK = 2
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE | IN_ATTRIB
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    '''
+    minimal inotify binding through libc, raises OSError if the kernel or
+    libc does not provide it
+    '''
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+
+    def add_watch(self, path, mask=EVENT_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        return wd
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, timeout):
+        '''
+        wait up to timeout seconds, return list of (path watched, mask, name)
+        '''
+        if not select_fds([self.fd], timeout):
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'replace')
+            pos += length
+            if wd in self.paths:
+                events.append((self.paths[wd], mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class RunWatcher(object):
+
+    def __init__(self, root, required=None, recheck_interval=RECHECK_INTERVAL, inotify=USE_INOTIFY):
+        self.root = root
+        # the required files of each pipeline watching the root
+        self.required = []
+        self.add_required(required)
+        self.recheck_interval = recheck_interval
+        self.root_mtime = None
+        self.dirs = []
+        # dir to (mtime, time checked) and per filter dir to result
+        self.stats = {}
+        self.results = {}
+        self.notified = set()
+        self.watched = set()
+        self.inotify = None
+        if inotify:
+            try:
+                self.inotify = Inotify()
+                self.inotify.add_watch(root.rstrip('/') or '/', IN_CREATE | IN_MOVED_TO | IN_DELETE)
+            except OSError as e:
+                logging.info('Run discovery in %s polling, no inotify: %s\n' % (root, e))
+                self.inotify = None
+
+    def add_required(self, required):
+        if required and list(required) not in self.required:
+            self.required.append(list(required))
+
+    def run_dirs(self):
+        # list the root again only when runs were added or removed
+        try:
+            mtime = os.stat(self.root).st_mtime
+        except OSError:
+            return []
+        if mtime != self.root_mtime or time.time() - mtime < MTIME_SLACK:
+            self.root_mtime = mtime
+            dirs = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path):
+                    dirs.append(path + '/')
+            self.dirs = sorted(dirs)
+            gone = set(self.stats) - set(self.dirs)
+            for dir in gone:
+                self.forget(dir)
+        return self.dirs
+
+    def forget(self, dir):
+        self.stats.pop(dir, None)
+        for results in self.results.values():
+            results.pop(dir, None)
+
+    def changed(self, dir, now):
+        '''
+        stat dir, true if it must be checked again, the cached results of
+        every filter for an unchanged dir stay valid
+        '''
+        try:
+            mtime = os.stat(dir).st_mtime
+        except OSError:
+            self.forget(dir)
+            return True
+        last = self.stats.get(dir)
+        if (last is None or last[0] != mtime or dir in self.notified
+                or now - last[1] > self.recheck_interval):
+            for results in self.results.values():
+                results.pop(dir, None)
+            self.notified.discard(dir)
+            # a dir changed within its mtime resolution may change unseen
+            checked = now if now - mtime > MTIME_SLACK else 0
+            self.stats[dir] = (mtime, checked)
+            self.watch(dir, mtime, now)
+            return True
+        return False
+
+    def watch(self, dir, mtime, now):
+        if self.inotify and dir not in self.watched and now - mtime < WATCH_DAYS * 86400:
+            try:
+                self.inotify.add_watch(dir.rstrip('/'))
+                self.watched.add(dir)
+            except OSError as e:
+                logging.warning('Could not watch %s: %s\n' % (dir, e))
+
+    def scan(self):
+        # list the root and stat its dirs, dirs that changed are checked
+        # again by every filter
+        now = time.time()
+        for dir in self.run_dirs():
+            self.changed(dir, now)
+
+    def find_runs(self, filter, rescan=True):
+        '''
+        run dirs that pass filter, a drop in replacement for globbing.
+        without rescan the last scan is used so several pipelines watching
+        the same root can share one scan
+        '''
+        if rescan:
+            self.scan()
+        results = self.results.setdefault(filter, {})
+        runs = []
+        for dir in self.dirs:
+            if dir not in results:
+                results[dir] = filter(dir)
+            if results[dir]:
+                runs.append(dir)
+        return runs
+
+    def is_ready(self, dir, required):
+        for req in required:
+            if not os.path.exists(dir + req):
+                return False
+        return True
+
+    def read_events(self):
+        '''
+        run dirs where a required file arrived since the last read that now
+        have every required file of any one pipeline
+        '''
+        ready = []
+        for path, mask, name in self.inotify.read(0):
+            if path.rstrip('/') == self.root.rstrip('/'):
+                # a new run folder, the next scan lists and watches it
+                self.root_mtime = None
+                continue
+            dir = path + '/'
+            self.notified.add(dir)
+            if dir in ready:
+                continue
+            for required in self.required:
+                if name in [os.path.basename(r) for r in required] and self.is_ready(dir, required):
+                    logging.info('Run ready: %s\n' % dir)
+                    ready.append(dir)
+                    break
+        return ready
+
+    def wait(self, timeout, wake=None):
+        '''
+        sleep up to timeout seconds, returning early with the run dirs that
+        became ready if inotify sees their required files arrive, or with
+        none if wake is set
+        '''
+        return wait_any([self], timeout, wake)
+
+def wait_any(watchers, timeout, wake=None):
+    # RunWatcher.wait for several roots at once
+    inotifies = dict((w.inotify, w) for w in watchers if w.inotify)
+    watched = list(inotifies) + ([wake] if wake else [])
+    if not watched:
+        time.sleep(timeout)
+        return []
+    end = time.time() + timeout
+    ready = []
+    while not ready:
+        remaining = end - time.time()
+        if remaining <= 0:
+            break
+        readable = select_fds(watched, remaining)
+        if wake and wake in readable:
+            wake.clear()
+            break
+        for inotify in readable:
+            if inotify in inotifies:
+                ready.extend(d for d in inotifies[inotify].read_events() if d not in ready)
+    return ready
+
+def select_fds(fds, timeout):
+    try:
+        readable, _, _ = select.select(fds, [], [], timeout)
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
+    return readable
+
+class Waker(object):
+    '''
+    lets another thread, like a pool callback, end a RunWatcher.wait early
+    '''
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.read_fd
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'x')
+        except OSError as e:
+            # a full pipe is already set
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+_watchers = {}
+
+def get_watcher(root, required=None):
+    '''
+    one watcher per root dir for the life of the daemon, pipelines sharing a
+    root share its scan, a dir is ready once it has the required files of
+    any one of them
+    '''
+    if root not in _watchers:
+        _watchers[root] = RunWatcher(root, required)
+    watcher = _watchers[root]
+    watcher.add_required(required)
+    return watcher
@@ -0,0 +1,269 @@
+'''
+prometheus metrics for the daemons, served as text from a thread on a local
+port along with a health check that fails when the scan loop stalls
+
+each daemon keeps its own metrics named after its pipeline, exp:
+odybcl2fastq_runs_in_flight, centrifuge_runs_in_flight
+'''
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+ADDRESS = os.getenv('ODYBCL2FASTQ_METRICS_ADDRESS', '127.0.0.1')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a quick scan to a long demultiplex
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+# the loop is stalled if it has not finished a pass for this long
+STALL_SECONDS = int(os.getenv('ODYBCL2FASTQ_STALL_SECONDS', 900))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in pairs]
+    return '{%s}' % ','.join(escaped)
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('%s takes labels %s, got %s' % (self.name, self.labels, sorted(labels)))
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        # name suffix, label pairs and value of each sample
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield '', list(zip(self.labels, key)), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, pairs, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(pairs), format_value(value)))
+        return lines
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        # number of observations and their sum
+        with self.lock:
+            counts, total = self.values.get(self.key(labels), ([0] * len(self.buckets), 0.0))
+        return counts[-1], total
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            pairs = list(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', pairs + [('le', format_value(bound))], count
+            yield '_sum', pairs, total
+            yield '_count', pairs, counts[-1]
+
+class Registry(object):
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter('%s_%s' % (self.prefix, name), help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge('%s_%s' % (self.prefix, name), help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram('%s_%s' % (self.prefix, name), help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class DaemonMetrics(Registry):
+    '''
+    the metrics every daemon reports, the daemon sets queue depth and runs
+    in flight and counts runs as they finish
+    '''
+
+    def __init__(self, prefix, stall_seconds=STALL_SECONDS):
+        super(DaemonMetrics, self).__init__(prefix)
+        self.stall_seconds = stall_seconds
+        self.started = time.time()
+        self.queue_depth = self.gauge('queue_depth', 'Ready runs waiting to be started.')
+        self.in_flight = self.gauge('runs_in_flight', 'Runs being processed.')
+        self.loop_seconds = self.histogram('loop_seconds', 'Time taken by one pass of the scan loop.')
+        self.last_loop = self.gauge('last_loop_timestamp_seconds', 'When the scan loop last finished a pass.')
+        self.finished = self.counter('runs_finished_total', 'Runs finished by status.', ['status'])
+        self.failures = self.counter('failures_total', 'Failures by reason.', ['reason'])
+        self.stage_seconds = self.histogram('stage_seconds', 'Wall time of completed stages.', ['stage'])
+        self.stage_bytes = self.counter('stage_bytes_total', 'Bytes written or copied by stages.', ['stage'])
+
+    @contextmanager
+    def loop(self):
+        # time one pass of the scan loop
+        start = time.time()
+        yield
+        end = time.time()
+        self.loop_seconds.observe(end - start)
+        self.last_loop.set(end)
+
+    def observe_stage(self, stage, seconds, bytes=None):
+        self.stage_seconds.observe(seconds, stage=stage)
+        if bytes:
+            self.stage_bytes.inc(bytes, stage=stage)
+
+    def observe_run_metrics(self, path):
+        '''
+        add the stages of a run's metrics json, stages skipped because an
+        earlier attempt completed them have no timings
+        '''
+        try:
+            with open(path, 'r') as fh:
+                run_metrics = json.load(fh)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('Could not read run metrics %s: %s\n' % (path, e))
+            return
+        for stage, record in run_metrics.get('stages', {}).items():
+            if record.get('status') == 'success' and 'wall_seconds' in record:
+                self.observe_stage(stage, record['wall_seconds'],
+                        record.get('bytes', record.get('bytes_written')))
+
+    def healthy(self, now=None):
+        # the loop finished a pass recently, or has not been running long
+        now = now or time.time()
+        last = self.last_loop.get() or self.started
+        return now - last < self.stall_seconds
+
+class Combined(object):
+    '''
+    serve the metrics of several registries, the first is the daemon's own
+    and decides its health
+    '''
+
+    def __init__(self, registries):
+        self.registries = registries
+        self.prefix = registries[0].prefix
+
+    def render(self):
+        return ''.join(r.render() for r in self.registries)
+
+    def healthy(self, now=None):
+        return self.registries[0].healthy(now)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path.split('?')[0] == '/metrics':
+            self.reply(200, registry.render())
+        elif self.path.split('?')[0] == '/health':
+            if getattr(registry, 'healthy', lambda: True)():
+                self.reply(200, 'ok\n')
+            else:
+                self.reply(503, 'stalled\n')
+        else:
+            self.reply(404, 'not found\n')
+
+    def reply(self, code, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics %s %s\n' % (self.address_string(), format % args))
+
+def serve(registry, port, address=ADDRESS):
+    '''
+    serve /metrics and /health on port from a daemon thread, return the
+    server, port 0 picks a free port
+    '''
+    server = _Server((address, port), _Handler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Serving %s metrics on %s:%i\n' % (registry.prefix, address, server.server_address[1]))
+    return server
+
+def start(registry, port):
+    # metrics are optional, a daemon runs on without them if the port is taken
+    if not port:
+        return None
+    try:
+        return serve(registry, port)
+    except Exception as e:
+        logging.warning('Could not serve metrics on port %s: %s\n' % (port, e))
+        return None
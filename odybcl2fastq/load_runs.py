@@ -18,6 +18,9 @@ from datetime import datetime
 from odybcl2fastq import config
 from odybcl2fastq import constants as const
 import odybcl2fastq.util as util
+from odybcl2fastq import discovery
+from odybcl2fastq import run_state
+from odybcl2fastq import exporter
 from odybcl2fastq.emailbuilder.emailbuilder import buildmessage
 from odybcl2fastq.bauer_db import BauerDB
 
@@ -32,6 +35,9 @@ DAYS_TO_SEARCH = 7
 SEARCH_AFTER_DATE = datetime.strptime('May 10 2018', '%b %d %Y')
 REQUIRED_FILES = ['SampleSheet.csv', 'RunInfo.xml']
 PROC_NUM = 1
+# serve prometheus metrics on this local port, off if unset
+METRICS_PORT = int(os.getenv('ODYBCL2FASTQ_BAUER_METRICS_PORT', 0))
+METRICS = exporter.DaemonMetrics('bauer')
 FREQUENCY = 60
 
 def setup_logging():
@@ -57,25 +63,14 @@ def send_email(message, subject):
     toemaillist=config.EMAIL['to_email']
     buildmessage(message, subject, None, fromaddr, toemaillist)
 
-def run_is_incomplete(dir):
-    now = datetime.now()
-    m_time = datetime.fromtimestamp(os.stat(dir).st_mtime)
-    # filter out if modified before cutover to odybcl2fastq
-    if m_time < SEARCH_AFTER_DATE:
-        return False
-    # filter out if modified after reasonable delay to allow for completion
-    if ((now - m_time).days) <= INCOMPLETE_AFTER_DAYS:
-        return False
-    # filter out if tagged as complete
-    if os.path.isfile(dir + COMPLETE_FILE):
-        return False
-    # filter out if never tagged for processing
-    if not os.path.isfile(dir + PROCESSED_FILE):
-        return False
-    # filter out already notified
-    if os.path.isfile(dir + INCOMPLETE_NOTIFIED_FILE):
-        return False
-    return True
+def find_incomplete_runs():
+    # runs marked processed long enough ago that never completed, an indexed
+    # lookup once run dirs not seen before have had their markers imported
+    db = run_state.get_db()
+    db.backfill_all(discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).run_dirs())
+    return db.find(PROCESSED_FILE, without=[COMPLETE_FILE, INCOMPLETE_NOTIFIED_FILE],
+            after=time.mktime(SEARCH_AFTER_DATE.timetuple()),
+            before=time.time() - (INCOMPLETE_AFTER_DAYS + 1) * 86400, root=config.SOURCE_DIR)
 
 def need_to_process(dir):
     now = datetime.now()
@@ -87,7 +82,7 @@ def need_to_process(dir):
     if ((now - m_time).days) > DAYS_TO_SEARCH:
         return False
     # filter out if tagged as processed
-    if os.path.isfile(dir + PROCESSED_FILE):
+    if run_state.has(dir, PROCESSED_FILE):
         return False
     # filter out if any required files are missing
     for req in REQUIRED_FILES:
@@ -95,14 +90,9 @@ def need_to_process(dir):
             return False
     return True
 
-def find_runs(filter):
-    # get all subdirectories
-    dirs = sorted(glob.glob(config.SOURCE_DIR + '*/'))
-    runs = []
-    for dir in dirs:
-        if filter(dir):
-            runs.append(dir)
-    return runs
+def find_runs(filter, rescan=True):
+    # subdirectories that pass filter, only changed dirs are checked again
+    return discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).find_runs(filter, rescan)
 
 def get_sample_sheet_path(run_dir):
     # set default
@@ -110,58 +100,75 @@ def get_sample_sheet_path(run_dir):
     return sample_sheet_path
 
 def notify_incomplete_runs():
-    run_dirs = find_runs(run_is_incomplete)
+    run_dirs = find_incomplete_runs()
     run_dirs_str = "\n".join(run_dirs)
     if run_dirs:
         message = "The following runs failed be entered into bauer db %s or more days ago:\n\n%s" % (INCOMPLETE_AFTER_DAYS, run_dirs_str)
         send_email(message, 'BauerDB incomplete runs')
         for run in run_dirs:
-            util.touch(run, INCOMPLETE_NOTIFIED_FILE)
+            run_state.mark(run, INCOMPLETE_NOTIFIED_FILE)
+
+def start_run(run_dir):
+    run_state.mark(run_dir, PROCESSED_FILE)
+    logging.info("Loading run into bauer db:\n%s\n" % (os.path.basename(os.path.normpath(run_dir))))
+
+def load_run(run_dir):
+    # insert the run, return its result and how long it took
+    start = time.time()
+    bauer = BauerDB(get_sample_sheet_path(run_dir))
+    result = bauer.insert_run(run_dir)
+    return result, time.time() - start
+
+def finish_run(run_dir, result, seconds):
+    METRICS.observe_stage('insert_run', seconds)
+    if result:
+        status = 'success'
+        run_state.mark(run_dir, COMPLETE_FILE)
+    else:
+        status = 'failure'
+        METRICS.failures.inc(reason='insert_run')
+    METRICS.finished.inc(status=status)
+    return status
 
 def load_runs(proc_num):
     runs_found = find_runs(need_to_process)
     run_dirs = runs_found[:proc_num]
+    METRICS.queue_depth.set(len(runs_found) - len(run_dirs))
     if run_dirs:
         logging.info("Found %s runs: %s\nprocessing first %s:\n%s\n" % (len(runs_found), json.dumps(runs_found), len(run_dirs),
             json.dumps(run_dirs)))
-        results = {}
-        for run_dir in run_dirs:
-            util.touch(run_dir, PROCESSED_FILE)
-            run = os.path.basename(os.path.normpath(run_dir))
-            sample_sheet_path = get_sample_sheet_path(run_dir)
-            bauer = BauerDB(sample_sheet_path)
-            logging.info("Loading run into bauer db:\n%s\n" % (run))
-            results[run] = bauer.insert_run(run_dir)
         failed_runs = []
         success_runs = []
-        for run, result in results.items():
-            if result:
+        for run_dir in run_dirs:
+            run = os.path.basename(os.path.normpath(run_dir))
+            start_run(run_dir)
+            METRICS.in_flight.set(1)
+            result, seconds = load_run(run_dir)
+            METRICS.in_flight.set(0)
+            if finish_run(run_dir, result, seconds) == 'success':
                 success_runs.append(run)
-                status = 'success'
-                util.touch(run_dir, COMPLETE_FILE)
             else:
                 failed_runs.append(run)
-                status = 'failure'
-
-            # success or failure of individual run will be logged from run.py to capture
-            # manual runs for the status log
         logging.info("Completed %i runs %i success %s and %i failures %s\n\n\n" %
-                (len(results), len(success_runs), json.dumps(success_runs), len(failed_runs), json.dumps(failed_runs)))
+                (len(run_dirs), len(success_runs), json.dumps(success_runs), len(failed_runs), json.dumps(failed_runs)))
 
 if __name__ == "__main__":
     try:
         proc_num = os.getenv('ODYBCL2FASTQ_PROC_NUM', PROC_NUM)
         setup_logging()
+        exporter.start(METRICS, METRICS_PORT)
         # run continuously
         while True:
             # search for new runs
-            load_runs(proc_num)
-            notify_incomplete_runs()
+            with METRICS.loop():
+                load_runs(proc_num)
+                notify_incomplete_runs()
             # wait before checking for more runs to process
             frequency = os.getenv('ODYBCL2FASTQ_FREQUENCY', FREQUENCY)
             if frequency != FREQUENCY:
                 logging.info("Frequency is not default: %i\n" % frequency)
-            time.sleep(frequency)
+            # returns early if a run finishes writing its required files
+            discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).wait(frequency)
     except Exception as e:
         logging.exception(e)
         send_email(str(e), 'Odybcl2fastq load_runs.py exception')
@@ -0,0 +1,130 @@
+'''
+per stage timing and throughput for a run, written as json next to the
+run's .opts file
+
+cpu and io are read for the whole process, including child processes once
+they have exited, so stages that overlap share their counts
+'''
+import os
+import json
+import numbers
+import time
+import logging
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+METRICS_SUFFIX = '.metrics.json'
+# run.py prints a line starting with this for each metrics file it writes
+WRITTEN_PREFIX = 'odybcl2fastq metrics written: '
+PROC_IO = '/proc/self/io'
+
+def read_io():
+    # bytes read and written by this process and its exited children
+    io = {}
+    if not os.path.exists(PROC_IO):
+        return io
+    with open(PROC_IO, 'r') as fh:
+        for line in fh:
+            key, val = line.split(':')
+            io[key.strip()] = int(val)
+    return io
+
+def report_written(path, out):
+    # tell the process that started run.py which metrics this attempt wrote
+    out.write('%s%s\n' % (WRITTEN_PREFIX, path))
+    out.flush()
+
+def written_paths(output):
+    # metrics paths reported in run.py's stdout
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    return [line[len(WRITTEN_PREFIX):].strip() for line in output.splitlines()
+            if line.startswith(WRITTEN_PREFIX)]
+
+def cpu_times():
+    # user and system seconds for this process and its exited children
+    usage = {'user': 0.0, 'sys': 0.0}
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        usage['user'] += ru.ru_utime
+        usage['sys'] += ru.ru_stime
+    return usage
+
+def get_metrics_path(output_dir, run):
+    return '%s/%s%s' % (output_dir, run, METRICS_SUFFIX)
+
+class RunMetrics(object):
+
+    def __init__(self, run, path=None):
+        self.run = run
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.children = []
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        time the block, the yielded record can be given counts like files
+        and bytes by the caller
+        '''
+        record = OrderedDict()
+        cpu = cpu_times()
+        io = read_io()
+        start = time.time()
+        record['start'] = start
+        record['status'] = 'failed'
+        try:
+            yield record
+            record['status'] = 'success'
+        finally:
+            end_cpu = cpu_times()
+            end_io = read_io()
+            record['wall_seconds'] = time.time() - start
+            record['user_seconds'] = end_cpu['user'] - cpu['user']
+            record['sys_seconds'] = end_cpu['sys'] - cpu['sys']
+            for key, name_io in [('bytes_read', 'rchar'), ('bytes_written', 'wchar'),
+                    ('disk_bytes_read', 'read_bytes'), ('disk_bytes_written', 'write_bytes')]:
+                if name_io in io and name_io in end_io:
+                    record[key] = end_io[name_io] - io[name_io]
+            with self.lock:
+                self.stages[name] = record
+            logging.info('%s stage %s took %.1fs\n' % (self.run, name, record['wall_seconds']))
+
+    def add_child(self, usage):
+        # resource usage of an external tool, see subproc.run
+        with self.lock:
+            self.children.append(usage)
+
+    def skip(self, name):
+        with self.lock:
+            self.stages[name] = OrderedDict([('start', time.time()), ('status', 'skipped')])
+
+    def add_counts(self, record, result):
+        # pick up file and byte counts from stages that return them
+        if isinstance(result, dict):
+            for key in ['files', 'bytes']:
+                if isinstance(result.get(key), numbers.Integral):
+                    record[key] = result[key]
+
+    def to_dict(self):
+        with self.lock:
+            return OrderedDict([
+                ('run', self.run),
+                ('started', self.started),
+                ('wall_seconds', time.time() - self.started),
+                ('stages', OrderedDict(self.stages)),
+                ('children', list(self.children))
+            ])
+
+    def write(self, path=None):
+        path = path or self.path
+        out_dir = os.path.dirname(path)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        with open(path, 'w') as fh:
+            json.dump(self.to_dict(), fh, indent=4)
+        return path
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+'''
+one daemon for demultiplexing, centrifuge and loading the bauer db, in place
+of running process_runs.py, centrifuge_process_runs.py and load_runs.py
+
+each pass scans the source and output dirs once, the pipelines watching the
+same dir share its scan, then the ready work of every pipeline is started
+from one queue into one pool, pipelines earlier in PRIORITY first and no
+pipeline holding more than its limit of the slots
+'''
+import os
+import json
+import logging
+import traceback
+from functools import partial
+from multiprocessing import Pool
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+from odybcl2fastq import config
+from odybcl2fastq import constants as const
+from odybcl2fastq import discovery
+from odybcl2fastq import priority
+from odybcl2fastq import claim
+from odybcl2fastq import retry
+from odybcl2fastq import exporter
+from odybcl2fastq import run_history
+from odybcl2fastq.admission import AdmissionController
+from odybcl2fastq import process_runs as demux
+from odybcl2fastq import centrifuge_process_runs as centrifuge
+from odybcl2fastq import load_runs as bauer
+
+LOG_FILE = const.ROOT_DIR + 'orchestrator.log'
+PROC_NUM = int(os.getenv('ODYBCL2FASTQ_ORCHESTRATOR_PROCS', 4))
+# pool slots each pipeline may hold at once, exp: demux:2,centrifuge:2,bauer:1
+LIMITS = dict((name, int(num)) for name, num in (item.split(':') for item in
+    os.getenv('ODYBCL2FASTQ_ORCHESTRATOR_LIMITS', 'demux:2,centrifuge:2,bauer:1').split(',') if item))
+# bauer loads are quick so they go first by default
+PRIORITY = os.getenv('ODYBCL2FASTQ_ORCHESTRATOR_PRIORITY', 'bauer,demux,centrifuge').split(',')
+METRICS_PORT = int(os.getenv('ODYBCL2FASTQ_ORCHESTRATOR_METRICS_PORT', 0))
+METRICS = exporter.DaemonMetrics('orchestrator')
+FREQUENCY = 60
+
+def setup_logging():
+    # take level from env or INFO
+    level = os.getenv('ODYBCL2FASTQ_LOGGING_LEVEL', logging.INFO)
+    logging.basicConfig(
+            filename= LOG_FILE,
+            level=level,
+            format='%(asctime)s %(message)s'
+    )
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+def run_work(func, args):
+    # runs in a pool worker, always returns so the slot is freed
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+class DemuxPipeline(object):
+    '''
+    demultiplex runs in the source dir with run.py, as process_runs.py does
+    '''
+
+    name = 'demux'
+    metrics = demux.METRICS
+
+    def __init__(self, heartbeat=None, admission=None, retries=None):
+        self.heartbeat = heartbeat
+        self.admission = admission
+        self.retries = retries
+        self.running = {}
+
+    def watchers(self):
+        return [discovery.get_watcher(config.SOURCE_DIR, demux.REQUIRED_FILES)]
+
+    def ready(self):
+        run_dirs = demux.ready_runs(self.running, self.retries, rescan=False)
+        return priority.order_runs(run_dirs, output_dir=config.OUTPUT_DIR)
+
+    def start(self, run_dir):
+        token = demux.start_run(run_dir, self.heartbeat, self.admission, self.retries)
+        if not token:
+            return None
+        run = demux.get_run(run_dir)
+        self.running[run] = (run_dir, token)
+        cmd = demux.get_odybcl2fastq_cmd(run_dir)
+        logging.info("Queueing odybcl2fastq cmd for %s:\n%s\n" % (run, cmd))
+        return run, demux.run_odybcl2fastq, (cmd, len(self.running))
+
+    def finish(self, run, result):
+        run_dir, token = self.running.pop(run)
+        status = demux.finish_run(run, run_dir, token, result, self.heartbeat,
+                self.admission, self.retries)
+        logging.info("Completed run %s with %s\n" % (run, status))
+
+    def failed(self, run, tb):
+        # run_odybcl2fastq catches its own errors, kept for completeness
+        self.finish(run, (1, '', tb, ''))
+
+    def after(self):
+        demux.notify_incomplete_runs()
+        demux.copy_log()
+
+class CentrifugePipeline(object):
+    '''
+    classify the samples of demultiplexed runs in the output dir, samples of
+    every started run share one queue so the next run's samples fill slots
+    as soon as they free, each slot classifies a batch of a run's samples
+    '''
+
+    name = 'centrifuge'
+    metrics = centrifuge.METRICS
+
+    def __init__(self, slots, batch_size=centrifuge.BATCH_SIZE):
+        self.slots = slots
+        self.batch_size = batch_size
+        self.samples = centrifuge.SampleQueue()
+        # cmd of each batch in the pool
+        self.cmds = {}
+
+    def watchers(self):
+        return [discovery.get_watcher(config.OUTPUT_DIR, centrifuge.REQUIRED_FILES)]
+
+    def ready(self):
+        # batches of (run dir, sample) waiting, runs are started while fewer
+        # samples than fill the pipeline's slots wait
+        centrifuge.fill_queue(self.samples, self.slots * self.batch_size, rescan=False)
+        return self.samples.batches(self.batch_size)
+
+    def start(self, batch):
+        cmd, outfiles, work = centrifuge.start_batch(self.samples, batch)
+        self.cmds[batch] = cmd
+        return batch, centrifuge.run_batch, (cmd, outfiles, work)
+
+    def finish(self, batch, results):
+        self.cmds.pop(batch, None)
+        centrifuge.batch_finished(self.samples, batch, results)
+
+    def failed(self, batch, tb):
+        # run_batch catches centrifuge's errors, kept for completeness
+        cmd = self.cmds.get(batch, '')
+        self.finish(batch, dict((item[1], centrifuge.error_result(cmd, tb)) for item in batch))
+
+    def after(self):
+        pass
+
+class BauerPipeline(object):
+    '''
+    load runs in the source dir into the bauer db, as load_runs.py does
+    '''
+
+    name = 'bauer'
+    metrics = bauer.METRICS
+
+    def __init__(self):
+        self.running = set()
+
+    def watchers(self):
+        return [discovery.get_watcher(config.SOURCE_DIR, bauer.REQUIRED_FILES)]
+
+    def ready(self):
+        return [d for d in bauer.find_runs(bauer.need_to_process, False) if d not in self.running]
+
+    def start(self, run_dir):
+        bauer.start_run(run_dir)
+        self.running.add(run_dir)
+        return run_dir, bauer.load_run, (run_dir,)
+
+    def finish(self, run_dir, result):
+        self.running.discard(run_dir)
+        status = bauer.finish_run(run_dir, *result)
+        logging.info("Loaded %s into bauer db with %s\n" % (run_dir, status))
+
+    def failed(self, run_dir, tb):
+        logging.error('Loading %s into bauer db failed:\n%s\n' % (run_dir, tb))
+        self.finish(run_dir, (False, 0))
+
+    def after(self):
+        bauer.notify_incomplete_runs()
+
+class Orchestrator(object):
+
+    def __init__(self, pool, proc_num, pipelines, limits=None, waker=None):
+        self.pool = pool
+        self.proc_num = proc_num
+        self.pipelines = pipelines
+        self.limits = limits or {}
+        self.waker = waker
+        # (pipeline name, key) to pipeline of the work in the pool
+        self.running = {}
+        self.finished = Queue()
+        self.watchers = []
+        for pipeline in pipelines:
+            for watcher in pipeline.watchers():
+                if watcher not in self.watchers:
+                    self.watchers.append(watcher)
+
+    def in_flight(self, pipeline):
+        return len([key for key in self.running if key[0] == pipeline.name])
+
+    def work_finished(self, name, key, result):
+        # called from the pool's result thread, the main loop handles the result
+        self.finished.put(((name, key), result))
+        if self.waker:
+            self.waker.set()
+
+    def handle_finished(self):
+        done = []
+        while True:
+            try:
+                (name, key), (ok, result) = self.finished.get_nowait()
+            except Empty:
+                break
+            pipeline = self.running.pop((name, key))
+            done.append((name, key))
+            if ok:
+                pipeline.finish(key, result)
+            else:
+                logging.error('%s work on %s failed:\n%s\n' % (name, key, result))
+                pipeline.failed(key, result)
+            pipeline.metrics.in_flight.set(self.in_flight(pipeline))
+        return done
+
+    def queue(self):
+        # ready work of every pipeline, pipelines in priority order
+        queue = []
+        for pipeline in self.pipelines:
+            queue.extend((pipeline, run_dir) for run_dir in pipeline.ready())
+        return queue
+
+    def dispatch(self):
+        '''
+        start queued work in the free slots, return the (pipeline name, key)
+        of the work started
+        '''
+        queue = self.queue()
+        started = []
+        for pipeline, run_dir in queue:
+            if len(self.running) >= self.proc_num:
+                break
+            if self.in_flight(pipeline) >= self.limits.get(pipeline.name, self.proc_num):
+                continue
+            work = pipeline.start(run_dir)
+            if not work:
+                continue
+            key, func, args = work
+            self.running[(pipeline.name, key)] = pipeline
+            self.pool.apply_async(run_work, (func, args),
+                    callback=partial(self.work_finished, pipeline.name, key))
+            started.append((pipeline.name, key))
+        if started:
+            logging.info("Started %s, %i of %i slots in use\n" % (json.dumps(started),
+                len(self.running), self.proc_num))
+        for pipeline in self.pipelines:
+            waiting = len([p for p, run_dir in queue if p is pipeline])
+            waiting -= len([key for key in started if key[0] == pipeline.name])
+            pipeline.metrics.queue_depth.set(waiting)
+            pipeline.metrics.in_flight.set(self.in_flight(pipeline))
+        METRICS.queue_depth.set(len(queue) - len(started))
+        METRICS.in_flight.set(len(self.running))
+        return started
+
+    def process(self):
+        with METRICS.loop():
+            # one scan of each dir for all the pipelines watching it
+            for watcher in self.watchers:
+                watcher.scan()
+            self.handle_finished()
+            self.dispatch()
+            for pipeline in self.pipelines:
+                pipeline.after()
+
+    def wait(self, timeout):
+        return discovery.wait_any(self.watchers, timeout, self.waker)
+
+def get_pipelines(names, heartbeat=None, admission=None, retries=None, limits=None):
+    limits = limits or {}
+    pipelines = {
+        'demux': lambda: DemuxPipeline(heartbeat, admission, retries),
+        'centrifuge': lambda: CentrifugePipeline(limits.get('centrifuge', PROC_NUM)),
+        'bauer': BauerPipeline
+    }
+    return [pipelines[name]() for name in names]
+
+if __name__ == "__main__":
+    try:
+        setup_logging()
+        exporter.start(exporter.Combined([METRICS, demux.METRICS, centrifuge.METRICS,
+            bauer.METRICS]), METRICS_PORT)
+        if not os.path.exists(run_history.HISTORY_FILE):
+            run_history.import_summary_log(demux.LOG_FILE)
+        proc_num = PROC_NUM
+        pool = Pool(proc_num)
+        # finished work wakes the loop so its slot is refilled right away
+        waker = discovery.Waker()
+        # renews the claims on the runs this worker is demultiplexing
+        heartbeat = claim.Heartbeat()
+        heartbeat.start()
+        pipelines = get_pipelines(PRIORITY, heartbeat, AdmissionController(config.OUTPUT_DIR),
+                retry.RetryQueue(), LIMITS)
+        orchestrator = Orchestrator(pool, proc_num, pipelines, LIMITS, waker)
+        logging.info("Orchestrating %s in %i slots, limits %s\n" % (json.dumps(PRIORITY),
+            proc_num, json.dumps(LIMITS)))
+        # run continuously
+        while True:
+            orchestrator.process()
+            # wait before checking for more work, returns early if a run
+            # becomes ready or work finishes
+            frequency = int(os.getenv('ODYBCL2FASTQ_FREQUENCY', FREQUENCY))
+            if frequency != FREQUENCY:
+                logging.info("Frequency is not default: %i\n" % frequency)
+            orchestrator.wait(frequency)
+        pool.close()
+    except Exception as e:
+        logging.exception(e)
+        demux.send_email(str(e), 'Odybcl2fastq orchestrator exception')
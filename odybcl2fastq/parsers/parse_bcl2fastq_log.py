@@ -0,0 +1,56 @@
+import re
+
+# bcl2fastq2 lines look like:
+# 2017-11-01 10:41:27 [2ad83eb8e700] Demultiplexing lane 1, tile 1101
+LINE_RE = re.compile(r'^(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) \[[0-9a-fA-F]+\] (?P<message>.*)$')
+LANE_RE = re.compile(r'\blane:?\s*(\d+)', re.IGNORECASE)
+TILE_RE = re.compile(r'\btile:?\s*(?:s_\d+_)?(\d+)', re.IGNORECASE)
+COMPLETE_RE = re.compile(r'Processing completed with (\d+) errors and (\d+) warnings')
+STAGES = ['loading', 'demultiplexing', 'compressing', 'writing', 'processing',
+        'converting']
+
+class Bcl2fastqProgress(object):
+    '''
+    turn bcl2fastq output lines into progress events, an event is a dict
+    with the stage, lane and tile named in the line and how many distinct
+    tiles have been seen in that stage
+    '''
+
+    def __init__(self):
+        self.tiles = {}
+
+    def parse(self, line):
+        match = LINE_RE.match(line.strip())
+        if not match:
+            return None
+        message = match.group('message')
+        complete = COMPLETE_RE.search(message)
+        if complete:
+            return {
+                'time': match.group('time'),
+                'stage': 'complete',
+                'errors': int(complete.group(1)),
+                'warnings': int(complete.group(2)),
+                'message': message
+            }
+        lane = LANE_RE.search(message)
+        tile = TILE_RE.search(message)
+        if not lane or not tile:
+            return None
+        words = message.lower()
+        stage = 'processing'
+        for s in STAGES:
+            if s in words:
+                stage = s
+                break
+        seen = self.tiles.setdefault(stage, set())
+        seen.add((int(lane.group(1)), int(tile.group(1))))
+        event = {
+            'time': match.group('time'),
+            'stage': stage,
+            'lane': int(lane.group(1)),
+            'tile': int(tile.group(1)),
+            'tiles_done': len(seen),
+            'message': message
+        }
+        return event
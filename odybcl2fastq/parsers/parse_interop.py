@@ -0,0 +1,60 @@
+import struct
+from collections import OrderedDict
+
+# tile metric codes in version 2 files
+CLUSTER_DENSITY = 100
+PF_CLUSTER_DENSITY = 101
+CLUSTER_COUNT = 102
+PF_CLUSTER_COUNT = 103
+V2_RECORD = struct.Struct('<HHHf')
+# version 3, written by RTA3, stores counts per tile under code 't'
+V3_RECORD = struct.Struct('<HIcff')
+
+class InterOpError(Exception):
+    pass
+
+def get_tile_metrics(tile_metrics_bin):
+    '''
+    return dict of (lane, tile) to dict of clusters and pf_clusters from
+    InterOp/TileMetricsOut.bin
+    '''
+    with open(tile_metrics_bin, 'rb') as fh:
+        data = fh.read()
+    if len(data) < 2:
+        raise InterOpError('tile metrics too short: %s' % tile_metrics_bin)
+    version, record_size = struct.unpack_from('<BB', data)
+    tiles = OrderedDict()
+    if version == 2:
+        if record_size != V2_RECORD.size:
+            raise InterOpError('unexpected record size %i in %s' % (record_size, tile_metrics_bin))
+        for pos in range(2, len(data) - record_size + 1, record_size):
+            lane, tile, code, value = V2_RECORD.unpack_from(data, pos)
+            if code == CLUSTER_COUNT:
+                tiles.setdefault((lane, tile), {})['clusters'] = value
+            elif code == PF_CLUSTER_COUNT:
+                tiles.setdefault((lane, tile), {})['pf_clusters'] = value
+    elif version == 3:
+        # a float tile area follows the header
+        if record_size != V3_RECORD.size:
+            raise InterOpError('unexpected record size %i in %s' % (record_size, tile_metrics_bin))
+        for pos in range(6, len(data) - record_size + 1, record_size):
+            lane, tile, code, clusters, pf_clusters = V3_RECORD.unpack_from(data, pos)
+            if code == b't':
+                tiles[(lane, tile)] = {'clusters': clusters, 'pf_clusters': pf_clusters}
+    else:
+        raise InterOpError('unsupported tile metrics version %i: %s' % (version, tile_metrics_bin))
+    return tiles
+
+def get_cluster_counts(tile_metrics_bin):
+    '''
+    total clusters and pf clusters for the run and the most clusters on any
+    one tile
+    '''
+    tiles = get_tile_metrics(tile_metrics_bin)
+    counts = {'clusters': 0, 'pf_clusters': 0, 'max_tile_clusters': 0, 'tiles': len(tiles)}
+    for metrics in tiles.values():
+        clusters = metrics.get('clusters', 0)
+        counts['clusters'] += clusters
+        counts['pf_clusters'] += metrics.get('pf_clusters', clusters)
+        counts['max_tile_clusters'] = max(counts['max_tile_clusters'], clusters)
+    return counts
@@ -24,3 +24,17 @@ def get_readinfo_from_runinfo(runinfo_xml_file):
         readkey_to_readdata_map['read%s' % number] = read_dict
     return readkey_to_readdata_map
 
+
+def get_flowcell_layout(runinfo_xml_file):
+    # tile counts per lane, total tiles is what bcl2fastq iterates over
+    tree = ET.parse(runinfo_xml_file)
+    root = tree.getroot()
+    layout = root.find('Run/FlowcellLayout')
+    counts = OrderedDict()
+    for key in ['LaneCount', 'SurfaceCount', 'SwathCount', 'TileCount']:
+        counts[key] = int(layout.attrib.get(key, 1)) if layout is not None else 1
+    tiles = 1
+    for cnt in counts.values():
+        tiles *= cnt
+    counts['Tiles'] = tiles
+    return counts
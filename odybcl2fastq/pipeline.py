@@ -0,0 +1,153 @@
+'''
+run the stages of a job as a dependency graph, each stage starts as soon as
+the stages it depends on have finished so independent stages overlap
+'''
+import os
+import logging
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from odybcl2fastq import checkpoint
+from odybcl2fastq import retry
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+THREADS = int(os.getenv('ODYBCL2FASTQ_PIPELINE_THREADS', 4))
+
+class StageError(Exception):
+    '''
+    a pipeline stage raised, the original exception is kept on the error
+    '''
+
+    def __init__(self, stage, error, tb=''):
+        super(StageError, self).__init__('stage %s failed: %s\n%s' % (stage, error, tb))
+        self.stage = stage
+        self.error = error
+
+class Pipeline(object):
+
+    def __init__(self, name, threads=THREADS, checkpoints=None, metrics=None,
+            retries=retry.RETRIES, retry_delay=retry.BASE_DELAY):
+        self.name = name
+        self.threads = threads
+        self.checkpoints = checkpoints
+        self.metrics = metrics
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.stages = OrderedDict()
+
+    def add(self, name, func, args=(), deps=(), inputs=None, retries=None):
+        '''
+        add a stage, deps on stages that were never added are ignored so
+        optional stages can be left out, stages with inputs are checkpointed
+        and skipped on a rerun with the same inputs and upstream stages.
+        a stage that raises a transient error is retried up to retries times,
+        the pipeline's retries by default
+        '''
+        if name in self.stages:
+            raise ValueError('duplicate stage %s' % name)
+        self.stages[name] = {
+            'func': func,
+            'args': args,
+            'deps': [d for d in deps if d in self.stages],
+            'inputs': inputs,
+            'retries': self.retries if retries is None else retries
+        }
+
+    def fingerprint(self, name):
+        stage = self.stages[name]
+        if self.checkpoints is None or stage['inputs'] is None:
+            return None
+        upstream = [self.checkpoints.token(d) for d in stage['deps']]
+        return checkpoint.fingerprint(name, stage['inputs'], upstream)
+
+    def _ready(self, done, started):
+        return [name for name, stage in self.stages.items() if name not in started
+                and all(d in done for d in stage['deps'])]
+
+    def _attempt(self, name):
+        # result of the stage and how many attempts it took
+        stage = self.stages[name]
+        return retry.call(stage['func'], stage['args'], stage['retries'],
+                self.retry_delay, '%s: stage %s' % (self.name, name))
+
+    def _call(self, name):
+        logging.info('%s: start stage %s\n' % (self.name, name))
+        try:
+            if self.metrics:
+                with self.metrics.stage(name) as record:
+                    result, record['attempts'] = self._attempt(name)
+                    self.metrics.add_counts(record, result)
+            else:
+                result, attempts = self._attempt(name)
+        except Exception as e:
+            logging.exception(e)
+            return name, False, (e, traceback.format_exc())
+        logging.info('%s: end stage %s\n' % (self.name, name))
+        return name, True, result
+
+    def run(self):
+        '''
+        run all stages, return dict of stage name to result, if a stage
+        raises its dependents are skipped and StageError is raised once the
+        remaining stages are finished
+        '''
+        results = OrderedDict()
+        done = set()
+        started = set()
+        failed = []
+        finished = Queue()
+        pool = ThreadPool(max(1, min(self.threads, len(self.stages))))
+        fingerprints = {}
+        try:
+            running = 0
+            while True:
+                skipped = False
+                for name in self._ready(done, started):
+                    started.add(name)
+                    fingerprints[name] = self.fingerprint(name)
+                    if fingerprints[name] and self.checkpoints.is_done(name, fingerprints[name]):
+                        logging.info('%s: skipping stage %s, completed in a previous run\n' % (self.name, name))
+                        if self.metrics:
+                            self.metrics.skip(name)
+                        done.add(name)
+                        results[name] = None
+                        skipped = True
+                        continue
+                    running += 1
+                    pool.apply_async(self._call, (name,), callback=finished.put)
+                if skipped:
+                    continue
+                if not running:
+                    break
+                name, ok, result = finished.get()
+                running -= 1
+                if ok:
+                    if fingerprints[name]:
+                        self.checkpoints.mark(name, fingerprints[name])
+                    done.add(name)
+                    results[name] = result
+                else:
+                    failed.append((name, result))
+                    # nothing downstream of a failed stage can run
+                    for skip in self.dependents(name):
+                        if skip not in started:
+                            logging.warning('%s: skipping stage %s, %s failed\n' % (self.name, skip, name))
+                            started.add(skip)
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            name, (error, tb) = failed[0]
+            raise StageError(name, error, tb)
+        return results
+
+    def dependents(self, name):
+        # all stages downstream of name
+        found = []
+        for stage_name, stage in self.stages.items():
+            if name in stage['deps'] or any(d in found for d in stage['deps']):
+                found.append(stage_name)
+        return found
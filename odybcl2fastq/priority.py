@@ -0,0 +1,114 @@
+'''
+order the runs ready for demultiplexing
+
+fifo keeps the run folder name order.  sjf starts the run with the least
+work first, a run's effective work shrinks the longer it waits so big
+flowcells are not starved.  weighted is weighted fair queuing, each run is
+ordered by when it became ready plus its work divided by its weight, so small
+and heavily weighted runs overtake big ones but never indefinitely.  a number
+in an odybcl2fastq.priority file in the run folder always goes first, higher
+numbers first, an empty file counts as 1
+'''
+import os
+import time
+import logging
+from odybcl2fastq.parsers.parse_runinfoxml import get_runinfo, get_flowcell_layout, get_readinfo_from_runinfo
+
+PRIORITY_FILE = 'odybcl2fastq.priority'
+MODES = ['fifo', 'sjf', 'weighted']
+MODE = os.getenv('ODYBCL2FASTQ_SCHEDULE', 'fifo')
+# waiting this long halves the effective work of a run
+AGING_HOURS = float(os.getenv('ODYBCL2FASTQ_AGING_HOURS', 12))
+# weights by instrument id prefix, exp: NB:2,D:1
+INSTRUMENT_WEIGHTS = dict((k, float(v)) for k, v in
+        (w.split(':') for w in os.getenv('ODYBCL2FASTQ_INSTRUMENT_WEIGHTS', '').split(',') if w))
+RERUN_WEIGHT = float(os.getenv('ODYBCL2FASTQ_RERUN_WEIGHT', 2))
+# cycles times tiles demultiplexed per hour, converts work to time
+WORK_PER_HOUR = float(os.getenv('ODYBCL2FASTQ_WORK_PER_HOUR', 50000))
+
+def get_override(run_dir):
+    path = run_dir + PRIORITY_FILE
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r') as fh:
+        value = fh.read().strip()
+    try:
+        return int(value) if value else 1
+    except ValueError:
+        logging.warning('Ignoring priority %s in %s' % (value, path))
+        return 0
+
+def estimate_work(runinfo_xml):
+    # cycles times tiles over all lanes, what bcl2fastq has to read
+    cycles = sum(int(read['NumCycles']) for read in get_readinfo_from_runinfo(runinfo_xml).values())
+    return cycles * get_flowcell_layout(runinfo_xml)['Tiles']
+
+def get_instrument_weight(instrument):
+    # longest matching prefix wins
+    for prefix in sorted(INSTRUMENT_WEIGHTS, key=len, reverse=True):
+        if instrument.startswith(prefix):
+            return INSTRUMENT_WEIGHTS[prefix]
+    return 1.0
+
+def get_run_info(run_dir, output_dir=None, now=None):
+    '''
+    inputs to the schedule for a run, reruns are runs that already have
+    output from an earlier attempt
+    '''
+    now = now or time.time()
+    runinfo_xml = run_dir + 'RunInfo.xml'
+    run = os.path.basename(os.path.normpath(run_dir))
+    info = {
+        'run_dir': run_dir,
+        'priority': get_override(run_dir),
+        'work': 1,
+        'instrument': '',
+        'rerun': bool(output_dir and os.path.exists(output_dir + run)),
+        'ready': now
+    }
+    try:
+        info['work'] = max(1, estimate_work(runinfo_xml))
+        info['instrument'] = get_runinfo(runinfo_xml)['instrument'] or ''
+    except Exception as e:
+        logging.warning('Could not estimate work for %s: %s' % (run_dir, e))
+    # a run is ready once the instrument is done writing it
+    ready_file = run_dir + 'RTAComplete.txt'
+    if os.path.exists(ready_file):
+        info['ready'] = min(now, os.path.getmtime(ready_file))
+    return info
+
+def effective_work(info, now):
+    waited = now - info['ready']
+    return info['work'] / (1 + waited / (AGING_HOURS * 3600))
+
+def finish_tag(info):
+    # when the run would finish if it had the node to itself at its weight
+    return info['ready'] + info['work'] / (weight(info) * WORK_PER_HOUR) * 3600
+
+def weight(info):
+    w = get_instrument_weight(info['instrument'])
+    if info['rerun']:
+        w *= RERUN_WEIGHT
+    return w
+
+def order_runs(run_dirs, mode=None, output_dir=None, now=None):
+    '''
+    return run_dirs in the order they should start
+    '''
+    mode = mode or MODE
+    now = now or time.time()
+    if mode not in MODES:
+        raise ValueError('unknown schedule %s, use one of %s' % (mode, ', '.join(MODES)))
+    infos = [get_run_info(d, output_dir, now) for d in run_dirs]
+    if mode == 'fifo':
+        key = lambda info: (-info['priority'], info['run_dir'])
+    elif mode == 'sjf':
+        key = lambda info: (-info['priority'], effective_work(info, now), info['run_dir'])
+    else:
+        key = lambda info: (-info['priority'], finish_tag(info), info['run_dir'])
+    ordered = sorted(infos, key=key)
+    if len(ordered) > 1:
+        logging.info('Run order (%s): %s\n' % (mode, ', '.join('%s work %i%s' %
+            (os.path.basename(os.path.normpath(i['run_dir'])), i['work'],
+                ' priority %i' % i['priority'] if i['priority'] else '') for i in ordered)))
+    return [info['run_dir'] for info in ordered]
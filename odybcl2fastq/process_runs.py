@@ -15,12 +15,27 @@ import os, glob, time
 import logging
 import subprocess
 import json
+import traceback
+from functools import partial
 from datetime import datetime
 from multiprocessing import Pool
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 from odybcl2fastq import config
 from odybcl2fastq import constants as const
 import odybcl2fastq.util as util
+from odybcl2fastq import discovery
+from odybcl2fastq import run_state
+from odybcl2fastq import priority
+from odybcl2fastq import claim
+from odybcl2fastq import retry
+from odybcl2fastq import exporter
+from odybcl2fastq import run_history
+from odybcl2fastq.admission import AdmissionController
 from odybcl2fastq import run as ody_run
+from odybcl2fastq.metrics import written_paths
 from odybcl2fastq.emailbuilder.emailbuilder import buildmessage
 
 LOG_FILE = const.ROOT_DIR + 'odybcl2fastq.log'
@@ -36,6 +51,10 @@ INCOMPLETE_AFTER_DAYS = 2
 SEARCH_AFTER_DATE = datetime.strptime('Jan 15 2017', '%b %d %Y')
 REQUIRED_FILES = ['InterOp/QMetricsOut.bin', 'InterOp/TileMetricsOut.bin', 'RunInfo.xml', 'RTAComplete.txt']
 PROC_NUM = int(os.getenv('ODYBCL2FASTQ_PROC_NUM', 2))
+# serve prometheus metrics on this local port, off if unset
+METRICS_PORT = int(os.getenv('ODYBCL2FASTQ_METRICS_PORT', 0))
+METRICS = exporter.DaemonMetrics('odybcl2fastq')
+STATUS_PAGE = run_history.StatusPage(LOG_HTML)
 
 FREQUENCY = 60
 
@@ -63,6 +82,17 @@ def send_email(message, subject):
     buildmessage(message, subject, None, fromaddr, toemaillist)
 
 def need_to_process(dir):
+    # filter out if tagged as processed, processed runs that were orphaned
+    # are found by orphaned_runs
+    return can_process(dir) and not run_state.has(dir, PROCESSED_FILE)
+
+def may_be_orphaned(dir):
+    # processed runs that never completed, their claims go stale without
+    # the run dir changing so they are checked every pass
+    return (can_process(dir) and run_state.has(dir, PROCESSED_FILE)
+            and not run_state.has(dir, COMPLETE_FILE))
+
+def can_process(dir):
     now = datetime.now()
     m_time = datetime.fromtimestamp(os.stat(dir).st_mtime)
     # filter out if modified before cutover to odybcl2fastq
@@ -71,10 +101,8 @@ def need_to_process(dir):
     # filter out if modified outside or search window
     if ((now - m_time).days) > DAYS_TO_SEARCH:
         return False
-    # filter out if tagged as processed
-    if os.path.isfile(dir + PROCESSED_FILE):
-        return False
-    # filter out if tagged as skip
+    # filter out if tagged as skip, skip files are made by hand so the file
+    # is checked rather than the run state db
     if os.path.isfile(dir + SKIP_FILE):
         return False
     # filter out if any required files are missing
@@ -83,34 +111,18 @@ def need_to_process(dir):
             return False
     return True
 
-def run_is_incomplete(dir):
-    now = datetime.now()
-    m_time = datetime.fromtimestamp(os.stat(dir).st_mtime)
-    # filter out if modified before cutover to odybcl2fastq
-    if m_time < SEARCH_AFTER_DATE:
-        return False
-    # filter out if modified after reasonable delay to allow for completion
-    if ((now - m_time).days) <= INCOMPLETE_AFTER_DAYS:
-        return False
-    # filter out if tagged as complete
-    if os.path.isfile(dir + COMPLETE_FILE):
-        return False
-    # filter out if never tagged for processing
-    if not os.path.isfile(dir + PROCESSED_FILE):
-        return False
-    # filter out already notified
-    if os.path.isfile(dir + INCOMPLETE_NOTIFIED_FILE):
-        return False
-    return True
+def find_incomplete_runs():
+    # runs marked processed long enough ago that never completed, an indexed
+    # lookup once run dirs not seen before have had their markers imported
+    db = run_state.get_db()
+    db.backfill_all(discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).run_dirs())
+    return db.find(PROCESSED_FILE, without=[COMPLETE_FILE, INCOMPLETE_NOTIFIED_FILE],
+            after=time.mktime(SEARCH_AFTER_DATE.timetuple()),
+            before=time.time() - (INCOMPLETE_AFTER_DAYS + 1) * 86400, root=config.SOURCE_DIR)
 
-def find_runs(filter):
-    # get all subdirectories
-    dirs = sorted(glob.glob(config.SOURCE_DIR + '*/'))
-    runs = []
-    for dir in dirs:
-        if filter(dir):
-            runs.append(dir)
-    return runs
+def find_runs(filter, rescan=True):
+    # subdirectories that pass filter, only changed dirs are checked again
+    return discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).find_runs(filter, rescan)
 
 def get_sample_sheet_path(run_dir):
     # set default
@@ -133,6 +145,8 @@ def get_odybcl2fastq_cmd(run_dir):
         'sample-sheet': get_sample_sheet_path(run_dir),
         'runinfoxml': run_dir + 'RunInfo.xml'
     }
+    if os.getenv('ODYBCL2FASTQ_AUTO_THREADS'):
+        params['auto-threads'] = None
     args = []
     opt_flag = '--'
     for opt, val in params.items():
@@ -141,94 +155,251 @@ def get_odybcl2fastq_cmd(run_dir):
             args.append(val)
     return 'python ' + const.APP_DIR + 'run.py ' + ' '.join(args)
 
-def run_odybcl2fastq(cmd):
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-    std_out, std_err = proc.communicate()
+def run_odybcl2fastq(cmd, active_runs=1):
+    # runs started with --auto-threads share the node between active runs
+    env = dict(os.environ, ODYBCL2FASTQ_ACTIVE_RUNS=str(active_runs))
+    try:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=env)
+        std_out, std_err = proc.communicate()
+    except Exception:
+        # always return a result so the scheduler frees the slot
+        return (1, '', traceback.format_exc(), cmd)
     return (proc.returncode, std_out, std_err, cmd)
 
 def notify_incomplete_runs():
-    run_dirs = find_runs(run_is_incomplete)
+    run_dirs = find_incomplete_runs()
     run_dirs_str = "\n".join(run_dirs)
     if run_dirs:
         message = "The following runs failed to complete %s or more days ago:\n\n%s" % (INCOMPLETE_AFTER_DAYS, run_dirs_str)
         send_email(message, 'Odybcl2fastq incomplete runs')
         for run in run_dirs:
-            util.touch(run, INCOMPLETE_NOTIFIED_FILE)
-
-def tail(f, n):
-    cmd = "tail -n %i %s | grep returned" % (n, f)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    std_out, std_err = proc.communicate()
-    return std_out.splitlines(True)
+            run_state.mark(run, INCOMPLETE_NOTIFIED_FILE)
 
 def copy_log():
-    # last line is the tail command
-    lines = tail(LOG_FILE, 80000)
-    # show max of 100 lines
-    end = len(lines)
-    max = 100
-    if end > max:
-        end = end - max
-        lines = lines[-1:end:-1]
+    # the status page only changes when a run finishes
+    STATUS_PAGE.update()
+
+def orphaned_runs():
+    # processed runs whose worker stopped renewing its claim, a stat of each
+    # claim file every pass since a claim going stale does not change the dir
+    return [d for d in find_runs(may_be_orphaned, False) if claim.is_orphaned(d)]
+
+def get_run(run_dir):
+    return os.path.basename(os.path.normpath(run_dir))
+
+def ready_runs(running, retries=None, rescan=True):
+    '''
+    run dirs ready to demultiplex that are not running, runs that failed
+    transiently are included once their backoff is over
+    '''
+    # cheap when nothing changed, only changed run dirs are checked again
+    runs_found = find_runs(need_to_process, rescan)
+    runs_found = runs_found + orphaned_runs()
+    # marked processed already so need_to_process passes over them
+    if retries:
+        runs_found = runs_found + [d for d in retries.due() if d not in runs_found]
+    # a run just started may not have marked itself processed yet
+    return [d for d in runs_found if get_run(d) not in running]
+
+def already_processed(run_dir, orphaned=False):
+    '''
+    check the run's markers again once it is claimed, listing the dir rather
+    than stat'ing the markers gets past nfs attribute caching, a run taken
+    over from a dead worker is only done if it completed
+    '''
+    try:
+        names = set(os.listdir(run_dir))
+    except OSError:
+        names = set()
+    markers = [COMPLETE_FILE] if orphaned else [PROCESSED_FILE, COMPLETE_FILE]
+    return any(m in names or run_state.has(run_dir, m) for m in markers)
+
+def start_run(run_dir, heartbeat=None, admission=None, retries=None):
+    '''
+    reserve the run for this worker, return its claim token, or None if
+    admission has no room for it or another worker holds its claim
+    '''
+    # a run that does not fit lets smaller runs behind it start
+    if admission and not admission.admit(run_dir):
+        return None
+    orphaned = claim.is_orphaned(run_dir)
+    token = claim.claim(run_dir)
+    if not token:
+        logging.info("Run %s is claimed by another worker\n" % run_dir)
+        if admission:
+            admission.release(run_dir)
+        return None
+    # the scan that found the run may be stale, another worker may have
+    # processed it and released its claim since
+    retrying = retries and run_state.normalize(run_dir) in retries.due()
+    if not retrying and already_processed(run_dir, orphaned):
+        logging.info("Run %s was processed by another worker\n" % run_dir)
+        claim.release(run_dir, token)
+        if admission:
+            admission.release(run_dir)
+        return None
+    if heartbeat:
+        heartbeat.add(run_dir, token)
+    if retries:
+        retries.started(run_dir)
+    return token
+
+def finish_run(run, run_dir, token, result, heartbeat=None, admission=None, retries=None):
+    '''
+    release what start_run reserved and report the result, runs that exited
+    with a transient failure are queued to retry, return the run's status
+    '''
+    ret_code, std_out, std_err, cmd = result
+    # the processed and complete markers now keep other workers off it
+    if heartbeat:
+        heartbeat.remove(run_dir)
+    if admission:
+        admission.release(run_dir)
+    claim.release(run_dir, token)
+    retrying = False
+    if ret_code == 0:
+        status = 'success'
+        if retries:
+            retries.forget(run_dir)
+    elif ret_code == retry.EX_TEMPFAIL and retries and retries.add(run_dir):
+        # checkpoints resume the retry at the stage that failed
+        status = 'transient failure, will retry'
+        retrying = True
     else:
-        lines = lines[::-1]
-    with open(LOG_HTML, 'w') as f:
-        f.write('<pre>')
-        f.writelines(lines)
-        f.write('</pre>')
-
-def process_runs(pool, proc_num):
-    runs_found = find_runs(need_to_process)
-    run_dirs = runs_found[:proc_num]
+        status = 'failure'
+        # failures from bcl2fastq will be emailed from inner job
+        # inner job passes ret code 9 on fail from bcl2fastq
+        # only email from outer job if error is from inner job itself
+        # not the bcl2fastq subprocess
+        if ret_code != 9:
+            failure_email(run, cmd, ret_code, std_out, std_err)
+        if retries:
+            retries.forget(run_dir)
+    observe_run(ret_code, std_out, retrying)
+    return status
+
+def dispatch_runs(pool, proc_num, running, finished, waker=None, heartbeat=None, admission=None,
+        retries=None):
+    '''
+    start the next runs that need processing in the free pool slots, running
+    maps each run in the pool to its run dir and claim token, a run is only started once this
+    worker holds its claim so workers on several hosts can share the source
+    dir, and once admission has room for it
+    '''
+    runs_found = ready_runs(running, retries)
+    # kept current even with no free slots
+    METRICS.queue_depth.set(len(runs_found))
+    free = proc_num - len(running)
+    if free <= 0:
+        return []
+    runs_found = priority.order_runs(runs_found, output_dir=config.OUTPUT_DIR)
+    run_dirs = []
+    tokens = {}
+    for run_dir in runs_found:
+        if len(run_dirs) == free:
+            break
+        token = start_run(run_dir, heartbeat, admission, retries)
+        if token:
+            tokens[run_dir] = token
+            run_dirs.append(run_dir)
     if run_dirs:
-        logging.info("Found %s runs: %s\nprocessing first %s:\n%s\n" % (len(runs_found), json.dumps(runs_found), len(run_dirs),
+        logging.info("Found %s runs: %s\nstarting %s in free slots:\n%s\n" % (len(runs_found), json.dumps(runs_found), len(run_dirs),
             json.dumps(run_dirs)))
-        results = {}
-        for run_dir in run_dirs:
-            run = os.path.basename(os.path.normpath(run_dir))
-            cmd = get_odybcl2fastq_cmd(run_dir)
-            logging.info("Queueing odybcl2fastq cmd for %s:\n%s\n" % (run, cmd))
-            results[run] = pool.apply_async(run_odybcl2fastq, (cmd,))
-        failed_runs = []
-        success_runs = []
-        for run, result in results.items():
-            ret_code, std_out, std_err, cmd = result.get()
-            if ret_code == 0:
-                success_runs.append(run)
-                status = 'success'
-            else:
-                failed_runs.append(run)
-                status = 'failure'
-                # failures from bcl2fastq will be emailed from inner job
-                # inner job passes ret code 9 on fail from bcl2fastq
-                # only email from outer job if error is from inner job itself
-                # not the bcl2fastq subprocess
-                if ret_code != 9:
-                    failure_email(run, cmd, ret_code, std_out, std_err)
-            # success or failure of individual run will be logged from run.py to capture
-            # manual runs for the status log
-        logging.info("Completed %i runs %i success %s and %i failures %s\n\n\n" %
-                (len(results), len(success_runs), json.dumps(success_runs), len(failed_runs), json.dumps(failed_runs)))
-    copy_log()
+    for run_dir in run_dirs:
+        run = get_run(run_dir)
+        cmd = get_odybcl2fastq_cmd(run_dir)
+        logging.info("Queueing odybcl2fastq cmd for %s:\n%s\n" % (run, cmd))
+        running[run] = (run_dir, tokens[run_dir])
+        pool.apply_async(run_odybcl2fastq, (cmd, len(running)),
+                callback=partial(run_finished, finished, waker, run))
+    METRICS.queue_depth.set(len(runs_found) - len(run_dirs))
+    METRICS.in_flight.set(len(running))
+    return run_dirs
+
+def run_finished(finished, waker, run, result):
+    # called from the pool's result thread, the main loop handles the result
+    finished.put((run, result))
+    if waker:
+        waker.set()
+
+def handle_finished(running, finished, heartbeat=None, admission=None, retries=None):
+    '''
+    handle the runs that finished since the last call, freeing their slots,
+    return the runs handled
+    '''
+    done = []
+    while True:
+        try:
+            run, result = finished.get_nowait()
+        except Empty:
+            break
+        run_dir, token = running.pop(run)
+        done.append(run)
+        status = finish_run(run, run_dir, token, result, heartbeat, admission, retries)
+        # success or failure of individual run will be logged from run.py to capture
+        # manual runs for the status log
+        logging.info("Completed run %s with %s, %i runs still running %s\n\n\n" %
+                (run, status, len(running), json.dumps(sorted(running))))
+    METRICS.in_flight.set(len(running))
+    return done
+
+def observe_run(ret_code, std_out, retrying=False):
+    '''
+    count the finished run and add the stage timings of the metrics files
+    this attempt of run.py reported writing, runs queued to retry are not
+    counted as failures
+    '''
+    if ret_code == 0:
+        METRICS.finished.inc(status='success')
+    else:
+        METRICS.finished.inc(status='retry' if retrying else 'failure')
+        reason = {9: 'bcl2fastq', retry.EX_TEMPFAIL: 'transient'}.get(ret_code, 'error')
+        METRICS.failures.inc(reason=reason)
+    for path in written_paths(std_out or ''):
+        METRICS.observe_run_metrics(path)
+
+def process_runs(pool, proc_num, running, finished, waker=None, heartbeat=None, admission=None,
+        retries=None):
+    # runs are started as soon as a slot frees rather than in batches
+    with METRICS.loop():
+        handle_finished(running, finished, heartbeat, admission, retries)
+        dispatch_runs(pool, proc_num, running, finished, waker, heartbeat, admission, retries)
+        copy_log()
 
 if __name__ == "__main__":
     try:
         setup_logging()
+        exporter.start(METRICS, METRICS_PORT)
+        if not os.path.exists(run_history.HISTORY_FILE):
+            run_history.import_summary_log(LOG_FILE)
         proc_num = PROC_NUM
         # create pool and call process_runs to apply_async jobs
         pool = Pool(proc_num)
+        running = {}
+        finished = Queue()
+        # finished runs wake the loop so their slot is refilled right away
+        waker = discovery.Waker()
+        # renews the claims on the runs this worker is processing
+        heartbeat = claim.Heartbeat()
+        heartbeat.start()
+        # holds runs back until the output dir and node have room for them
+        admission = AdmissionController(config.OUTPUT_DIR)
+        # runs waiting to be retried after a transient failure
+        retries = retry.RetryQueue()
         # run continuously
         while True:
             # queue new runs for demultiplexing with bcl2fastq2
-            process_runs(pool, proc_num)
+            process_runs(pool, proc_num, running, finished, waker, heartbeat, admission, retries)
             # check for any runs that started but never completed demultiplexing
             notify_incomplete_runs()
             # wait before checking for more runs to process
             frequency = os.getenv('ODYBCL2FASTQ_FREQUENCY', FREQUENCY)
             if frequency != FREQUENCY:
                 logging.info("Frequency is not default: %i\n" % frequency)
-            time.sleep(frequency)
+            # returns early if a run finishes writing its required files or
+            # a running run finishes
+            discovery.get_watcher(config.SOURCE_DIR, REQUIRED_FILES).wait(frequency, waker)
         pool.close()
     except Exception as e:
         logging.exception(e)
@@ -14,8 +14,9 @@ from numpy import mean,median,log2,random,std,histogram
 from scipy.stats import sem
 from collections import defaultdict,OrderedDict
 from os.path import basename
-from subprocess import Popen,PIPE,call
+from subprocess import call
 from odybcl2fastq import UserException
+from odybcl2fastq import subproc
 
 
 def get_input_stream(fastqfile):
@@ -57,9 +58,8 @@ def fastq_sampler(fqin,samplingfreq=0.01,max_sample_count=100000):
 
 def dustmasker_runner(fasta,windowsize=20):             	
     dustcmd = 'dustmasker -in %s -out dustmasked_%s.intervals -window %s -outfmt acclist' % (fasta,fasta,windowsize) 
-    dust_run = Popen(dustcmd,shell=True,stderr=PIPE,stdout=PIPE)
-    dust_out,dust_err=dust_run.communicate() 
-    if dust_run.returncode!=0:
+    returncode,dust_out,dust_err,usage = subproc.run(dustcmd,name='dustmasker')
+    if returncode!=0:
         raise Exception('dustmasker run on %s failed: %s' % (fasta,dust_err))               
     else:
         return 'dustmasked_%s.intervals' % fasta       
@@ -1,5 +1,4 @@
 import argparse
-from subprocess import Popen,PIPE
 from glob import glob
 import os
 from subprocess import call
@@ -7,8 +6,13 @@ import gzip
 import logging
 import json
 import re
+from odybcl2fastq import subproc
+from odybcl2fastq import broker
 
-def fastqc_runner(output_dir,numthreads = 1,batch = False):
+# fastqc's default java heap per thread plus jvm overhead
+FASTQC_MEM_MB = 512
+
+def fastqc_runner(output_dir,numthreads = 1,batch = False,metrics = None):
     errors = []
     badfiles = []
     out = []
@@ -28,10 +32,10 @@ def fastqc_runner(output_dir,numthreads = 1,batch = False):
         call('mkdir %s' % (qc_dir) ,shell=True)
     if batch == True:
         fastqc_cmd = 'fastqc -o %s --threads %s -b %s' % (qc_dir,numthreads,files)
-        fastqc_run = Popen(fastqc_cmd,shell=True,stderr=PIPE,stdout=PIPE)
-        fastqc_out,fastqc_err=fastqc_run.communicate()
+        with broker.lease('fastqc', numthreads, numthreads * FASTQC_MEM_MB):
+            returncode,fastqc_out,fastqc_err,usage = subproc.run(fastqc_cmd,name='fastqc',metrics=metrics)
 
-        if fastqc_run.returncode!=0:
+        if returncode!=0:
             errors.append(fastqc_err)
             for file in files.split():
                 badfiles.append(os.pathbasename(file))
@@ -43,9 +47,9 @@ def fastqc_runner(output_dir,numthreads = 1,batch = False):
                 print('gz is not empty' + file)
                 fastqc_cmd = 'fastqc -o %s --noextract --threads 1 %s' % (qc_dir,file)
                 logging.info("FASTQC: " + fastqc_cmd)
-                fastqc_run = Popen(fastqc_cmd,shell=True,stderr=PIPE,stdout=PIPE)
-                fastqc_out,fastqc_err=fastqc_run.communicate()
-                if fastqc_run.returncode!=0:
+                with broker.lease('fastqc', 1, FASTQC_MEM_MB):
+                    returncode,fastqc_out,fastqc_err,usage = subproc.run(fastqc_cmd,name='fastqc',metrics=metrics)
+                if returncode!=0:
                     logging.info("FASTQC failed for: " + file)
                 else:
                     logging.info("FASTQC complete successfully for: " + file)
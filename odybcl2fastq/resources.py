@@ -0,0 +1,81 @@
+'''
+size bcl2fastq thread counts from the cpus and memory of the node, shared
+between the runs demultiplexing on it at the same time
+'''
+import os
+import logging
+import multiprocessing
+
+MEMINFO = '/proc/meminfo'
+# rough bcl2fastq resident memory per processing thread
+MEM_PER_THREAD_MB = int(os.getenv('ODYBCL2FASTQ_BCL_MEM_PER_THREAD_MB', 1024))
+MAX_LOADING_THREADS = 4
+MAX_WRITING_THREADS = 8
+
+def cpu_count():
+    # cpus this process may run on, respects taskset and cgroups cpusets
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+def read_meminfo():
+    # /proc/meminfo in bytes
+    meminfo = {}
+    try:
+        with open(MEMINFO, 'r') as fh:
+            for line in fh:
+                parts = line.split()
+                meminfo[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return meminfo
+
+def mem_total():
+    meminfo = read_meminfo()
+    if 'MemTotal' in meminfo:
+        return meminfo['MemTotal']
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def mem_available():
+    # bytes of memory available for new processes without swapping
+    meminfo = read_meminfo()
+    if not meminfo:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    return meminfo.get('MemFree', 0) + meminfo.get('Cached', 0)
+
+def active_runs():
+    # process_runs tells each run how many runs it launched alongside it
+    for env in ['ODYBCL2FASTQ_ACTIVE_RUNS', 'ODYBCL2FASTQ_PROC_NUM']:
+        if os.getenv(env):
+            return max(1, int(os.getenv(env)))
+    return 1
+
+def auto_bcl2fastq_threads(lanes, samples, concurrent=None, cpus=None, mem_bytes=None, starting=1):
+    '''
+    return dict of loading, processing and writing threads for one
+    bcl2fastq job given the number of jobs sharing the node, starting of
+    them sized together and not yet running
+    '''
+    if concurrent is None:
+        concurrent = active_runs()
+    if cpus is None:
+        cpus = cpu_count()
+    if mem_bytes is None:
+        mem_bytes = mem_available()
+    share = max(1, cpus // max(1, concurrent))
+    # processing threads are capped by the memory share of this job, memory
+    # available already leaves out what running jobs hold
+    mem_threads = max(1, (mem_bytes // max(1, starting)) // (MEM_PER_THREAD_MB * 2**20))
+    threads = {
+        # bcl files are loaded per lane
+        'loading': max(1, min(MAX_LOADING_THREADS, share // 8, lanes)),
+        # bcl2fastq cannot use more writing threads than samples
+        'writing': max(1, min(MAX_WRITING_THREADS, share // 8, samples))
+    }
+    # loading and writing threads come out of the job's share
+    threads['processing'] = max(1, min(share - threads['loading'] - threads['writing'], mem_threads))
+    logging.info('Auto threads for %i lanes, %i samples, %i concurrent jobs on %i cpus with %i MB available: %s' %
+            (lanes, samples, concurrent, cpus, mem_bytes // 2**20, threads))
+    return threads
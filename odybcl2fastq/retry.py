@@ -0,0 +1,134 @@
+'''
+tell transient failures, like an nfs hiccup, a db timeout or an smtp outage,
+from permanent ones and retry the transient ones with exponential backoff
+
+run.py exits with EX_TEMPFAIL when it failed for a transient reason so
+process_runs can queue the run again, stages that completed are checkpointed
+so only the stage that failed runs again
+'''
+import os
+import time
+import errno
+import random
+import socket
+import smtplib
+import logging
+from odybcl2fastq import run_state
+
+# sysexits.h, temporary failure, the run can be tried again
+EX_TEMPFAIL = 75
+RETRIES = int(os.getenv('ODYBCL2FASTQ_RETRIES', 3))
+BASE_DELAY = float(os.getenv('ODYBCL2FASTQ_RETRY_DELAY', 30))
+MAX_DELAY = float(os.getenv('ODYBCL2FASTQ_RETRY_MAX_DELAY', 3600))
+RUN_RETRIES = int(os.getenv('ODYBCL2FASTQ_RUN_RETRIES', 3))
+RUN_BASE_DELAY = float(os.getenv('ODYBCL2FASTQ_RUN_RETRY_DELAY', 600))
+
+# a full disk or quota, ENOSPC and EDQUOT, is permanent so the failure email
+# goes out for an operator to free space
+TRANSIENT_ERRNOS = set(getattr(errno, name) for name in [
+    'EIO', 'EAGAIN', 'EBUSY', 'ETIMEDOUT', 'ESTALE', 'ENOLCK', 'ECONNRESET',
+    'ECONNREFUSED', 'ECONNABORTED', 'EHOSTUNREACH', 'EHOSTDOWN', 'ENETUNREACH',
+    'ENETDOWN', 'ENETRESET', 'EPIPE'] if hasattr(errno, name))
+# matched by class name so optional dependencies need not be imported,
+# requests and urllib3 connection errors and timeouts
+TRANSIENT_CLASSES = set(['ConnectionError', 'ConnectTimeout', 'ReadTimeout', 'Timeout',
+    'ChunkedEncodingError', 'ProtocolError', 'IncompleteRead', 'RemoteDisconnected',
+    'SMTPServerDisconnected', 'SMTPConnectError'])
+# MySQLdb server gone away, lost connection, can't connect, lock wait timeout, deadlock
+TRANSIENT_MYSQL_CODES = set([1205, 1213, 2002, 2003, 2006, 2013])
+
+def unwrap(error):
+    # the original exception of a pipeline StageError
+    while getattr(error, 'error', None) is not None and isinstance(error.error, BaseException):
+        error = error.error
+    return error
+
+def is_transient(error):
+    '''
+    true if error is likely to go away if the same work is tried again
+    '''
+    error = unwrap(error)
+    names = set(cls.__name__ for cls in type(error).__mro__)
+    if names & TRANSIENT_CLASSES:
+        return True
+    if isinstance(error, socket.timeout):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 4xx replies are temporary by definition
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, EnvironmentError) and error.errno in TRANSIENT_ERRNOS:
+        return True
+    if 'OperationalError' in names:
+        code = error.args[0] if error.args else None
+        if code in TRANSIENT_MYSQL_CODES:
+            return True
+        # sqlite
+        return 'locked' in str(error)
+    return False
+
+def backoff(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    # seconds to wait before the attempt after attempt, jittered so retries
+    # of many jobs do not line up
+    delay = min(cap, base * 2 ** attempt)
+    return delay * (0.5 + random.random() / 2)
+
+def call(func, args=(), retries=RETRIES, base_delay=BASE_DELAY, name=None, sleep=time.sleep):
+    '''
+    call func, retrying up to retries times if it raises a transient error,
+    return its result and the number of attempts made
+    '''
+    attempt = 0
+    while True:
+        try:
+            return func(*args), attempt + 1
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = backoff(attempt, base_delay)
+            logging.warning('%s failed with a transient error, retrying in %.0fs: %s\n' %
+                    (name or getattr(func, '__name__', 'call'), delay, e))
+            sleep(delay)
+            attempt += 1
+
+class RetryQueue(object):
+    '''
+    runs waiting to be tried again after a transient failure, kept in the
+    run state db so a restarted daemon or a worker on another host picks
+    them up
+    '''
+
+    def __init__(self, retries=RUN_RETRIES, base_delay=RUN_BASE_DELAY, db=None,
+            pipeline='odybcl2fastq'):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.db = db
+        self.pipeline = pipeline
+
+    def get_db(self):
+        return self.db or run_state.get_db()
+
+    def add(self, run_dir, now=None):
+        '''
+        queue run_dir again, false if it has used up its retries
+        '''
+        attempt = self.get_db().retry_attempts(run_dir, self.pipeline)
+        if attempt >= self.retries:
+            self.forget(run_dir)
+            return False
+        delay = backoff(attempt, self.base_delay, MAX_DELAY)
+        self.get_db().set_retry(run_dir, self.pipeline, attempt + 1, (now or time.time()) + delay)
+        logging.info('Retrying %s in %.0fs, attempt %i of %i\n' % (run_dir, delay,
+            attempt + 1, self.retries))
+        return True
+
+    def due(self, now=None):
+        return self.get_db().due_retries(self.pipeline, now or time.time())
+
+    def started(self, run_dir):
+        # no longer due, the attempts are kept until the run finishes
+        attempts = self.get_db().retry_attempts(run_dir, self.pipeline)
+        if attempts:
+            self.get_db().set_retry(run_dir, self.pipeline, attempts, None)
+
+    def forget(self, run_dir):
+        self.get_db().clear_retry(run_dir, self.pipeline)
@@ -13,22 +13,35 @@ Created on  2017-04-19
 @copyright: 2017 The Presidents and Fellows of Harvard College. All rights reserved.
 @license: GPL v2.0
 '''
-import sys, os, traceback, stat
+import sys, os, traceback, stat, copy
+import multiprocessing
 import logging
 import json
-from glob import glob
-import hashlib
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import odybcl2fastq.util as util
+from odybcl2fastq import transfer
+from odybcl2fastq import subproc
+from odybcl2fastq import resources
+from odybcl2fastq import broker
+from odybcl2fastq import run_state
+from odybcl2fastq import retry
+from odybcl2fastq import run_history
 from odybcl2fastq import constants as const
 from odybcl2fastq import config
 from odybcl2fastq.parsers.makebasemask import extract_basemasks
 from odybcl2fastq.emailbuilder.emailbuilder import buildmessage
 from odybcl2fastq.parsers import parse_stats
-from subprocess import Popen, PIPE, STDOUT
+from odybcl2fastq.parsers.parse_runinfoxml import get_flowcell_layout
+from odybcl2fastq.parsers.parse_bcl2fastq_log import Bcl2fastqProgress
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 from odybcl2fastq.status_db import StatusDB
+from odybcl2fastq.pipeline import Pipeline
+from odybcl2fastq import checkpoint
+from odybcl2fastq.checkpoint import Checkpoints
+from odybcl2fastq.metrics import RunMetrics, get_metrics_path, report_written
 from odybcl2fastq.parsers.samplesheet import SampleSheet
 from odybcl2fastq.qc.fastqc_runner import fastqc_runner
 from tests.compare_fastq import compare_fastq
@@ -41,6 +54,10 @@ SUMMARY_LOG_FILE = const.ROOT_DIR + 'odybcl2fastq.log'
 MASK_SHORT_ADAPTER_READS = 22
 STORAGE_CAPACITY_WARN = 0.96
 STORAGE_CAPACITY_ERROR = 0.99
+# thread counts are sized to the node when a run starts and do not change
+# the output, so they are left out of the demux checkpoint
+THREAD_SWITCHES = ['-p', '--processing-threads', '-r', '--loading-threads',
+        '-w', '--writing-threads']
 
 
 def initArgs():
@@ -79,6 +96,13 @@ def initArgs():
             'help'      : 'run without copying files to final',
             'action'    : 'store_true',
         },
+        {
+            'name'      : 'IGNORE_CHECKPOINTS',
+            'switches'  : ['--ignore-checkpoints'],
+            'required'  : False,
+            'help'      : 'rerun every stage even if it completed in a previous run',
+            'action'    : 'store_true',
+        },
         {
             'name'      : 'BCL_MIN_LOG_LEVEL',
             'switches'  : ['--min-log-level'],
@@ -95,6 +119,44 @@ def initArgs():
             'default'   : 8,
             'type'      : int,
         },
+        {
+            'name'      : 'BCL_LOADING_THREADS',
+            'switches'  : ['-r','--loading-threads'],
+            'required'  : False,
+            'help'      : 'number threads used for loading BCL data',
+            'default'   : False,
+            'type'      : int,
+        },
+        {
+            'name'      : 'BCL_WRITING_THREADS',
+            'switches'  : ['-w','--writing-threads'],
+            'required'  : False,
+            'help'      : 'number threads used for writing FASTQ data',
+            'default'   : False,
+            'type'      : int,
+        },
+        {
+            'name'      : 'CONCURRENT_MASKS',
+            'switches'  : ['--concurrent-masks'],
+            'required'  : False,
+            'help'      : 'run the bcl2fastq jobs for runs with more than one mask concurrently',
+            'action'    : 'store_true',
+        },
+        {
+            'name'      : 'AUTO_THREADS',
+            'switches'  : ['--auto-threads'],
+            'required'  : False,
+            'help'      : 'size bcl2fastq threads from the cpus and memory of the node and the number of active runs',
+            'action'    : 'store_true',
+        },
+        {
+            'name'      : 'CPU_BUDGET',
+            'switches'  : ['--cpu-budget'],
+            'required'  : False,
+            'help'      : 'cpus shared by concurrent bcl2fastq jobs',
+            'default'   : multiprocessing.cpu_count(),
+            'type'      : int,
+        },
         {
             'name'      : 'BCL_ADAPTER_STRINGENCY',
             'switches'  : ['--adapter-stringency'],
@@ -332,22 +394,14 @@ def copy_source_to_output(src_root, dest_root, sample_sheet, instrument):
 def copy_output_to_final(output_dir, run_folder, output_log):
     # determine dest_dir
     dest_dir = config.FINAL_DIR + run_folder
-    # check size of output_dir
-    cmd = 'du -s %s' % output_dir
-    code, out, err = run_cmd(cmd)
-
-    if code != 0:
-        raise Exception('Could not check size of output_dir, files not copied to %s: %s' % (config.FINAL_DIR, cmd))
-    output_space = int(out.split()[0])
-
-    # check capacity of final dir
-    cmd = 'df -P %s | grep  -v Filesystem' % config.FINAL_DIR
-    code, out, err = run_cmd(cmd)
-    if code != 0:
-        raise Exception('Could not check capacity of %s, files not copied %s: %s' % (config.FINAL_DIR, output_dir, cmd))
-    dest_space = out.split()
-    tot_space = int(dest_space[1])
-    used = int(dest_space[2])
+    # size of output_dir is totalled while cataloguing files to deliver
+    catalogued = transfer.catalogue(output_dir, transfer.DELIVER_IGNORE)
+    output_space = transfer.tree_size(catalogued[1]) // 1024
+    # check capacity of final dir, in KB as reported by df
+    try:
+        tot_space, used, free = [b // 1024 for b in util.disk_usage(config.FINAL_DIR)]
+    except OSError as e:
+        raise Exception('Could not check capacity of %s, files not copied %s: %s' % (config.FINAL_DIR, output_dir, e))
     capacity = (used + output_space) / float(tot_space)
     storage_capacity_warn = float(os.getenv('ODY_STORAGE_CAPACITY_WARN', STORAGE_CAPACITY_WARN))
     storage_capacity_error = float(os.getenv('ODY_STORAGE_CAPACITY_ERROR', STORAGE_CAPACITY_ERROR))
@@ -360,30 +414,10 @@ def copy_output_to_final(output_dir, run_folder, output_log):
         raise Exception(msg)
     logging.info('Copying %s: %s, to %s at capacity: %s' % (output_dir, output_space,
         dest_dir, capacity))
-    util.copy(output_dir, dest_dir)
-    # change permissions on dest_dir
-    util.chmod_rec(dest_dir, FINAL_DIR_PERMISSIONS, FINAL_FILE_PERMISSIONS)
-
-def fastq_checksum(output_dir):
-    checksum_report = output_dir + '/md5sum.txt'
-    with open(checksum_report, 'a') as checksum_fh:
-        checksum_fh.truncate(0)
-        sample_proj_path = '%s/*/*.fastq.gz' % output_dir
-        file_path = '%s/*.fastq.gz' % output_dir
-        file_lst = glob(sample_proj_path)
-        file_lst.extend(glob(file_path))
-        for f in file_lst:
-            with open(f, 'rb') as fh:
-                # put relative path in the checksum file so it can be run from
-                # the root even if the user copies the data somewhere else
-                checksum = hashlib.md5()
-                while True:
-                    data = fh.read(2**20)
-                    if not data:
-                        break
-                    checksum.update(data)
-                checksum = checksum.hexdigest() + '  ' +  f.replace(output_dir + '/', '') + '\n'
-                checksum_fh.write(checksum)
+    # only files that are missing or changed in dest_dir are copied, fastq
+    # are checksummed and permissions set in the same pass
+    return transfer.deliver_tree(output_dir, dest_dir, FINAL_FILE_PERMISSIONS,
+            FINAL_DIR_PERMISSIONS, catalogued=catalogued)
 
 def run_cmd(cmd):
     # run unix cmd, return out and error
@@ -391,31 +425,51 @@ def run_cmd(cmd):
     out, err = proc.communicate()
     return (proc.returncode, out, err)
 
-def run_bcl2fastq_cmd(cmd, output_log):
-    # run unix cmd, stream out and error, return last lines of out
-    with open(output_log, 'a+') as writer:
-        with open(output_log, 'r') as reader:
-            proc = Popen(cmd, shell=True, stderr=STDOUT, stdout=writer)
-            lines = []
-            # stream output to log, std out
-            while proc.poll() is None:
-                line = reader.readline()
-                # save last 40 lines for email
-                if line:
-                    lines.append(line)
-                    if len(lines) > 40:
-                        lines.pop(0)
-                sys.stdout.write(line)
-            # write any remaining output
-            try:
-                line = reader.readline()
-                lines.append(line)
-                sys.stdout.write(line)
-            except Exception:
-                pass
-            code = proc.wait()
+def run_bcl2fastq_cmd(cmd, output_log, progress_callbacks=None, metrics=None):
+    # run unix cmd, stream out and error to the log, return last lines of out
+    progress = Bcl2fastqProgress()
+    # save last 40 lines for email
+    lines = deque(maxlen=40)
+    with open(output_log, 'a') as writer:
+        def tee(line):
+            writer.write(line)
+            writer.flush()
+            sys.stdout.write(line)
+            lines.append(line)
+            event = progress.parse(line)
+            if event:
+                for callback in (progress_callbacks or []):
+                    callback(event)
+        # lines are read from a pipe as the child writes them, no polling
+        code, out, err, usage = subproc.run(cmd, stderr_to_stdout=True,
+                line_callback=tee, name='bcl2fastq', metrics=metrics)
     return code, ''.join(lines)
 
+class ProgressLogger(object):
+    '''
+    subscriber for bcl2fastq progress events, logs each stage every step of
+    the flowcell
+    '''
+
+    def __init__(self, runinfo_xml=None, step=0.1):
+        self.step = step
+        self.next = {}
+        self.total_tiles = None
+        if runinfo_xml and os.path.exists(runinfo_xml):
+            self.total_tiles = get_flowcell_layout(runinfo_xml)['Tiles']
+
+    def __call__(self, event):
+        if event['stage'] == 'complete':
+            logging.info('bcl2fastq %s\n' % event['message'])
+            return
+        if not self.total_tiles:
+            return
+        fraction = min(1.0, event['tiles_done'] / float(self.total_tiles))
+        if fraction >= self.next.get(event['stage'], self.step):
+            logging.info('bcl2fastq %s %i%% (%i of %i tiles)\n' % (event['stage'],
+                int(fraction * 100), event['tiles_done'], self.total_tiles))
+            self.next[event['stage']] = fraction + self.step
+
 def bcl2fastq_build_cmd(args, switches_to_names, mask_list, instrument, run_type, sample_sheet):
     argdict = vars(args)
     cmdstrings=['bcl2fastq']
@@ -465,7 +519,15 @@ def get_params_from_sample_sheet(sample_sheet, bcl_params):
 def shortest_read(r):
     return int(r[min(r.keys(), key=(lambda k:int(r[k])))])
 
-def bcl2fastq_runner(cmd, output_log, args, no_demultiplex = False):
+def bcl2fastq_threads(args):
+    # every thread the job will run, loading and writing only when set
+    threads = int(args.BCL_PROC_THREADS)
+    for name in ('BCL_LOADING_THREADS', 'BCL_WRITING_THREADS'):
+        if getattr(args, name, None):
+            threads += int(getattr(args, name))
+    return threads
+
+def bcl2fastq_runner(cmd, output_log, args, no_demultiplex = False, progress_callbacks = None, metrics = None):
     logging.info("***** START bcl2fastq *****\n\n")
     run = os.path.basename(args.BCL_RUNFOLDER_DIR)
     last_output = ''
@@ -473,7 +535,10 @@ def bcl2fastq_runner(cmd, output_log, args, no_demultiplex = False):
         message = 'run %s completed successfully\nsee logs here: %s\n' % (run, output_log)
         success = True
     else:
-        code, last_output = run_bcl2fastq_cmd(cmd, output_log)
+        # wait for the node to have the cpus and memory for this job
+        cpus = bcl2fastq_threads(args)
+        with broker.lease('bcl2fastq', cpus, cpus * resources.MEM_PER_THREAD_MB):
+            code, last_output = run_bcl2fastq_cmd(cmd, output_log, progress_callbacks, metrics)
         logging.info("***** END bcl2fastq *****\n\n")
         if code!=0:
             message = 'run %s failed\n see logs here: %s\n' % (run, output_log)
@@ -493,6 +558,22 @@ def check_sample_sheet(sample_sheet, run):
         if os.path.exists(path):
             util.copy(path, sample_sheet)
 
+def strip_thread_switches(cmd):
+    # the bcl2fastq cmd without its thread counts
+    words = cmd.split(' ')
+    kept = []
+    i = 0
+    while i < len(words):
+        if words[i] in THREAD_SWITCHES:
+            i += 2
+            continue
+        kept.append(words[i])
+        i += 1
+    return ' '.join(kept)
+
+def demux_fingerprint(cmd, sample_sheet_fp):
+    return checkpoint.fingerprint(strip_thread_switches(cmd), sample_sheet_fp)
+
 def write_cmd(cmd, output_dir, run):
     path = '%s/%s.opts' % (output_dir, run)
     with open(path, 'w') as fout:
@@ -500,11 +581,13 @@ def write_cmd(cmd, output_dir, run):
 
 def bcl2fastq_process_runs():
     args, switches_to_names = initArgs()
-    util.touch(args.BCL_RUNFOLDER_DIR + '/', PROCESSED_FILE)
+    run_state.mark(args.BCL_RUNFOLDER_DIR + '/', PROCESSED_FILE)
     test = ('TEST' in args and args.TEST)
     no_demultiplex = ('NO_DEMULTIPLEX' in args and args.NO_DEMULTIPLEX)
     no_post_process = ('NO_POST_PROCESS' in args and args.NO_POST_PROCESS)
     no_file_copy = ('NO_FILE_COPY' in args and args.NO_FILE_COPY)
+    ignore_checkpoints = ('IGNORE_CHECKPOINTS' in args and args.IGNORE_CHECKPOINTS)
+    auto_threads = ('AUTO_THREADS' in args and args.AUTO_THREADS)
     run = os.path.basename(args.BCL_RUNFOLDER_DIR)
     setup_logging(run, test)
     logging.info("***** START Odybcl2fastq *****\n\n")
@@ -528,81 +611,198 @@ def bcl2fastq_process_runs():
     jobs_tot = len(mask_lists)
     if jobs_tot > 1:
         logging.info("This run contains different masks in the same lane and will require %i bcl2fastq jobs" % jobs_tot)
-    job_cnt = 1
-    sample_sheet_dir = args.BCL_SAMPLE_SHEET
+    concurrent = jobs_tot > 1 and ('CONCURRENT_MASKS' in args and args.CONCURRENT_MASKS)
     output_dir = args.BCL_OUTPUT_DIR
+    jobs = []
     # run bcl2fatq per indexing strategy on run
-    for mask, mask_list in mask_lists.items():
-        output_suffix = None
+    for job_cnt, (mask, mask_list) in enumerate(mask_lists.items(), 1):
+        job_args = copy.copy(args)
+        job_sample_sheet = sample_sheet
         # if more than one bcl2fastq cmd needed suffix output dir and sample sheet
         if jobs_tot > 1:
             output_suffix = mask.replace(',', '_')
-            args.BCL_OUTPUT_DIR = output_dir + '-' + output_suffix
-            args.BCL_SAMPLE_SHEET = sample_sheet.write_new_sample_sheet(mask_samples[mask], output_suffix)
-            sample_sheet = SampleSheet(args.BCL_SAMPLE_SHEET)
-        cmd = bcl2fastq_build_cmd(args,
-                switches_to_names, mask_list, instrument, run_type, sample_sheet.sections)
-        logging.info("\nJob %i of %i:" % (job_cnt, jobs_tot))
-        if test:
-            logging.info("Test run, command not run: %s" % cmd)
-            success = True
-            message = 'TEST'
-        else:
-            logging.info('Launching bcl2fastq...%s\n' % cmd)
-            output_log = get_output_log(run)
-            success, message = bcl2fastq_runner(cmd, output_log, args, no_demultiplex)
-            summary_data = {}
-            # run folder will contain any suffix that was applied
-            run_folder = args.BCL_OUTPUT_DIR.split('/').pop()
-            if success:
-                if not no_post_process:
-                    # write bcl2fastq cmd
-                    write_cmd(cmd, args.BCL_OUTPUT_DIR, run)
-                    # update lims db
-                    update_lims_db(run_folder, sample_sheet.sections, instrument)
-                    # run  qc, TODO: consider a seperate job for this
-                    error_files, fastqc_err, fastqc_out = fastqc_runner(args.BCL_OUTPUT_DIR)
-                    with open(output_log, 'a+') as f:
-                        f.write('\n'.join(fastqc_out) + "\n\n")
-                        f.write('\n'.join(fastqc_err) + "\n\n")
-                    # copy run files to final
-                if not no_file_copy:
-                    copy_source_to_output(args.BCL_RUNFOLDER_DIR,
-                            args.BCL_OUTPUT_DIR, args.BCL_SAMPLE_SHEET,
-                            instrument)
-                    fastq_checksum(args.BCL_OUTPUT_DIR)
-                    # copy output to final dest where users will access
-                    copy_output_to_final(args.BCL_OUTPUT_DIR, run_folder, output_log)
-                # get data from run to put in the email
-                summary_data = parse_stats.get_summary(args.BCL_OUTPUT_DIR, instrument, args.BCL_SAMPLE_SHEET, run_folder)
-                summary_data['run'] = run
-                summary_data['run_folder'] = run_folder
-                summary_data['cmd'] = cmd
-                summary_data['version'] = 'bcl2fastq2 v2.2'
-                subject = 'Demultiplex Summary for ' + run_folder
-            else:
-                subject = 'Run Failed: ' + run_folder
-            toemaillist = config.EMAIL['to_email']
-            fromaddr = config.EMAIL['from_email']
-            logging.info('Sending email summary to %s\n' % json.dumps(toemaillist))
-            sent = buildmessage(message, subject, summary_data, fromaddr, toemaillist)
-            logging.info('Email sent: %s\n' % str(sent))
-            # add a file to show that this output folder is completed, safe to
-            # centrifuge
-            util.touch(args.BCL_OUTPUT_DIR + '/', COMPLETE_FILE)
-        job_cnt += 1
+            job_args.BCL_OUTPUT_DIR = output_dir + '-' + output_suffix
+            job_args.BCL_SAMPLE_SHEET = sample_sheet.write_new_sample_sheet(mask_samples[mask], output_suffix)
+            job_sample_sheet = SampleSheet(job_args.BCL_SAMPLE_SHEET)
+        if auto_threads:
+            set_auto_threads(job_args, job_sample_sheet, (jobs_tot if concurrent else 1))
+        elif concurrent:
+            split_threads(job_args, jobs_tot)
+        cmd = bcl2fastq_build_cmd(job_args,
+                switches_to_names, mask_list, instrument, run_type, job_sample_sheet.sections)
+        jobs.append({
+            'job_cnt': job_cnt,
+            'jobs_tot': jobs_tot,
+            'args': job_args,
+            'cmd': cmd,
+            'run': run,
+            'sample_sheet': job_sample_sheet,
+            'instrument': instrument,
+            'test': test,
+            'no_demultiplex': no_demultiplex,
+            'no_post_process': no_post_process,
+            'no_file_copy': no_file_copy,
+            'ignore_checkpoints': ignore_checkpoints
+        })
+    if concurrent:
+        # each mask job has its own output dir and sample sheet so they can
+        # run side by side, each post processes as soon as it is done
+        logging.info("Running %i bcl2fastq jobs concurrently within %i cpus\n" % (jobs_tot, args.CPU_BUDGET))
+        pool = ThreadPool(jobs_tot)
+        try:
+            results = pool.map(run_mask_job, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_mask_job(job) for job in jobs]
+    success = all(results)
     if success:
         ret_code = 0
         status = 'success'
-        util.touch(args.BCL_RUNFOLDER_DIR + '/', COMPLETE_FILE)
+        run_state.mark(args.BCL_RUNFOLDER_DIR + '/', COMPLETE_FILE)
     else:
         # pass a special ret_code to avoid double email on error
         ret_code = 9
         status = 'failure'
     get_summary_logger().info("Odybcl2fastq for %s returned %s\n" % (run, status))
+    run_history.record(run, status)
     logging.info("***** END Odybcl2fastq *****\n\n")
     return ret_code
 
+def split_threads(args, jobs_tot):
+    # share the cpu budget between concurrent bcl2fastq jobs, the loading
+    # and writing threads come out of each job's share
+    cpus = max(1, int(args.CPU_BUDGET) // jobs_tot)
+    args.BCL_LOADING_THREADS = max(1, min(4, cpus // 4))
+    args.BCL_WRITING_THREADS = max(1, min(4, cpus // 4))
+    args.BCL_PROC_THREADS = max(1, cpus - args.BCL_LOADING_THREADS - args.BCL_WRITING_THREADS)
+
+def set_auto_threads(args, sample_sheet, jobs):
+    # share the node between these jobs and the other runs that are active
+    lanes = get_flowcell_layout(args.RUNINFO_XML)['LaneCount']
+    samples = len(sample_sheet.sections['Data'])
+    cpus = min(int(args.CPU_BUDGET), resources.cpu_count())
+    active = max(resources.active_runs(), broker.active_runs('bcl2fastq'))
+    threads = resources.auto_bcl2fastq_threads(lanes, samples, active * jobs, cpus, starting=jobs)
+    args.BCL_PROC_THREADS = threads['processing']
+    args.BCL_LOADING_THREADS = threads['loading']
+    args.BCL_WRITING_THREADS = threads['writing']
+
+def run_fastqc(output_dir, output_log, metrics=None):
+    error_files, fastqc_err, fastqc_out = fastqc_runner(output_dir, metrics=metrics)
+    with open(output_log, 'a+') as f:
+        f.write('\n'.join(fastqc_out) + "\n\n")
+        f.write('\n'.join(fastqc_err) + "\n\n")
+    return {'files': len(fastqc_out)}
+
+def run_mask_job(job):
+    # demultiplex and post process output of one mask, return success
+    args = job['args']
+    cmd = job['cmd']
+    run = job['run']
+    logging.info("\nJob %i of %i:" % (job['job_cnt'], job['jobs_tot']))
+    if job['test']:
+        logging.info("Test run, command not run: %s" % cmd)
+        return True
+    output_log = get_output_log(run)
+    # stages completed by an earlier attempt with the same inputs are skipped
+    checkpoints = Checkpoints(args.BCL_OUTPUT_DIR, not job['ignore_checkpoints'])
+    sample_sheet_fp = checkpoint.file_fingerprint(args.BCL_SAMPLE_SHEET)
+    demux_fp = demux_fingerprint(cmd, sample_sheet_fp)
+    no_demultiplex = job['no_demultiplex']
+    if not no_demultiplex and checkpoints.is_done('demux', demux_fp):
+        logging.info('bcl2fastq already completed with this cmd and sample sheet, skipping demultiplexing\n')
+        no_demultiplex = True
+    else:
+        logging.info('Launching bcl2fastq...%s\n' % cmd)
+    # run folder will contain any suffix that was applied
+    run_folder = args.BCL_OUTPUT_DIR.split('/').pop()
+    metrics = RunMetrics(run_folder, get_metrics_path(args.BCL_OUTPUT_DIR, run))
+    try:
+        return process_mask_job(job, checkpoints, metrics, output_log, run_folder,
+                no_demultiplex, demux_fp, sample_sheet_fp)
+    finally:
+        path = metrics.write()
+        logging.info('Writing run metrics to %s\n' % path)
+        report_written(path, sys.stdout)
+
+def process_mask_job(job, checkpoints, metrics, output_log, run_folder,
+        no_demultiplex, demux_fp, sample_sheet_fp):
+    args = job['args']
+    cmd = job['cmd']
+    run = job['run']
+    sample_sheet = job['sample_sheet']
+    instrument = job['instrument']
+    progress_callbacks = [ProgressLogger(args.RUNINFO_XML)]
+    if no_demultiplex:
+        metrics.skip('demux')
+        success, message = bcl2fastq_runner(cmd, output_log, args,
+                no_demultiplex, progress_callbacks)
+    else:
+        with metrics.stage('demux') as record:
+            success, message = bcl2fastq_runner(cmd, output_log, args,
+                    no_demultiplex, progress_callbacks, metrics)
+            if not success:
+                record['status'] = 'failed'
+    if success and not no_demultiplex:
+        checkpoints.mark('demux', demux_fp)
+    demux = checkpoints.token('demux')
+    summary_data = {}
+    if success:
+        post_process = Pipeline(run_folder, checkpoints=checkpoints, metrics=metrics)
+        if not job['no_post_process']:
+            # write bcl2fastq cmd
+            post_process.add('write_cmd', write_cmd, (cmd, args.BCL_OUTPUT_DIR, run),
+                    inputs=[demux, strip_thread_switches(cmd)])
+            # update lims db
+            post_process.add('update_lims_db', update_lims_db, (run_folder,
+                sample_sheet.sections, instrument), inputs=[demux, sample_sheet_fp])
+            # run  qc
+            post_process.add('fastqc', run_fastqc, (args.BCL_OUTPUT_DIR, output_log,
+                metrics), inputs=[demux])
+        if not job['no_file_copy']:
+            # copy run files to final
+            post_process.add('copy_source_to_output', copy_source_to_output,
+                    (args.BCL_RUNFOLDER_DIR, args.BCL_OUTPUT_DIR,
+                        args.BCL_SAMPLE_SHEET, instrument),
+                    inputs=[demux, sample_sheet_fp])
+            # checksum and copy output to final dest where users will access,
+            # waits for every stage that writes to the output dir
+            post_process.add('copy_output_to_final', copy_output_to_final,
+                    (args.BCL_OUTPUT_DIR, run_folder, output_log),
+                    deps=['write_cmd', 'fastqc', 'copy_source_to_output'],
+                    inputs=[demux, config.FINAL_DIR])
+        # get data from run to put in the email
+        post_process.add('summary', parse_stats.get_summary,
+                (args.BCL_OUTPUT_DIR, instrument, args.BCL_SAMPLE_SHEET, run_folder))
+        summary_data = post_process.run()['summary']
+        summary_data['run'] = run
+        summary_data['run_folder'] = run_folder
+        summary_data['cmd'] = cmd
+        summary_data['version'] = 'bcl2fastq2 v2.2'
+        subject = 'Demultiplex Summary for ' + run_folder
+    else:
+        subject = 'Run Failed: ' + run_folder
+    email_fp = checkpoint.fingerprint(demux, subject)
+    if success and checkpoints.is_done('email', email_fp):
+        logging.info('Summary email already sent for %s\n' % run_folder)
+        metrics.skip('email')
+    else:
+        with metrics.stage('email'):
+            toemaillist = config.EMAIL['to_email']
+            fromaddr = config.EMAIL['from_email']
+            logging.info('Sending email summary to %s\n' % json.dumps(toemaillist))
+            sent, attempts = retry.call(buildmessage, (message, subject, summary_data,
+                fromaddr, toemaillist), name='email')
+            logging.info('Email sent: %s\n' % str(sent))
+        if success:
+            checkpoints.mark('email', email_fp)
+    # add a file to show that this output folder is completed, safe to
+    # centrifuge
+    run_state.mark(args.BCL_OUTPUT_DIR + '/', COMPLETE_FILE)
+    return success
+
 def get_output_log(run):
     return config.LOG_DIR + run + '.log'
 
@@ -629,4 +829,9 @@ if __name__ == "__main__":
         sys.exit(bcl2fastq_process_runs())
     except Exception as e:
         logging.exception(e)
+        if retry.is_transient(e):
+            # completed stages are checkpointed so the retry process_runs
+            # queues resumes at the stage that failed
+            logging.warning('Exiting with a transient failure, the run will be retried\n')
+            sys.exit(retry.EX_TEMPFAIL)
         raise
@@ -0,0 +1,131 @@
+'''
+history of finished runs as an append-only file of json lines, run.py
+appends a line when a run finishes and process_runs turns the newest lines
+into the odybcl2fastq_log.html status page
+
+the page keeps the byte offset it has read up to so each update only reads
+lines appended since, and rewrites the html only if there were any
+'''
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+from collections import deque
+from odybcl2fastq import constants as const
+
+HISTORY_FILE = os.getenv('ODYBCL2FASTQ_HISTORY_FILE', const.ROOT_DIR + 'odybcl2fastq.history.jsonl')
+MAX_LINES = 100
+# summary lines run.py writes to odybcl2fastq.log
+SUMMARY_RE = re.compile(r'^(?P<time>\S+ \S+) \S+ Odybcl2fastq for (?P<run>\S+) returned (?P<status>\S+)')
+
+def format_line(when, run, status):
+    # same form as the summary line in odybcl2fastq.log
+    asctime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+    return '%s,%03d run.py Odybcl2fastq for %s returned %s\n' % (asctime, int(when % 1 * 1000), run, status)
+
+def parse_asctime(asctime):
+    # seconds since the epoch of a log timestamp, the inverse of format_line
+    stamp, sep, millis = asctime.partition(',')
+    when = time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S'))
+    return when + (int(millis) / 1000.0 if millis else 0)
+
+def record(run, status, path=HISTORY_FILE, when=None):
+    '''
+    append a finished run, a single write to a file opened for append so
+    several run.py can add lines at once
+    '''
+    when = when or time.time()
+    line = json.dumps({'time': when, 'run': run, 'status': status,
+        'line': format_line(when, run, status)}) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def import_summary_log(log_file, path=HISTORY_FILE, lines=80000):
+    '''
+    start the history with the summary lines already in the log, once, so
+    the status page keeps showing runs finished before the history existed
+    '''
+    proc = subprocess.Popen(['tail', '-n', str(lines), log_file], stdout=subprocess.PIPE)
+    out, err = proc.communicate()
+    entries = []
+    for line in out.decode('utf-8', 'replace').splitlines(True):
+        match = SUMMARY_RE.match(line)
+        if match:
+            try:
+                when = parse_asctime(match.group('time'))
+            except ValueError as e:
+                logging.warning('Skipping summary line with bad time in %s: %s\n' % (log_file, e))
+                continue
+            entries.append(json.dumps({'time': when, 'run': match.group('run'),
+                'status': match.group('status'), 'line': line}) + '\n')
+    with open(path + '.tmp', 'w') as fh:
+        fh.writelines(entries)
+    os.rename(path + '.tmp', path)
+    logging.info('Imported %i finished runs from %s into %s\n' % (len(entries), log_file, path))
+
+class StatusPage(object):
+
+    def __init__(self, html_path, path=HISTORY_FILE, max_lines=MAX_LINES):
+        self.html_path = html_path
+        self.path = path
+        self.lines = deque(maxlen=max_lines)
+        self.offset = 0
+        self.inode = None
+        self.written = False
+
+    def read_new(self):
+        '''
+        add lines appended since the last read, return how many, a history
+        that was replaced or truncated is read again from the start
+        '''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return 0
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.inode = st.st_ino
+            self.offset = 0
+            self.lines.clear()
+        if st.st_size == self.offset:
+            return 0
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            data = fh.read(st.st_size - self.offset)
+        # a line still being written is left for the next read
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        added = 0
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            try:
+                self.lines.append(json.loads(line)['line'])
+            except (ValueError, KeyError) as e:
+                logging.warning('Skipping bad line in %s: %s\n' % (self.path, e))
+                continue
+            added += 1
+        return added
+
+    def write(self):
+        # newest first, replaced in one rename so readers never see it half
+        # written
+        tmp = self.html_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('<pre>')
+            f.writelines(reversed(self.lines))
+            f.write('</pre>')
+        os.rename(tmp, self.html_path)
+        self.written = True
+
+    def update(self):
+        '''
+        rewrite the page if any run finished since the last update, return
+        true if it was rewritten
+        '''
+        if not self.read_new() and self.written:
+            return False
+        self.write()
+        return True
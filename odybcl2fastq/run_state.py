@@ -0,0 +1,216 @@
+'''
+run lifecycle indexed in a local sqlite db so the daemons can look up which
+runs are processed, complete, skipped or notified over a time window without
+listing every run dir
+
+every marker is a row in stages keyed by run dir and named like the marker
+file, <pipeline>.<stage>, exp: odybcl2fastq.processed.  the marker files stay
+the record: a row is added when its file is found and dropped once its file is
+gone, so deleting a marker by hand still forces a rerun.  the db is per host,
+sqlite locking is not safe on nfs so it must not be on the shared root
+'''
+import os
+import re
+import time
+import sqlite3
+import logging
+from contextlib import closing
+import odybcl2fastq.util as util
+
+DB_FILE = os.getenv('ODYBCL2FASTQ_RUN_STATE_DB', '/var/tmp/odybcl2fastq.runs.db')
+MARKER_RE = re.compile(r'^(odybcl2fastq|centrifuge|bauer)\.(processed|complete|skip|incomplete_notified)$')
+SCHEMA = [
+    '''create table if not exists runs (
+        run_dir text primary key,
+        run text,
+        added real
+    )''',
+    '''create table if not exists stages (
+        run_dir text,
+        pipeline text,
+        stage text,
+        time real,
+        primary key (run_dir, pipeline, stage)
+    )''',
+    'create index if not exists stages_by_state on stages (pipeline, stage, time)',
+    # runs waiting to be tried again after a transient failure, due is null
+    # while the retry is running
+    '''create table if not exists retries (
+        run_dir text,
+        pipeline text,
+        attempts integer,
+        due real,
+        primary key (run_dir, pipeline)
+    )'''
+]
+
+def normalize(run_dir):
+    # same form as the daemons use, absolute with a trailing slash
+    return os.path.normpath(os.path.abspath(run_dir)) + '/'
+
+def split_marker(marker):
+    pipeline, stage = marker.split('.', 1)
+    return pipeline, stage
+
+class RunStateDB(object):
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        with self.connect() as db:
+            for sql in SCHEMA:
+                db.execute(sql)
+
+    def connect(self):
+        '''
+        a connection per call so the db can be used from forked pool workers
+        and threads, commits when the block exits without error
+        '''
+        conn = sqlite3.connect(self.path, timeout=60)
+        return _Transaction(conn)
+
+    def _add_run(self, db, run_dir, now):
+        cur = db.execute('insert or ignore into runs (run_dir, run, added) values (?, ?, ?)',
+                (run_dir, os.path.basename(run_dir.rstrip('/')), now))
+        return cur.rowcount == 1
+
+    def mark(self, run_dir, marker, when=None):
+        # record marker for the run and touch the marker file
+        run_dir = normalize(run_dir)
+        pipeline, stage = split_marker(marker)
+        now = when or time.time()
+        with self.connect() as db:
+            self._add_run(db, run_dir, now)
+            db.execute('insert or replace into stages (run_dir, pipeline, stage, time) values (?, ?, ?, ?)',
+                    (run_dir, pipeline, stage, now))
+        util.touch(run_dir, marker)
+
+    def backfill(self, run_dir):
+        '''
+        import marker files of a run dir the db has never seen, return true
+        if the run was new
+        '''
+        run_dir = normalize(run_dir)
+        with self.connect() as db:
+            if db.execute('select 1 from runs where run_dir = ?', (run_dir,)).fetchone():
+                return False
+            markers = []
+            try:
+                names = os.listdir(run_dir)
+            except OSError:
+                names = []
+            for name in names:
+                if MARKER_RE.match(name):
+                    pipeline, stage = split_marker(name)
+                    markers.append((run_dir, pipeline, stage, os.path.getmtime(run_dir + name)))
+            self._add_run(db, run_dir, time.time())
+            db.executemany('insert or ignore into stages (run_dir, pipeline, stage, time) values (?, ?, ?, ?)',
+                    markers)
+        if markers:
+            logging.info('Imported %i markers for %s\n' % (len(markers), run_dir))
+        return True
+
+    def backfill_all(self, run_dirs):
+        with self.connect() as db:
+            known = set(row[0] for row in db.execute('select run_dir from runs'))
+        for run_dir in run_dirs:
+            if normalize(run_dir) not in known:
+                self.backfill(run_dir)
+
+    def has(self, run_dir, marker):
+        '''
+        whether the marker file exists, the row is brought in step with it:
+        added for a marker written by hand or on another host, dropped for
+        one deleted by hand or a run dir cleared out
+        '''
+        run_dir = normalize(run_dir)
+        pipeline, stage = split_marker(marker)
+        try:
+            mtime = os.path.getmtime(run_dir + marker)
+        except OSError:
+            mtime = None
+        with self.connect() as db:
+            row = db.execute('select 1 from stages where run_dir = ? and pipeline = ? and stage = ?',
+                    (run_dir, pipeline, stage)).fetchone()
+            if mtime is not None and not row:
+                db.execute('insert or ignore into stages (run_dir, pipeline, stage, time) values (?, ?, ?, ?)',
+                        (run_dir, pipeline, stage, mtime))
+            elif mtime is None and row:
+                logging.info('Marker %s gone from %s, forgetting it\n' % (marker, run_dir))
+                db.execute('delete from stages where run_dir = ? and pipeline = ? and stage = ?',
+                        (run_dir, pipeline, stage))
+        return mtime is not None
+
+    def find(self, marker, without=(), after=None, before=None, root=None):
+        '''
+        run dirs with marker but none of the markers in without, optionally
+        marked in a time window and under a root dir, oldest first, the db
+        narrows the window and the marker files of what it finds are checked
+        '''
+        pipeline, stage = split_marker(marker)
+        sql = 'select s.run_dir from stages s where s.pipeline = ? and s.stage = ?'
+        params = [pipeline, stage]
+        if after is not None:
+            sql += ' and s.time >= ?'
+            params.append(after)
+        if before is not None:
+            sql += ' and s.time < ?'
+            params.append(before)
+        sql += ' order by s.time'
+        with self.connect() as db:
+            run_dirs = [row[0] for row in db.execute(sql, params)]
+        if root:
+            run_dirs = [d for d in run_dirs if d.startswith(normalize(root))]
+        return [d for d in run_dirs if self.has(d, marker)
+                and not any(self.has(d, other) for other in without)]
+
+    def retry_attempts(self, run_dir, pipeline):
+        with self.connect() as db:
+            row = db.execute('select attempts from retries where run_dir = ? and pipeline = ?',
+                    (normalize(run_dir), pipeline)).fetchone()
+        return row[0] if row else 0
+
+    def set_retry(self, run_dir, pipeline, attempts, due):
+        with self.connect() as db:
+            db.execute('insert or replace into retries (run_dir, pipeline, attempts, due) values (?, ?, ?, ?)',
+                    (normalize(run_dir), pipeline, attempts, due))
+
+    def clear_retry(self, run_dir, pipeline):
+        with self.connect() as db:
+            db.execute('delete from retries where run_dir = ? and pipeline = ?',
+                    (normalize(run_dir), pipeline))
+
+    def due_retries(self, pipeline, now):
+        # run dirs whose retry is due, soonest due first
+        with self.connect() as db:
+            return [row[0] for row in db.execute('select run_dir from retries where pipeline = ?'
+                ' and due <= ? order by due', (pipeline, now))]
+
+class _Transaction(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        with closing(self.conn):
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        return False
+
+_db = None
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = RunStateDB()
+    return _db
+
+def mark(run_dir, marker):
+    get_db().mark(run_dir, marker)
+
+def has(run_dir, marker):
+    return get_db().has(run_dir, marker)
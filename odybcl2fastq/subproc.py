@@ -0,0 +1,142 @@
+'''
+run external tools and account for what they cost, cpu and peak memory come
+from wait4 rusage, which includes any children the tool waited on, io and
+memory high water marks are sampled from /proc while the tool runs
+'''
+import os
+import time
+import errno
+import logging
+import threading
+from collections import OrderedDict
+from subprocess import Popen, PIPE, STDOUT
+
+SAMPLE_INTERVAL = 5
+
+def read_proc_io(pid):
+    io = {}
+    try:
+        with open('/proc/%i/io' % pid, 'r') as fh:
+            for line in fh:
+                key, val = line.split(':')
+                io[key.strip()] = int(val)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+def read_proc_hwm(pid):
+    # peak resident set size in KB of the process itself
+    try:
+        with open('/proc/%i/status' % pid, 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class ProcSampler(threading.Thread):
+    '''
+    periodically read /proc for a running child, keeps the latest io counts
+    and the highest VmHWM seen
+    '''
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        super(ProcSampler, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.io = {}
+        self.hwm_kb = None
+
+    def sample(self):
+        io = read_proc_io(self.pid)
+        if io:
+            self.io = io
+        hwm = read_proc_hwm(self.pid)
+        if hwm is not None and hwm > (self.hwm_kb or 0):
+            self.hwm_kb = hwm
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        # called before the child is reaped so the pid cannot be reused
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+def _read_lines(fh, lines, callback=None):
+    for line in iter(fh.readline, b''):
+        if callback:
+            callback(line)
+        else:
+            lines.append(line)
+    fh.close()
+
+def wait4(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+def exit_code(status):
+    # same convention as Popen.returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run(cmd, stderr_to_stdout=False, line_callback=None, name=None,
+        metrics=None, sample_interval=SAMPLE_INTERVAL):
+    '''
+    run cmd in a shell, with line_callback each line of stdout is passed to
+    the callback rather than returned, return code, out, err and a dict of
+    resource usage which is also added to metrics if given
+    '''
+    start = time.time()
+    proc = Popen(cmd, shell=True, stdout=PIPE,
+            stderr=(STDOUT if stderr_to_stdout else PIPE))
+    sampler = ProcSampler(proc.pid, sample_interval)
+    sampler.start()
+    out = []
+    err = []
+    readers = []
+    if not stderr_to_stdout:
+        # drain stderr in the background so neither pipe fills and blocks
+        readers.append(threading.Thread(target=_read_lines, args=(proc.stderr, err)))
+        readers[-1].daemon = True
+        readers[-1].start()
+    _read_lines(proc.stdout, out, line_callback)
+    for reader in readers:
+        reader.join()
+    sampler.stop()
+    pid, status, ru = wait4(proc.pid)
+    proc.returncode = exit_code(status)
+    usage = OrderedDict([
+        ('name', name or cmd.split()[0]),
+        ('cmd', cmd),
+        ('exit_status', proc.returncode),
+        ('wall_seconds', time.time() - start),
+        ('user_seconds', ru.ru_utime),
+        ('sys_seconds', ru.ru_stime),
+        # KB on linux, the largest of the child and the children it waited on
+        ('max_rss_kb', ru.ru_maxrss),
+        ('proc_hwm_kb', sampler.hwm_kb),
+        ('block_read_bytes', ru.ru_inblock * 512),
+        ('block_write_bytes', ru.ru_oublock * 512),
+        ('bytes_read', sampler.io.get('rchar')),
+        ('bytes_written', sampler.io.get('wchar')),
+        ('disk_bytes_read', sampler.io.get('read_bytes')),
+        ('disk_bytes_written', sampler.io.get('write_bytes'))
+    ])
+    logging.info('%s exited %i: %.1fs wall, %.1fs user, %.1fs sys, %i KB max rss\n' %
+            (usage['name'], usage['exit_status'], usage['wall_seconds'],
+                usage['user_seconds'], usage['sys_seconds'], usage['max_rss_kb']))
+    if metrics is not None:
+        metrics.add_child(usage)
+    return proc.returncode, b''.join(out), b''.join(err), usage
@@ -0,0 +1,300 @@
+'''
+copy a directory tree to its final location, copying only the files that
+differ, several at a time, each written to a temp name and renamed into
+place so an interrupted copy can be resumed
+'''
+import os
+import stat
+import shutil
+import fnmatch
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+from odybcl2fastq import checksum
+from odybcl2fastq import checkpoint
+from odybcl2fastq.metrics import METRICS_SUFFIX
+
+TMP_SUFFIX = '.odytmp'
+BUFFER_SIZE = 2**23
+# bytes at the end of a partial temp file checked against the source before
+# the copy is resumed
+RESUME_CHECK = 2**20
+THREADS = int(os.getenv('ODYBCL2FASTQ_COPY_THREADS', 4))
+# mtime compares size and mtime, checksum rereads both copies
+COMPARE = os.getenv('ODYBCL2FASTQ_COPY_COMPARE', 'mtime')
+# bookkeeping files that are not delivered, names or glob patterns
+IGNORE = [checksum.CACHE_FILE, checkpoint.CHECKPOINT_FILE]
+# manifests are regenerated on delivery rather than copied, run metrics are
+# written after delivery so the output dir's copy is a previous attempt's
+DELIVER_IGNORE = IGNORE + list(checksum.MANIFEST_FILES.values()) + ['*' + METRICS_SUFFIX]
+
+def catalogue(src, ignore=IGNORE):
+    '''
+    walk src once, return list of relative dirs and dict of relative file
+    path to stat
+    '''
+    dirs = []
+    files = {}
+    for root, dir_names, file_names in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        if rel_root == '.':
+            rel_root = ''
+        for d in dir_names:
+            dirs.append(os.path.join(rel_root, d))
+        for f in file_names:
+            if f.endswith(TMP_SUFFIX) or any(fnmatch.fnmatch(f, i) for i in ignore):
+                continue
+            rel = os.path.join(rel_root, f)
+            files[rel] = os.lstat(os.path.join(root, f))
+    return dirs, files
+
+def tree_size(files):
+    # bytes allocated on disk, as du reports, for catalogued files
+    return sum(getattr(st, 'st_blocks', 0) * 512 or st.st_size for st in files.values())
+
+def tmp_path(dest_path):
+    head, tail = os.path.split(dest_path)
+    return os.path.join(head, '.' + tail + TMP_SUFFIX)
+
+def needs_copy(src_path, src_st, dest_path, compare=COMPARE):
+    # src_st is an lstat, so dest is lstat'd too, a symlink is compared by
+    # its target path since copies of links do not keep the source mtime
+    if not os.path.lexists(dest_path):
+        return True
+    dest_st = os.lstat(dest_path)
+    if stat.S_ISLNK(src_st.st_mode) or stat.S_ISLNK(dest_st.st_mode):
+        return not (stat.S_ISLNK(src_st.st_mode) and stat.S_ISLNK(dest_st.st_mode)
+                and os.readlink(src_path) == os.readlink(dest_path))
+    if dest_st.st_size != src_st.st_size:
+        return True
+    if compare == 'checksum':
+        return (checksum.hash_file(src_path, ['md5'])['md5'] !=
+                checksum.hash_file(dest_path, ['md5'])['md5'])
+    # copies keep the source mtime, compare to the second for nfs
+    return int(dest_st.st_mtime) != int(src_st.st_mtime)
+
+def resume_offset(tmp, src_path, src_st):
+    '''
+    resume a partial temp file if the source has not changed since it was
+    written and the end of the temp file matches the source
+    '''
+    if not os.path.exists(tmp):
+        return 0
+    tmp_st = os.stat(tmp)
+    if tmp_st.st_size > src_st.st_size or tmp_st.st_mtime < src_st.st_mtime:
+        return 0
+    start = max(0, tmp_st.st_size - RESUME_CHECK)
+    with open(tmp, 'rb') as tmp_fh:
+        with open(src_path, 'rb') as src_fh:
+            tmp_fh.seek(start)
+            src_fh.seek(start)
+            if tmp_fh.read() != src_fh.read(tmp_st.st_size - start):
+                logging.warning('Partial copy %s does not match %s, copying again' % (tmp, src_path))
+                return 0
+    return tmp_st.st_size
+
+def copy_file(src_path, dest_path, src_st=None, buffer_size=BUFFER_SIZE,
+        algorithms=None, file_mode=None):
+    '''
+    copy to a temp file next to dest then rename so dest is never partial,
+    hash the data as it streams if algorithms are given and set file_mode
+    on the open file, return bytes copied and dict of digests
+    '''
+    if src_st is None:
+        src_st = os.stat(src_path)
+    if os.path.islink(src_path):
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        os.symlink(os.readlink(src_path), dest_path)
+        return 0, None
+    hashers = []
+    if algorithms:
+        hashers = [(alg, hashlib.new(alg)) for alg in checksum.get_algorithms(algorithms)]
+    tmp = tmp_path(dest_path)
+    offset = resume_offset(tmp, src_path, src_st)
+    if offset:
+        logging.info('Resuming copy of %s at byte %i' % (src_path, offset))
+    copied = 0
+    with open(src_path, 'rb') as src_fh:
+        with open(tmp, 'ab' if offset else 'wb') as dest_fh:
+            # the resumed part of the file still has to be hashed
+            while hashers and src_fh.tell() < offset:
+                data = src_fh.read(min(buffer_size, offset - src_fh.tell()))
+                if not data:
+                    break
+                for alg, hasher in hashers:
+                    hasher.update(data)
+            src_fh.seek(offset)
+            while True:
+                data = src_fh.read(buffer_size)
+                if not data:
+                    break
+                dest_fh.write(data)
+                for alg, hasher in hashers:
+                    hasher.update(data)
+                copied += len(data)
+            dest_fh.flush()
+            os.fsync(dest_fh.fileno())
+            os.fchmod(dest_fh.fileno(), file_mode or stat.S_IMODE(src_st.st_mode))
+    # keep the source mtime, it is how unchanged files are recognized
+    os.utime(tmp, (src_st.st_atime, src_st.st_mtime))
+    os.rename(tmp, dest_path)
+    digests = None
+    if hashers:
+        digests = dict((alg, hasher.hexdigest()) for alg, hasher in hashers)
+    return copied, digests
+
+def _copy_worker(job):
+    src_path, dest_path, src_st = job
+    return copy_file(src_path, dest_path, src_st)[0]
+
+def remove_extra(dest, dirs, files):
+    # drop anything in dest that is no longer in src so dest mirrors src
+    removed = 0
+    for root, dir_names, file_names in os.walk(dest, topdown=False):
+        rel_root = os.path.relpath(root, dest)
+        if rel_root == '.':
+            rel_root = ''
+        for f in file_names:
+            rel = os.path.join(rel_root, f)
+            if rel not in files:
+                os.remove(os.path.join(root, f))
+                removed += 1
+        for d in dir_names:
+            rel = os.path.join(rel_root, d)
+            if rel not in dirs:
+                shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+    return removed
+
+def sync_tree(src, dest, threads=THREADS, compare=COMPARE, delete=True):
+    '''
+    make dest a copy of src, only copying files that are missing or differ,
+    return dict of counts
+    '''
+    dirs, files = catalogue(src)
+    dest_existed = os.path.exists(dest)
+    if not dest_existed:
+        os.makedirs(dest)
+    for d in sorted(dirs):
+        dest_dir = os.path.join(dest, d)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+    jobs = []
+    for rel, st in files.items():
+        src_path = os.path.join(src, rel)
+        dest_path = os.path.join(dest, rel)
+        if not dest_existed or needs_copy(src_path, st, dest_path, compare):
+            jobs.append((src_path, dest_path, st))
+    logging.info('Copying %i of %i files from %s to %s using %i threads' %
+            (len(jobs), len(files), src, dest, threads))
+    if threads > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(threads, len(jobs)))
+        try:
+            copied = pool.map(_copy_worker, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        copied = [_copy_worker(job) for job in jobs]
+    removed = 0
+    if delete and dest_existed:
+        removed = remove_extra(dest, set(dirs), files)
+    stats = {
+        'files': len(files),
+        'copied': len(jobs),
+        'skipped': len(files) - len(jobs),
+        'removed': removed,
+        'bytes': sum(copied)
+    }
+    logging.info('Successfully copied %s to %s: %s' % (src, dest, stats))
+    return stats
+
+def _deliver_worker(job):
+    rel, src_path, dest_path, src_st, copy, algorithms, cached, file_mode = job
+    digests = cached
+    copied = 0
+    if copy:
+        copied, digests = copy_file(src_path, dest_path, src_st,
+                algorithms=(algorithms if algorithms and not cached else None),
+                file_mode=file_mode)
+        digests = digests or cached
+    else:
+        if file_mode and stat.S_IMODE(os.lstat(dest_path).st_mode) != file_mode:
+            os.chmod(dest_path, file_mode)
+        if algorithms and not cached:
+            digests = checksum.hash_file(src_path, algorithms)
+    return rel, src_st, copied, digests
+
+def deliver_tree(src, dest, file_mode=None, dir_mode=None, algorithms=None,
+        threads=THREADS, compare=COMPARE, delete=True, catalogued=None):
+    '''
+    copy src to dest in one pass over the data: fastq are hashed as they
+    stream to dest, permissions are set on each file as it is written and
+    checksum manifests are written to both src and dest, catalogued can
+    pass in the result of catalogue(src, DELIVER_IGNORE) to save a walk,
+    return dict of counts
+    '''
+    algorithms = checksum.get_algorithms(algorithms)
+    manifests = set(checksum.MANIFEST_FILES.values())
+    if catalogued is None:
+        catalogued = catalogue(src, DELIVER_IGNORE)
+    dirs, files = catalogued
+    cache = checksum.load_cache(src)
+    dest_existed = os.path.exists(dest)
+    for d in [''] + sorted(dirs):
+        dest_dir = os.path.join(dest, d)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        if dir_mode:
+            os.chmod(dest_dir, dir_mode)
+    jobs = []
+    for rel, st in files.items():
+        src_path = os.path.join(src, rel)
+        dest_path = os.path.join(dest, rel)
+        copy = not dest_existed or needs_copy(src_path, st, dest_path, compare)
+        fastq_algs = None
+        cached = None
+        if checksum.is_fastq(rel):
+            fastq_algs = algorithms
+            cached = checksum.cached_digests(cache, rel,
+                    checksum.stat_key(st), algorithms)
+        jobs.append((rel, src_path, dest_path, st, copy, fastq_algs, cached,
+            file_mode))
+    copy_cnt = len([job for job in jobs if job[4]])
+    logging.info('Delivering %i of %i files from %s to %s using %i threads' %
+            (copy_cnt, len(files), src, dest, threads))
+    if threads > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(threads, len(jobs)))
+        try:
+            results = list(pool.imap_unordered(_deliver_worker, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_deliver_worker(job) for job in jobs]
+    digests = {}
+    new_cache = {}
+    copied = 0
+    for rel, st, file_copied, file_digests in results:
+        copied += file_copied
+        if file_digests:
+            digests[rel] = file_digests
+            new_cache[rel] = {'key': checksum.stat_key(st), 'digests': file_digests}
+    checksum.save_cache(src, new_cache)
+    removed = 0
+    if delete and dest_existed:
+        removed = remove_extra(dest, set(dirs), set(files) | manifests)
+    for root in (src, dest):
+        for path in checksum.write_manifests(root, digests, algorithms):
+            if root == dest and file_mode:
+                os.chmod(path, file_mode)
+    stats = {
+        'files': len(files),
+        'copied': copy_cnt,
+        'skipped': len(files) - copy_cnt,
+        'removed': removed,
+        'bytes': copied,
+        'checksummed': len(digests)
+    }
+    logging.info('Successfully delivered %s to %s: %s' % (src, dest, stats))
+    return stats
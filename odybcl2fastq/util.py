@@ -44,6 +44,17 @@ def copy(src, dest):
         print('copyfile')
     logging.info('Successfully copied %s to %s' % (src, dest))
 
+def disk_usage(path):
+    '''
+    total, used and free bytes of the filesystem containing path, used is
+    counted as df does
+    '''
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    return total, used, free
+
 def load_json(path):
     obj = {}
     with open(path, 'r') as data:
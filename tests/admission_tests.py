@@ -0,0 +1,138 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from odybcl2fastq import admission
+from odybcl2fastq.admission import AdmissionController
+from odybcl2fastq.parsers.parse_interop import get_cluster_counts, InterOpError
+
+RUNINFO = '''<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="run" Number="1">
+    <Reads>
+      <Read Number="1" NumCycles="100" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="100" IsIndexedRead="N" />
+    </Reads>
+    <FlowcellLayout LaneCount="1" SurfaceCount="1" SwathCount="1" TileCount="2" />
+  </Run>
+</RunInfo>
+'''
+
+def write_tile_metrics_v2(path, tiles):
+    with open(path, 'wb') as fh:
+        fh.write(struct.pack('<BB', 2, 10))
+        for (lane, tile), (clusters, pf) in tiles.items():
+            fh.write(struct.pack('<HHHf', lane, tile, 100, 1000.0))
+            fh.write(struct.pack('<HHHf', lane, tile, 102, clusters))
+            fh.write(struct.pack('<HHHf', lane, tile, 103, pf))
+
+def write_tile_metrics_v3(path, tiles):
+    with open(path, 'wb') as fh:
+        fh.write(struct.pack('<BBf', 3, 15, 2.5))
+        for (lane, tile), (clusters, pf) in tiles.items():
+            fh.write(struct.pack('<HIcff', lane, tile, b't', clusters, pf))
+            fh.write(struct.pack('<HIcIf', lane, tile, b'r', 1, 0.5))
+
+class AdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp, 'run') + '/'
+        os.makedirs(self.run_dir + 'InterOp')
+        with open(self.run_dir + 'RunInfo.xml', 'w') as fh:
+            fh.write(RUNINFO)
+        self.tiles = {(1, 1101): (2000000.0, 1500000.0), (1, 1102): (3000000.0, 2500000.0)}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_tile_metrics_versions(self):
+        for write in [write_tile_metrics_v2, write_tile_metrics_v3]:
+            path = self.run_dir + 'InterOp/TileMetricsOut.bin'
+            write(path, self.tiles)
+            counts = get_cluster_counts(path)
+            assert counts['clusters'] == 5000000
+            assert counts['pf_clusters'] == 4000000
+            assert counts['max_tile_clusters'] == 3000000
+            assert counts['tiles'] == 2
+
+    def test_unsupported_version(self):
+        path = self.run_dir + 'InterOp/TileMetricsOut.bin'
+        with open(path, 'wb') as fh:
+            fh.write(struct.pack('<BB', 9, 10))
+        self.assertRaises(InterOpError, get_cluster_counts, path)
+
+    def test_estimate(self):
+        assert admission.estimate_run(self.run_dir)['output_bytes'] is None
+        write_tile_metrics_v2(self.run_dir + 'InterOp/TileMetricsOut.bin', self.tiles)
+        estimate = admission.estimate_run(self.run_dir)
+        per_read = 100 * admission.BYTES_PER_BASE + admission.RECORD_OVERHEAD
+        assert estimate['output_bytes'] == int(4000000 * 2 * per_read)
+        assert estimate['mem_bytes'] > admission.BASE_MEM
+
+    def test_defers_without_disk(self):
+        write_tile_metrics_v2(self.run_dir + 'InterOp/TileMetricsOut.bin', self.tiles)
+        # reserve all but a sliver of the filesystem
+        controller = AdmissionController(self.tmp, disk_reserve=0.9999)
+        assert not controller.admit(self.run_dir)
+        assert controller.deferred[self.run_dir] == 'disk'
+        controller = AdmissionController(self.tmp, disk_reserve=0)
+        assert controller.admit(self.run_dir)
+        assert self.run_dir in controller.admitted
+        controller.release(self.run_dir)
+        assert not controller.admitted
+
+    def test_reserves_only_what_is_unwritten(self):
+        write_tile_metrics_v2(self.run_dir + 'InterOp/TileMetricsOut.bin', self.tiles)
+        output_dir = os.path.join(self.tmp, 'output')
+        os.makedirs(os.path.join(output_dir, 'run-y26_i8'))
+        controller = AdmissionController(output_dir, disk_reserve=0)
+        assert controller.admit(self.run_dir)
+        estimate = controller.admitted[self.run_dir]['output_bytes']
+        assert controller.unwritten(self.run_dir) == estimate
+        # what the run wrote to its mask's output dir is no longer reserved
+        with open(os.path.join(output_dir, 'run-y26_i8', 'a.fastq.gz'), 'wb') as fh:
+            fh.write(b'x' * 2**20)
+        written = admission.written_bytes(output_dir, self.run_dir)
+        assert written >= 2**20
+        # the output is walked again only once the count is stale
+        assert controller.unwritten(self.run_dir) == estimate
+        counted, cached = controller.written[self.run_dir]
+        controller.written[self.run_dir] = (counted - admission.WRITTEN_CACHE, cached)
+        assert controller.unwritten(self.run_dir) == estimate - written
+
+    def test_memory_follows_threads(self):
+        write_tile_metrics_v2(self.run_dir + 'InterOp/TileMetricsOut.bin', self.tiles)
+        few = AdmissionController(self.tmp, threads=2).mem_needed(self.run_dir)
+        many = AdmissionController(self.tmp, threads=16).mem_needed(self.run_dir)
+        per_thread = admission.estimate_run(self.run_dir)['thread_mem_bytes']
+        assert many - few == 14 * per_thread
+
+    def test_running_runs_memory_counted_once(self):
+        write_tile_metrics_v2(self.run_dir + 'InterOp/TileMetricsOut.bin', self.tiles)
+        controller = AdmissionController(self.tmp, disk_reserve=0, threads=2)
+        needed = controller.mem_needed(self.run_dir)
+        for running in ['run1', 'run2']:
+            controller.admitted[running] = {'output_bytes': None, 'mem_bytes': needed}
+        original = (admission.resources.mem_total, admission.resources.mem_available)
+        try:
+            # the running runs already hold their memory, what is left fits one more
+            admission.resources.mem_total = lambda: 4 * needed
+            admission.resources.mem_available = lambda: 2 * needed
+            assert controller.admit(self.run_dir)
+            controller.release(self.run_dir)
+            # memory used outside the runs still counts
+            admission.resources.mem_available = lambda: needed // 2
+            assert not controller.admit(self.run_dir)
+            assert controller.deferred[self.run_dir] == 'memory'
+        finally:
+            admission.resources.mem_total, admission.resources.mem_available = original
+
+    def test_unestimated_runs_are_admitted(self):
+        controller = AdmissionController(self.tmp, disk_reserve=0.9999)
+        assert controller.admit(self.run_dir)
+
+if __name__ == '__main__':
+    unittest.main()
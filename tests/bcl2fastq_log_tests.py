@@ -0,0 +1,36 @@
+import unittest
+from odybcl2fastq.parsers.parse_bcl2fastq_log import Bcl2fastqProgress
+from odybcl2fastq.parsers.parse_runinfoxml import get_flowcell_layout
+
+class Bcl2fastqLogTests(unittest.TestCase):
+
+    def test_progress_events(self):
+        progress = Bcl2fastqProgress()
+        lines = [
+            'BCL to FASTQ file converter\n',
+            '2017-11-01 10:41:27 [2ad83eb8e700] Loading BCL data for Lane 1, tile 1101\n',
+            '2017-11-01 10:41:28 [2ad83eb8e700] Demultiplexing lane 1, tile 1101\n',
+            '2017-11-01 10:41:29 [2ad83eb8e701] Demultiplexing lane 1, tile 1102\n',
+            '2017-11-01 10:41:30 [2ad83eb8e700] Demultiplexing lane 1, tile 1102\n',
+        ]
+        events = [progress.parse(line) for line in lines]
+        assert events[0] is None
+        assert events[1]['stage'] == 'loading'
+        assert (events[2]['lane'], events[2]['tile']) == (1, 1101)
+        assert events[3]['tiles_done'] == 2
+        # a repeated tile is not counted twice
+        assert events[4]['tiles_done'] == 2
+
+    def test_complete_event(self):
+        line = '2017-11-01 12:00:00 [2ad83eb8e700] Processing completed with 0 errors and 2 warnings.\n'
+        event = Bcl2fastqProgress().parse(line)
+        assert event['stage'] == 'complete'
+        assert event['warnings'] == 2
+
+    def test_flowcell_layout(self):
+        layout = get_flowcell_layout('tests/sample_data/RunInfo.xml')
+        assert layout['LaneCount'] == 2
+        assert layout['Tiles'] == 2 * 2 * 2 * 16
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from odybcl2fastq.broker import ResourceBroker
+
+class BrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'leases.json')
+        self.broker = ResourceBroker(self.path, cpus=8, mem_mb=1000, poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_lease_and_release(self):
+        with self.broker.lease('bcl2fastq', 4, 500):
+            with self.broker.ledger() as ledger:
+                assert len(ledger['leases']) == 1
+                assert ledger['leases'][0]['granted']
+        with self.broker.ledger() as ledger:
+            assert ledger['leases'] == []
+
+    def test_oversized_request_runs_alone(self):
+        with self.broker.lease('centrifuge', 64, 5000):
+            with self.broker.ledger() as ledger:
+                assert ledger['leases'][0]['cpus'] == 8
+                assert ledger['leases'][0]['mem_mb'] == 1000
+
+    def test_waiters_are_granted_in_order(self):
+        order = []
+        first = self.broker.acquire('bcl2fastq', 8)
+        def wait(name):
+            with self.broker.lease(name, 6):
+                order.append(name)
+        threads = []
+        for name in ['a', 'b', 'c']:
+            threads.append(threading.Thread(target=wait, args=(name,)))
+            threads[-1].start()
+            # each ticket is taken before the next thread starts
+            while True:
+                with self.broker.ledger() as ledger:
+                    if len(ledger['leases']) == len(threads) + 1:
+                        break
+        self.broker.release(first)
+        for thread in threads:
+            thread.join()
+        assert order == ['a', 'b', 'c']
+
+    def test_dead_leases_are_pruned(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.path, 'w') as fh:
+            json.dump({'ticket': 1, 'leases': [{'id': 'x', 'pid': pid, 'name': 'bcl2fastq',
+                'cpus': 8, 'mem_mb': 0, 'ticket': 1, 'granted': True}]}, fh)
+        with self.broker.lease('bcl2fastq', 8):
+            assert self.broker.active_pids('bcl2fastq') == set()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+from odybcl2fastq import centrifuge_batch
+
+# reads each stream it is given and classifies every read as human
+FAKE_CENTRIFUGE = '''
+import sys
+args = sys.argv[1:]
+opts = dict(zip(args[::2], args[1::2]))
+names = []
+for switch in ('-1', '-2', '-U'):
+    if switch in opts:
+        with open(opts[switch]) as fh:
+            for i, line in enumerate(fh):
+                if i % 4 == 0 and switch != '-2':
+                    names.append(line[1:].split()[0])
+with open(opts['-S'], 'w') as out:
+    out.write('readID\\tseqID\\ttaxID\\n')
+    for name in names:
+        out.write('%s\\tNC_1\\t9606\\n' % name)
+'''
+
+# writes the reads it was given as the report
+FAKE_KRONA = '''
+import sys, shutil
+shutil.copy(sys.argv[1], sys.argv[3])
+'''
+
+class CentrifugeBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.original = (centrifuge_batch.CENTRIFUGE, centrifuge_batch.KRONA)
+        centrifuge_batch.CENTRIFUGE = '%s %s' % (sys.executable, self.script('centrifuge.py', FAKE_CENTRIFUGE))
+        centrifuge_batch.KRONA = '%s %s' % (sys.executable, self.script('krona.py', FAKE_KRONA))
+
+    def tearDown(self):
+        centrifuge_batch.CENTRIFUGE, centrifuge_batch.KRONA = self.original
+        shutil.rmtree(self.tmp)
+
+    def script(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def fastq(self, name, reads):
+        path = os.path.join(self.tmp, name)
+        with gzip.open(path, 'wb') as f:
+            for read in reads:
+                f.write(('@%s 1:N:0:1\nACGT\n+\nFFFF\n' % read).encode('ascii'))
+        return path
+
+    def batch(self):
+        samples = {
+            'a': ([self.fastq('a_R1_L1.fastq.gz', ['r1', 'r2']), self.fastq('a_R1_L2.fastq.gz', ['r3'])],
+                [self.fastq('a_R2_L1.fastq.gz', ['r1', 'r2']), self.fastq('a_R2_L2.fastq.gz', ['r3'])]),
+            'b': ([self.fastq('b_R1.fastq.gz', ['r1', 'r9'])], None)
+        }
+        outfiles = dict((s, os.path.join(self.tmp, s + '.html')) for s in samples)
+        return centrifuge_batch.Batch(samples, outfiles, os.path.join(self.tmp, 'batch'),
+                '/centrifuge/nt', 2), outfiles
+
+    def test_one_process_split_by_sample(self):
+        batch, outfiles = self.batch()
+        result, reports = batch.run()
+        assert result[0] == 0
+        assert reports == {'a': (0, b'', b''), 'b': (0, b'', b'')}
+        for sample, reads in (('a', ['r1', 'r2', 'r3']), ('b', ['r1', 'r9'])):
+            with open(outfiles[sample]) as f:
+                lines = f.read().splitlines()
+            # the tags are removed and every sample keeps the header
+            assert lines == ['readID\tseqID\ttaxID'] + ['%s\tNC_1\t9606' % r for r in reads]
+        assert not os.path.exists(os.path.join(self.tmp, 'batch'))
+
+    def test_failed_centrifuge_writes_no_reports(self):
+        # exits without opening its streams
+        centrifuge_batch.CENTRIFUGE = 'false'
+        batch, outfiles = self.batch()
+        result, reports = batch.run()
+        assert result[0] != 0 and reports == {}
+        assert not any(os.path.exists(path) for path in outfiles.values())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from odybcl2fastq import centrifuge_batch
+from odybcl2fastq import centrifuge_process_runs as centrifuge
+from tests.centrifuge_batch_tests import FAKE_CENTRIFUGE
+
+# logs the report cmd it was run as and writes the reads as the report
+FAKE_KRONA = '''
+import sys, shutil
+with open(sys.argv[0] + '.log', 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+shutil.copy(sys.argv[1], sys.argv[3])
+'''
+
+class CentrifugeQueueTests(unittest.TestCase):
+
+    def test_run_done_with_last_sample(self):
+        samples = centrifuge.SampleQueue()
+        samples.add_run('/out/run1/', {'s2': 'cmd s2', 's1': 'cmd s1'})
+        samples.add_run('/out/run2/', {'s1': 'cmd run2 s1'})
+        assert samples.pending == [('/out/run1/', 's1'), ('/out/run1/', 's2'), ('/out/run2/', 's1')]
+        assert samples.take(('/out/run1/', 's1')) == 'cmd s1'
+        assert samples.take(('/out/run2/', 's1')) == 'cmd run2 s1'
+        # run2's only sample finishes before run1's
+        assert samples.finished(('/out/run2/', 's1'), 'ok') == {'s1': 'ok'}
+        assert samples.finished(('/out/run1/', 's1'), 'ok') is None
+        samples.take(('/out/run1/', 's2'))
+        assert samples.finished(('/out/run1/', 's2'), 'fail') == {'s1': 'ok', 's2': 'fail'}
+        assert not samples.remaining and not samples.pending
+
+    def test_samples_of_next_run_fill_slots(self):
+        # one slot busy with a long sample of run1 does not hold up run2
+        finished_runs = []
+        original = (centrifuge.get_batch_cmd, centrifuge.run_batch, centrifuge.finish_run)
+        centrifuge.get_batch_cmd = lambda batch, reads: (reads[0], {batch[0][1]: None}, None)
+        centrifuge.run_batch = lambda cmd, outfiles, work: time.sleep(0.5 if cmd == 'slow' else 0) or \
+                dict((sample, cmd) for sample in outfiles)
+        centrifuge.finish_run = lambda run_dir, results: finished_runs.append(run_dir)
+        pool = ThreadPool(2)
+        try:
+            samples = centrifuge.SampleQueue()
+            samples.add_run('run1', {'a': 'slow', 'b': 'fast'})
+            samples.add_run('run2', {'a': 'fast', 'b': 'fast'})
+            running = set()
+            finished = Queue()
+            end = time.time() + 5
+            while (samples.remaining or running) and time.time() < end:
+                centrifuge.handle_finished(samples, running, finished)
+                centrifuge.dispatch_samples(pool, 2, samples, running, finished)
+                time.sleep(0.01)
+            assert finished_runs == ['run2', 'run1']
+        finally:
+            centrifuge.get_batch_cmd, centrifuge.run_batch, centrifuge.finish_run = original
+            pool.close()
+            pool.join()
+
+    def test_batches_stay_within_a_run(self):
+        samples = centrifuge.SampleQueue()
+        samples.add_run('run1', {'a': 'a', 'b': 'b', 'c': 'c'})
+        samples.add_run('run2', {'a': 'a'})
+        assert samples.batches(2) == [(('run1', 'a'), ('run1', 'b')), (('run1', 'c'),),
+                (('run2', 'a'),)]
+        assert samples.batches(1) == [(item,) for item in samples.pending]
+
+    def test_batch_results_split_by_report(self):
+        usage = OrderedDict([('name', 'centrifuge'), ('wall_seconds', 10.0), ('bytes_read', 100)])
+        reports = {'a': (0, b'', b''), 'b': (1, b'', b'krona failed')}
+        results = centrifuge.split_results((0, b'out', b'err', 'cmd', usage), reports, ['a', 'b'])
+        assert results['a'][0] == 0
+        assert results['b'][0] == 1 and b'krona failed' in results['b'][2]
+        # the batch's time is shared, each sample gets its own usage
+        assert results['a'][4]['wall_seconds'] == 5.0 and results['a'][4]['batch_size'] == 2
+        assert results['a'][4] is not results['b'][4]
+        # no sample of a failed batch succeeds
+        results = centrifuge.split_results((2, b'', b'killed', 'cmd', usage), {}, ['a', 'b'])
+        assert results['a'][0] == 2 and results['b'][0] == 2
+
+    def test_lone_and_batched_samples_report_alike(self):
+        tmp = tempfile.mkdtemp()
+        original = (centrifuge_batch.CENTRIFUGE, centrifuge_batch.KRONA)
+        try:
+            scripts = {}
+            for name, text in (('centrifuge.py', FAKE_CENTRIFUGE), ('krona.py', FAKE_KRONA)):
+                scripts[name] = os.path.join(tmp, name)
+                with open(scripts[name], 'w') as fh:
+                    fh.write(text)
+            centrifuge_batch.CENTRIFUGE = '%s %s' % (sys.executable, scripts['centrifuge.py'])
+            centrifuge_batch.KRONA = '%s %s' % (sys.executable, scripts['krona.py'])
+            run_dir = os.path.join(tmp, 'run') + '/'
+            os.mkdir(run_dir)
+            reads = {}
+            for sample in ('a', 'b'):
+                path = run_dir + sample + '.fastq'
+                with open(path, 'w') as fh:
+                    fh.write('@r1 1:N:0:1\nACGT\n+\nFFFF\n')
+                reads[sample] = ([path], None)
+            cmds = []
+            for batch in ([(run_dir, 'a')], [(run_dir, 'a'), (run_dir, 'b')]):
+                cmd, outfiles, work = centrifuge.get_batch_cmd(batch, [reads[item[1]] for item in batch])
+                result, reports = work.run()
+                assert result[0] == 0 and reports['a'][0] == 0
+                with open(scripts['krona.py'] + '.log') as log:
+                    cmds.append(log.read().splitlines()[-len(batch)])
+                os.remove(scripts['krona.py'] + '.log')
+            # sample a's report is made by the same cmd alone or batched
+            assert cmds[0] == cmds[1]
+            assert cmds[0].startswith(run_dir + 'centrifuge/')
+        finally:
+            centrifuge_batch.CENTRIFUGE, centrifuge_batch.KRONA = original
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
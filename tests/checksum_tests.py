@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+import hashlib
+import tempfile
+import odybcl2fastq.checksum as checksum
+
+class ChecksumTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        os.mkdir(self.output_dir + '/proj')
+        self.files = {
+            'Undetermined_S0_L001_R1_001.fastq.gz': b'undetermined' * 1000,
+            'proj/sample_S1_L001_R1_001.fastq.gz': b'sample1' * 5000,
+            'proj/sample_S2_L001_R1_001.fastq.gz': b'',
+        }
+        for rel, data in self.files.items():
+            with open(os.path.join(self.output_dir, rel), 'wb') as fh:
+                fh.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _read_manifest(self, name):
+        with open(os.path.join(self.output_dir, name)) as fh:
+            return [line.rstrip('\n') for line in fh]
+
+    def test_md5_manifest_format(self):
+        checksum.checksum_dir(self.output_dir, threads=2)
+        lines = self._read_manifest('md5sum.txt')
+        control = ['%s  %s' % (hashlib.md5(self.files[rel]).hexdigest(), rel)
+                for rel in sorted(self.files)]
+        assert lines == control
+
+    def test_single_pass_multiple_algorithms(self):
+        path = os.path.join(self.output_dir, 'proj/sample_S1_L001_R1_001.fastq.gz')
+        digests = checksum.hash_file(path, 'md5,sha256', buffer_size=1024)
+        data = self.files['proj/sample_S1_L001_R1_001.fastq.gz']
+        assert digests['md5'] == hashlib.md5(data).hexdigest()
+        assert digests['sha256'] == hashlib.sha256(data).hexdigest()
+
+    def test_rerun_hashes_only_changed_files(self):
+        checksum.checksum_dir(self.output_dir)
+        changed = 'proj/sample_S2_L001_R1_001.fastq.gz'
+        with open(os.path.join(self.output_dir, changed), 'wb') as fh:
+            fh.write(b'changed')
+        hashed = []
+        hash_files = checksum.hash_files
+        def counting_hash_files(paths, *args):
+            hashed.extend(paths)
+            return hash_files(paths, *args)
+        checksum.hash_files = counting_hash_files
+        try:
+            checksum.checksum_dir(self.output_dir)
+        finally:
+            checksum.hash_files = hash_files
+        assert hashed == [os.path.join(self.output_dir, changed)]
+        lines = self._read_manifest('md5sum.txt')
+        assert '%s  %s' % (hashlib.md5(b'changed').hexdigest(), changed) in lines
+        assert len(lines) == len(self.files)
+
+    def test_md5_always_included(self):
+        assert checksum.get_algorithms('sha1') == ['md5', 'sha1']
+        self.assertRaises(ValueError, checksum.get_algorithms, 'crc32')
+
+if __name__ == '__main__':
+    unittest.main()
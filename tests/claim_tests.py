@@ -0,0 +1,92 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+from odybcl2fastq import claim
+
+def claim_all(run_dirs):
+    # a worker process claiming whatever it can, like process_runs on a host
+    return [(run_dir, claim.claim(run_dir, timeout=60)) for run_dir in run_dirs]
+
+def make_stale(run_dir):
+    path = claim.get_path(run_dir)
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+
+class ClaimTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.run_dirs = []
+        for i in range(20):
+            run_dir = os.path.join(self.tmp, 'run%i' % i) + '/'
+            os.mkdir(run_dir)
+            self.run_dirs.append(run_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def claims_by_run(self, results):
+        won = {}
+        for worker in results:
+            for run_dir, token in worker:
+                if token:
+                    won.setdefault(run_dir, []).append(token)
+        return won
+
+    def test_claim_and_release(self):
+        run_dir = self.run_dirs[0]
+        token = claim.claim(run_dir)
+        assert token
+        assert claim.claim(run_dir) is None
+        assert claim.holds(run_dir, token)
+        claim.release(run_dir, 'other')
+        assert os.path.exists(claim.get_path(run_dir))
+        claim.release(run_dir, token)
+        assert not os.path.exists(claim.get_path(run_dir))
+
+    def test_each_run_claimed_once_by_concurrent_workers(self):
+        pool = Pool(6)
+        try:
+            results = pool.map(claim_all, [self.run_dirs] * 6)
+        finally:
+            pool.close()
+            pool.join()
+        won = self.claims_by_run(results)
+        assert sorted(won) == sorted(self.run_dirs)
+        assert all(len(tokens) == 1 for tokens in won.values())
+
+    def test_stale_claims_are_taken_over_once(self):
+        for run_dir in self.run_dirs:
+            assert claim.claim(run_dir)
+            make_stale(run_dir)
+            assert claim.is_orphaned(run_dir)
+        pool = Pool(6)
+        try:
+            results = pool.map(claim_all, [self.run_dirs] * 6)
+        finally:
+            pool.close()
+            pool.join()
+        won = self.claims_by_run(results)
+        assert sorted(won) == sorted(self.run_dirs)
+        assert all(len(tokens) == 1 for tokens in won.values())
+        for run_dir, tokens in won.items():
+            assert claim.holds(run_dir, tokens[0])
+            assert not claim.is_orphaned(run_dir)
+        # no takeover locks are left behind
+        assert not [f for d in self.run_dirs for f in os.listdir(d) if f.endswith('.takeover')]
+
+    def test_heartbeat_keeps_claim_fresh(self):
+        run_dir = self.run_dirs[0]
+        token = claim.claim(run_dir)
+        make_stale(run_dir)
+        heartbeat = claim.Heartbeat(interval=60)
+        heartbeat.add(run_dir, token)
+        heartbeat.beat()
+        assert not claim.is_stale(claim.get_path(run_dir), 60)
+        assert claim.claim(run_dir, timeout=60) is None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from odybcl2fastq.discovery import RunWatcher, Waker
+
+class DiscoveryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp() + '/'
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_run(self, name, files=()):
+        os.mkdir(self.root + name)
+        for f in files:
+            open(self.root + name + '/' + f, 'w').close()
+        # age the dir past the mtime slack so it can be cached
+        old = time.time() - 60
+        os.utime(self.root + name, (old, old))
+        return self.root + name + '/'
+
+    def has_complete(self, dir):
+        self.calls.append(dir)
+        return os.path.exists(dir + 'RTAComplete.txt')
+
+    def test_unchanged_dirs_are_not_rechecked(self):
+        ready = self.make_run('run1', ['RTAComplete.txt'])
+        self.make_run('run2')
+        watcher = RunWatcher(self.root, inotify=False)
+        assert watcher.find_runs(self.has_complete) == [ready]
+        assert len(self.calls) == 2
+        assert watcher.find_runs(self.has_complete) == [ready]
+        assert len(self.calls) == 2
+
+    def test_changed_and_new_dirs_are_checked(self):
+        self.make_run('run1')
+        watcher = RunWatcher(self.root, inotify=False)
+        assert watcher.find_runs(self.has_complete) == []
+        open(self.root + 'run1/RTAComplete.txt', 'w').close()
+        new = self.make_run('run2', ['RTAComplete.txt'])
+        runs = watcher.find_runs(self.has_complete)
+        assert runs == [self.root + 'run1/', new]
+
+    def test_shared_scan(self):
+        self.make_run('run1')
+        watcher = RunWatcher(self.root, inotify=False)
+        watcher.scan()
+        assert watcher.find_runs(self.has_complete, rescan=False) == []
+        open(self.root + 'run1/RTAComplete.txt', 'w').close()
+        # the change is only seen by the next scan
+        assert watcher.find_runs(self.has_complete, rescan=False) == []
+        watcher.scan()
+        assert watcher.find_runs(self.has_complete, rescan=False) == [self.root + 'run1/']
+        assert watcher.find_runs(os.path.isdir, rescan=False) == [self.root + 'run1/']
+
+    def test_recheck_interval(self):
+        self.make_run('run1')
+        watcher = RunWatcher(self.root, recheck_interval=0, inotify=False)
+        watcher.find_runs(self.has_complete)
+        time.sleep(0.01)
+        watcher.find_runs(self.has_complete)
+        assert len(self.calls) == 2
+
+    def test_wait_wakes_when_run_ready(self):
+        run = self.make_run('run1', ['RunInfo.xml'])
+        watcher = RunWatcher(self.root, ['RunInfo.xml', 'RTAComplete.txt'])
+        if not watcher.inotify:
+            self.skipTest('inotify not available')
+        # watches are added as runs are scanned
+        watcher.find_runs(self.has_complete)
+        timer = threading.Timer(0.1, lambda: open(run + 'RTAComplete.txt', 'w').close())
+        timer.start()
+        start = time.time()
+        assert watcher.wait(10) == [run]
+        assert time.time() - start < 5
+        assert watcher.find_runs(self.has_complete) == [run]
+
+    def test_ready_for_any_pipeline(self):
+        run = self.make_run('run1', ['RunInfo.xml'])
+        watcher = RunWatcher(self.root, ['RTAComplete.txt', 'RunInfo.xml'])
+        if not watcher.inotify:
+            self.skipTest('inotify not available')
+        watcher.add_required(['SampleSheet.csv', 'RunInfo.xml'])
+        watcher.find_runs(self.has_complete)
+        # only the second pipeline's files are there
+        timer = threading.Timer(0.1, lambda: open(run + 'SampleSheet.csv', 'w').close())
+        timer.start()
+        assert watcher.wait(10) == [run]
+
+    def test_wait_wakes_when_set(self):
+        watcher = RunWatcher(self.root, inotify=False)
+        waker = Waker()
+        threading.Timer(0.1, waker.set).start()
+        start = time.time()
+        assert watcher.wait(10, waker) == []
+        assert time.time() - start < 5
+        # cleared once woken
+        start = time.time()
+        watcher.wait(0.2, waker)
+        assert time.time() - start >= 0.2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+from odybcl2fastq import exporter
+
+class ExporterTests(unittest.TestCase):
+
+    def test_render(self):
+        registry = exporter.Registry('test')
+        runs = registry.counter('runs_total', 'Runs.', ['status'])
+        depth = registry.gauge('queue_depth', 'Queue.')
+        seconds = registry.histogram('seconds', 'Time.', buckets=(1, 10))
+        runs.inc(status='success')
+        runs.inc(2, status='fail"ure')
+        depth.set(3)
+        seconds.observe(0.5)
+        seconds.observe(5)
+        text = registry.render()
+        assert '# TYPE test_runs_total counter' in text
+        assert 'test_runs_total{status="success"} 1.0' in text
+        assert 'test_runs_total{status="fail\\"ure"} 2.0' in text
+        assert 'test_queue_depth 3.0' in text
+        assert 'test_seconds_bucket{le="1.0"} 1' in text
+        assert 'test_seconds_bucket{le="10.0"} 2' in text
+        assert 'test_seconds_bucket{le="+Inf"} 2' in text
+        assert 'test_seconds_sum 5.5' in text
+        assert 'test_seconds_count 2' in text
+        self.assertRaises(ValueError, runs.inc, stage='demux')
+
+    def test_run_metrics(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'run.metrics.json')
+            with open(path, 'w') as fh:
+                json.dump({'stages': {
+                    'demux': {'status': 'success', 'wall_seconds': 100, 'bytes_written': 2**30},
+                    'copy_output_to_final': {'status': 'success', 'wall_seconds': 10, 'bytes': 2**20},
+                    'fastqc': {'status': 'skipped'}}}, fh)
+            metrics = exporter.DaemonMetrics('test')
+            metrics.observe_run_metrics(path)
+            assert metrics.stage_seconds.get(stage='demux') == (1, 100)
+            assert metrics.stage_bytes.get(stage='demux') == 2**30
+            assert metrics.stage_bytes.get(stage='copy_output_to_final') == 2**20
+            assert metrics.stage_seconds.get(stage='fastqc') == (0, 0)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_health(self):
+        metrics = exporter.DaemonMetrics('test', stall_seconds=60)
+        with metrics.loop():
+            pass
+        server = exporter.serve(metrics, 0)
+        try:
+            url = 'http://127.0.0.1:%i' % server.server_address[1]
+            body = urlopen(url + '/metrics').read().decode('utf-8')
+            assert 'test_loop_seconds_count 1' in body
+            assert urlopen(url + '/health').getcode() == 200
+            # no pass of the loop for longer than stall_seconds
+            metrics.last_loop.set(time.time() - 120)
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(url + '/health')
+            assert cm.exception.code == 503
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+from odybcl2fastq import exporter
+from odybcl2fastq.orchestrator import Orchestrator
+
+def work(item):
+    if item == 'bad':
+        raise ValueError('bad run')
+    return item
+
+class FakePipeline(object):
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = list(items)
+        self.running = set()
+        self.done = []
+        self.failures = []
+        self.metrics = exporter.DaemonMetrics(name)
+
+    def watchers(self):
+        return []
+
+    def ready(self):
+        return [i for i in self.items if i not in self.running]
+
+    def start(self, item):
+        self.items.remove(item)
+        self.running.add(item)
+        return item, work, (item,)
+
+    def finish(self, key, result):
+        self.running.discard(key)
+        self.done.append(result)
+
+    def failed(self, key, tb):
+        self.running.discard(key)
+        self.failures.append(key)
+
+    def after(self):
+        pass
+
+class OrchestratorTests(unittest.TestCase):
+
+    def test_priority_and_limits(self):
+        first = FakePipeline('first', ['a1', 'a2', 'a3'])
+        second = FakePipeline('second', ['b1', 'bad'])
+        pool = ThreadPool(3)
+        try:
+            orchestrator = Orchestrator(pool, 3, [first, second], {'first': 2})
+            # first is limited to 2 of the 3 slots, second gets the last
+            assert orchestrator.dispatch() == [('first', 'a1'), ('first', 'a2'), ('second', 'b1')]
+            assert first.metrics.queue_depth.get() == 1
+            assert first.metrics.in_flight.get() == 2
+            end = time.time() + 5
+            while (first.items or second.items or orchestrator.running) and time.time() < end:
+                time.sleep(0.01)
+                orchestrator.handle_finished()
+                orchestrator.dispatch()
+            assert sorted(first.done) == ['a1', 'a2', 'a3']
+            assert second.done == ['b1']
+            assert second.failures == ['bad']
+        finally:
+            pool.close()
+            pool.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import errno
+import unittest
+import shutil
+import tempfile
+import threading
+from odybcl2fastq.pipeline import Pipeline, StageError
+from odybcl2fastq.checkpoint import Checkpoints
+from odybcl2fastq.metrics import RunMetrics
+
+class PipelineTests(unittest.TestCase):
+
+    def test_dependencies_run_in_order(self):
+        order = []
+        pipeline = Pipeline('test')
+        pipeline.add('a', order.append, ('a',))
+        pipeline.add('b', order.append, ('b',), deps=['a'])
+        pipeline.add('c', order.append, ('c',), deps=['b', 'not_added'])
+        pipeline.run()
+        assert order == ['a', 'b', 'c']
+
+    def test_independent_stages_overlap(self):
+        # each stage waits for the other so this only finishes if they
+        # run at the same time
+        barrier = [threading.Event(), threading.Event()]
+        def stage(i):
+            barrier[i].set()
+            return barrier[1 - i].wait(5)
+        pipeline = Pipeline('test', threads=2)
+        pipeline.add('first', stage, (0,))
+        pipeline.add('second', stage, (1,))
+        results = pipeline.run()
+        assert results['first'] and results['second']
+
+    def test_failure_skips_dependents(self):
+        ran = []
+        def fail():
+            raise IOError('nfs hiccup')
+        pipeline = Pipeline('test')
+        pipeline.add('fail', fail)
+        pipeline.add('after', ran.append, ('after',), deps=['fail'])
+        pipeline.add('independent', ran.append, ('independent',))
+        with self.assertRaises(StageError) as cm:
+            pipeline.run()
+        assert cm.exception.stage == 'fail'
+        assert isinstance(cm.exception.error, IOError)
+        assert ran == ['independent']
+
+    def test_stage_metrics(self):
+        metrics = RunMetrics('test')
+        pipeline = Pipeline('test', metrics=metrics)
+        pipeline.add('copy', lambda: {'files': 3, 'bytes': 2**40})
+        pipeline.run()
+        record = metrics.to_dict()['stages']['copy']
+        assert record['status'] == 'success'
+        assert record['files'] == 3
+        assert record['bytes'] == 2**40
+        assert record['wall_seconds'] >= 0
+
+    def test_transient_failure_retried(self):
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise IOError(errno.ESTALE, 'Stale file handle')
+            return {'files': 1}
+        metrics = RunMetrics('test')
+        pipeline = Pipeline('test', metrics=metrics, retries=2, retry_delay=0)
+        pipeline.add('copy', flaky)
+        # runs alongside copy so it keeps its own list
+        pipeline.add('no_retry', [].append, (2,), retries=0)
+        pipeline.run()
+        record = metrics.to_dict()['stages']['copy']
+        assert record['status'] == 'success'
+        assert record['attempts'] == 2
+
+    def _checkpointed_pipeline(self, output_dir, ran, fail=False):
+        def stage(name):
+            if fail and name == 'copy':
+                raise IOError('copy failed')
+            ran.append(name)
+        pipeline = Pipeline('test', checkpoints=Checkpoints(output_dir))
+        pipeline.add('qc', stage, ('qc',), inputs=['demux1'])
+        pipeline.add('copy', stage, ('copy',), deps=['qc'], inputs=['demux1'])
+        pipeline.add('summary', stage, ('summary',))
+        return pipeline
+
+    def test_rerun_resumes_at_failed_stage(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            ran = []
+            pipeline = self._checkpointed_pipeline(output_dir, ran, fail=True)
+            self.assertRaises(StageError, pipeline.run)
+            assert sorted(ran) == ['qc', 'summary']
+            ran = []
+            self._checkpointed_pipeline(output_dir, ran).run()
+            # qc completed last time, stages without inputs always run
+            assert sorted(ran) == ['copy', 'summary']
+            ran = []
+            checkpoints = Checkpoints(output_dir)
+            checkpoints.clear('qc')
+            self._checkpointed_pipeline(output_dir, ran).run()
+            # rerunning an upstream stage reruns everything downstream
+            assert sorted(ran) == ['copy', 'qc', 'summary']
+        finally:
+            shutil.rmtree(output_dir)
+
+if __name__ == '__main__':
+    unittest.main()
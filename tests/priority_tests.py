@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from odybcl2fastq import priority
+
+RUNINFO = '''<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="%(run)s" Number="1">
+    <Flowcell>FC</Flowcell>
+    <Instrument>%(instrument)s</Instrument>
+    <Reads>
+      <Read Number="1" NumCycles="%(cycles)i" IsIndexedRead="N" />
+    </Reads>
+    <FlowcellLayout LaneCount="%(lanes)i" SurfaceCount="1" SwathCount="1" TileCount="10" />
+  </Run>
+</RunInfo>
+'''
+
+class PriorityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp() + '/'
+        self.now = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_run(self, run, lanes, cycles=100, hours_ago=0, instrument='NB1'):
+        run_dir = self.tmp + run + '/'
+        os.mkdir(run_dir)
+        with open(run_dir + 'RunInfo.xml', 'w') as fh:
+            fh.write(RUNINFO % {'run': run, 'instrument': instrument, 'cycles': cycles, 'lanes': lanes})
+        open(run_dir + 'RTAComplete.txt', 'w').close()
+        ready = self.now - hours_ago * 3600
+        os.utime(run_dir + 'RTAComplete.txt', (ready, ready))
+        return run_dir
+
+    def test_estimate_work(self):
+        run_dir = self.make_run('a', 8, 300)
+        assert priority.estimate_work(run_dir + 'RunInfo.xml') == 8 * 10 * 300
+
+    def test_fifo_and_override(self):
+        big = self.make_run('a_big', 8)
+        small = self.make_run('b_small', 1)
+        assert priority.order_runs([small, big], 'fifo', now=self.now) == [big, small]
+        with open(small + priority.PRIORITY_FILE, 'w') as fh:
+            fh.write('5')
+        assert priority.order_runs([big, small], 'fifo', now=self.now) == [small, big]
+
+    def test_sjf_ages_big_runs(self):
+        big = self.make_run('a_big', 8)
+        small = self.make_run('b_small', 1)
+        assert priority.order_runs([big, small], 'sjf', now=self.now) == [small, big]
+        # waited long enough that its effective work is less than the new run
+        old_big = self.make_run('c_big', 8, hours_ago=priority.AGING_HOURS * 10)
+        assert priority.order_runs([small, old_big], 'sjf', now=self.now) == [old_big, small]
+
+    def test_weighted_fair(self):
+        # 0.48 hours of work ready 0.25 hours ago finishes after 0.02 hours ready now
+        big = self.make_run('a_big', 8, 300, hours_ago=0.25)
+        small = self.make_run('b_small', 1)
+        assert priority.order_runs([big, small], 'weighted', now=self.now) == [small, big]
+        # a rerun has twice the weight, so half the time
+        os.makedirs(self.tmp + 'out/a_big')
+        order = priority.order_runs([big, small], 'weighted', output_dir=self.tmp + 'out/', now=self.now)
+        assert order == [big, small]
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, priority.order_runs, [], 'lifo')
+
+if __name__ == '__main__':
+    unittest.main()
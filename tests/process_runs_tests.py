@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from odybcl2fastq import claim
+from odybcl2fastq import config
+from odybcl2fastq import retry
+from odybcl2fastq import run_state
+from odybcl2fastq import process_runs
+from odybcl2fastq.run_state import RunStateDB
+from odybcl2fastq.metrics import report_written
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+class ProcessRunsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.original = run_state._db
+        run_state._db = RunStateDB(os.path.join(self.tmp, 'runs.db'))
+        self.run_dir = os.path.join(self.tmp, 'run1') + '/'
+        os.mkdir(self.run_dir)
+
+    def tearDown(self):
+        run_state._db = self.original
+        shutil.rmtree(self.tmp)
+
+    def touch(self, name, age=0):
+        path = self.run_dir + name
+        open(path, 'w').close()
+        old = time.time() - age
+        os.utime(path, (old, old))
+
+    def test_run_processed_since_the_scan_is_not_started(self):
+        # another host marked it processed after our scan and released it
+        self.touch(process_runs.PROCESSED_FILE)
+        assert process_runs.start_run(self.run_dir) is None
+        assert not os.path.exists(claim.get_path(self.run_dir))
+
+    def test_orphaned_run_is_taken_over_unless_complete(self):
+        self.touch(process_runs.PROCESSED_FILE)
+        self.touch(claim.CLAIM_FILE, age=claim.TIMEOUT + 60)
+        token = process_runs.start_run(self.run_dir)
+        assert token and claim.holds(self.run_dir, token)
+        claim.release(self.run_dir, token)
+        self.touch(process_runs.COMPLETE_FILE)
+        self.touch(claim.CLAIM_FILE, age=claim.TIMEOUT + 60)
+        assert process_runs.start_run(self.run_dir) is None
+
+    def test_due_retry_is_started(self):
+        # its first attempt marked it processed
+        self.touch(process_runs.PROCESSED_FILE)
+        retries = retry.RetryQueue(base_delay=0, db=run_state._db)
+        retries.add(self.run_dir, now=time.time() - 60)
+        assert process_runs.start_run(self.run_dir, retries=retries)
+
+    def test_new_run_is_started(self):
+        token = process_runs.start_run(self.run_dir)
+        assert token and claim.holds(self.run_dir, token)
+
+    def test_orphaned_run_found_without_dir_change(self):
+        os.mkdir(self.run_dir + 'InterOp')
+        for name in process_runs.REQUIRED_FILES + [process_runs.PROCESSED_FILE, claim.CLAIM_FILE]:
+            self.touch(name)
+        hour_ago = time.time() - 3600
+        os.utime(self.run_dir, (hour_ago, hour_ago))
+        original = config.SOURCE_DIR
+        config.SOURCE_DIR = self.tmp + '/'
+        try:
+            assert process_runs.ready_runs([]) == []
+            # the worker died, its claim goes stale but the run dir is untouched
+            self.touch(claim.CLAIM_FILE, age=claim.TIMEOUT + 60)
+            os.utime(self.run_dir, (hour_ago, hour_ago))
+            assert process_runs.ready_runs([]) == [self.run_dir]
+        finally:
+            config.SOURCE_DIR = original
+
+    def test_observe_reported_metrics_only(self):
+        path = os.path.join(self.tmp, 'run1-y26.metrics.json')
+        with open(path, 'w') as fh:
+            json.dump({'stages': {'demux': {'status': 'success', 'wall_seconds': 100}}}, fh)
+        # a metrics file an earlier attempt left is not reported again
+        old = os.path.join(self.tmp, 'run1.metrics.json')
+        with open(old, 'w') as fh:
+            json.dump({'stages': {'demux': {'status': 'success', 'wall_seconds': 50}}}, fh)
+        out = StringIO()
+        out.write('bcl2fastq output\n')
+        report_written(path, out)
+        before = process_runs.METRICS.stage_seconds.get(stage='demux')
+        retried = process_runs.METRICS.finished.get(status='retry')
+        failed = process_runs.METRICS.finished.get(status='failure')
+        process_runs.observe_run(retry.EX_TEMPFAIL, out.getvalue(), retrying=True)
+        after = process_runs.METRICS.stage_seconds.get(stage='demux')
+        assert (after[0] - before[0], after[1] - before[1]) == (1, 100)
+        assert process_runs.METRICS.finished.get(status='retry') == retried + 1
+        assert process_runs.METRICS.finished.get(status='failure') == failed
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import odybcl2fastq.resources as resources
+
+GB = 2**30
+
+class ResourcesTests(unittest.TestCase):
+
+    def test_single_run_uses_node(self):
+        threads = resources.auto_bcl2fastq_threads(8, 96, 1, 32, 64 * GB)
+        assert threads == {'loading': 4, 'processing': 24, 'writing': 4}
+
+    def test_concurrent_runs_share_cpus(self):
+        threads = resources.auto_bcl2fastq_threads(8, 96, 4, 32, 64 * GB)
+        assert threads == {'loading': 1, 'processing': 6, 'writing': 1}
+        assert sum(threads.values()) <= 32 // 4
+
+    def test_bounded_by_lanes_samples_and_memory(self):
+        threads = resources.auto_bcl2fastq_threads(1, 2, 1, 64, 4 * GB)
+        assert threads == {'loading': 1, 'processing': 4, 'writing': 2}
+
+    def test_memory_of_running_jobs_not_discounted(self):
+        # the other jobs are running, memory available already leaves them out
+        running = resources.auto_bcl2fastq_threads(8, 96, 2, 64, 16 * GB)
+        assert running['processing'] == 16
+        # two jobs sized together split what is available
+        starting = resources.auto_bcl2fastq_threads(8, 96, 2, 64, 16 * GB, starting=2)
+        assert starting['processing'] == 8
+
+    def test_host_resources(self):
+        assert resources.cpu_count() >= 1
+        assert resources.mem_available() > 0
+
+if __name__ == '__main__':
+    unittest.main()
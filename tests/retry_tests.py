@@ -0,0 +1,90 @@
+import os
+import errno
+import shutil
+import socket
+import smtplib
+import tempfile
+import unittest
+from odybcl2fastq import retry
+from odybcl2fastq.run_state import RunStateDB
+from odybcl2fastq.pipeline import StageError
+
+class OperationalError(Exception):
+    # stands in for MySQLdb's, matched by name
+    pass
+
+class RetryTests(unittest.TestCase):
+
+    def test_transient_errors(self):
+        assert retry.is_transient(IOError(errno.ESTALE, 'Stale file handle'))
+        assert retry.is_transient(OSError(errno.EIO, 'Input/output error'))
+        assert retry.is_transient(socket.timeout('timed out'))
+        assert retry.is_transient(smtplib.SMTPServerDisconnected('gone'))
+        assert retry.is_transient(smtplib.SMTPResponseException(421, 'try later'))
+        assert retry.is_transient(OperationalError(2006, 'MySQL server has gone away'))
+        # the cause of a failed pipeline stage
+        assert retry.is_transient(StageError('copy', IOError(errno.EIO, 'Input/output error')))
+
+    def test_permanent_errors(self):
+        assert not retry.is_transient(IOError(errno.ENOENT, 'No such file or directory'))
+        # a full disk needs an operator
+        assert not retry.is_transient(IOError(errno.ENOSPC, 'No space left on device'))
+        assert not retry.is_transient(ValueError('bad sample sheet'))
+        assert not retry.is_transient(smtplib.SMTPResponseException(550, 'no such user'))
+        assert not retry.is_transient(OperationalError(1045, 'Access denied'))
+        assert not retry.is_transient(StageError('summary', KeyError('Lane')))
+
+    def test_backoff_grows_to_cap(self):
+        for attempt in range(10):
+            delay = retry.backoff(attempt, 10, 100)
+            assert min(100, 10 * 2 ** attempt) / 2 <= delay <= min(100, 10 * 2 ** attempt)
+
+    def test_call_retries_transient(self):
+        calls = []
+        slept = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise IOError(errno.ESTALE, 'Stale file handle')
+            return 'done'
+        result, attempts = retry.call(flaky, retries=3, base_delay=1, sleep=slept.append)
+        assert result == 'done'
+        assert attempts == 3
+        assert len(slept) == 2
+
+    def test_call_gives_up(self):
+        calls = []
+        def broken(error):
+            calls.append(1)
+            raise error
+        self.assertRaises(IOError, retry.call, broken, (IOError(errno.EIO, 'Input/output error'),),
+                retries=2, sleep=lambda s: None)
+        assert len(calls) == 3
+        calls = []
+        # permanent errors are not retried
+        self.assertRaises(ValueError, retry.call, broken, (ValueError('bad'),),
+                retries=2, sleep=lambda s: None)
+        assert len(calls) == 1
+
+    def test_retry_queue(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            db = RunStateDB(os.path.join(tmp, 'runs.db'))
+            queue = retry.RetryQueue(retries=2, base_delay=10, db=db)
+            assert queue.add('/runs/a/', now=1000)
+            assert queue.due(now=1000) == []
+            # a restarted daemon still has the retry
+            queue = retry.RetryQueue(retries=2, base_delay=10, db=db)
+            assert queue.due(now=1010) == ['/runs/a/']
+            queue.started('/runs/a/')
+            assert queue.due(now=2000) == []
+            assert queue.add('/runs/a/', now=2000)
+            # out of retries
+            assert not queue.add('/runs/a/', now=3000)
+            assert queue.due(now=10000) == []
+            assert db.retry_attempts('/runs/a/', 'odybcl2fastq') == 0
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from odybcl2fastq import run_history
+
+class RunHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.history = os.path.join(self.tmp, 'history.jsonl')
+        self.html = os.path.join(self.tmp, 'log.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read_html(self):
+        with open(self.html) as fh:
+            return fh.read()
+
+    def test_rewritten_only_on_change(self):
+        page = run_history.StatusPage(self.html, self.history, max_lines=2)
+        # the page is written once even with no history
+        assert page.update()
+        assert self.read_html() == '<pre></pre>'
+        assert not page.update()
+        run_history.record('run1', 'success', self.history)
+        run_history.record('run2', 'failure', self.history)
+        run_history.record('run3', 'success', self.history)
+        assert page.update()
+        html = self.read_html()
+        # newest first, only the last max_lines
+        assert 'run1' not in html
+        assert html.index('run3 returned success') < html.index('run2 returned failure')
+        assert not page.update()
+
+    def test_partial_and_truncated(self):
+        page = run_history.StatusPage(self.html, self.history)
+        run_history.record('run1', 'success', self.history)
+        with open(self.history, 'a') as fh:
+            fh.write('{"run": "run2", "line": "half')
+        assert page.read_new() == 1
+        with open(self.history, 'a') as fh:
+            fh.write(' written\\n"}\n')
+        assert page.read_new() == 1
+        assert list(page.lines)[-1] == 'half written\n'
+        # replaced by a shorter file
+        with open(self.history, 'w') as fh:
+            fh.write('')
+        run_history.record('run3', 'success', self.history)
+        page.read_new()
+        assert len(page.lines) == 1
+
+    def test_import_summary_log(self):
+        log = os.path.join(self.tmp, 'odybcl2fastq.log')
+        with open(log, 'w') as fh:
+            fh.write('2018-07-05 12:00:00,123 run.py Odybcl2fastq for run1 returned success\n\n')
+            fh.write('2018-07-05 12:00:01,000 Queueing odybcl2fastq cmd for run2\n')
+        run_history.import_summary_log(log, self.history)
+        with open(self.history) as fh:
+            entry = json.loads(fh.readline())
+        # seconds since the epoch, as record writes
+        assert abs(entry['time'] - (time.mktime((2018, 7, 5, 12, 0, 0, 0, 0, -1)) + 0.123)) < 1e-6
+        page = run_history.StatusPage(self.html, self.history)
+        page.update()
+        assert self.read_html() == ('<pre>2018-07-05 12:00:00,123 run.py Odybcl2fastq for run1 '
+                'returned success\n</pre>')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from odybcl2fastq.run_state import RunStateDB
+
+class RunStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = RunStateDB(os.path.join(self.tmp, 'runs.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_run(self, name, markers=()):
+        run_dir = os.path.join(self.tmp, name) + '/'
+        os.mkdir(run_dir)
+        for marker in markers:
+            open(run_dir + marker, 'w').close()
+        return run_dir
+
+    def test_mark_records_and_touches(self):
+        run_dir = self.make_run('run1')
+        assert not self.db.has(run_dir, 'odybcl2fastq.processed')
+        self.db.mark(run_dir, 'odybcl2fastq.processed')
+        assert self.db.has(run_dir, 'odybcl2fastq.processed')
+        assert os.path.exists(run_dir + 'odybcl2fastq.processed')
+        assert not self.db.has(run_dir, 'centrifuge.processed')
+
+    def test_markers_on_disk_are_imported(self):
+        run_dir = self.make_run('run1', ['odybcl2fastq.processed', 'bauer.complete', 'other.txt'])
+        assert self.db.has(run_dir, 'odybcl2fastq.processed')
+        assert self.db.has(run_dir, 'bauer.complete')
+        # the marker file stays the record, deleting it forces a rerun
+        os.remove(run_dir + 'odybcl2fastq.processed')
+        assert not self.db.has(run_dir, 'odybcl2fastq.processed')
+        assert self.db.find('odybcl2fastq.processed') == []
+
+    def test_find_incomplete(self):
+        old = time.time() - 5 * 86400
+        done = self.make_run('done')
+        self.db.mark(done, 'odybcl2fastq.processed', old)
+        self.db.mark(done, 'odybcl2fastq.complete', old)
+        notified = self.make_run('notified')
+        self.db.mark(notified, 'odybcl2fastq.processed', old)
+        self.db.mark(notified, 'odybcl2fastq.incomplete_notified', old)
+        recent = self.make_run('recent')
+        self.db.mark(recent, 'odybcl2fastq.processed')
+        stuck = self.make_run('stuck', ['odybcl2fastq.processed'])
+        os.utime(stuck + 'odybcl2fastq.processed', (old, old))
+        self.db.backfill_all([done, notified, recent, stuck])
+        found = self.db.find('odybcl2fastq.processed',
+                without=['odybcl2fastq.complete', 'odybcl2fastq.incomplete_notified'],
+                before=time.time() - 86400, root=self.tmp)
+        assert found == [stuck]
+        # a complete marker deleted by hand puts the run back
+        os.remove(done + 'odybcl2fastq.complete')
+        found = self.db.find('odybcl2fastq.processed',
+                without=['odybcl2fastq.complete', 'odybcl2fastq.incomplete_notified'],
+                before=time.time() - 86400, root=self.tmp)
+        assert sorted(found) == [done, stuck]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from odybcl2fastq import run
+from odybcl2fastq.checkpoint import Checkpoints
+
+class RunTests(unittest.TestCase):
+
+    def test_thread_counts_do_not_rerun_demux(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            cmd = ('bcl2fastq --output-dir /out/run --processing-threads 8 '
+                    '--loading-threads 2 --writing-threads 2 --use-bases-mask 1:y26,i8,y134')
+            Checkpoints(output_dir).mark('demux', run.demux_fingerprint(cmd, 'sheet'))
+            # a rerun sized to a busier node
+            rerun = cmd.replace('--processing-threads 8', '--processing-threads 3').replace(
+                    '--writing-threads 2', '--writing-threads 1')
+            assert Checkpoints(output_dir).is_done('demux', run.demux_fingerprint(rerun, 'sheet'))
+            # anything else about the cmd still reruns it
+            other = cmd.replace('/out/run', '/out/other')
+            assert not Checkpoints(output_dir).is_done('demux', run.demux_fingerprint(other, 'sheet'))
+            assert not Checkpoints(output_dir).is_done('demux', run.demux_fingerprint(cmd, 'new sheet'))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_split_threads_within_budget(self):
+        for budget in (3, 8, 16, 32, 64):
+            for jobs_tot in (1, 2, 3, 4):
+                if budget < 3 * jobs_tot:
+                    continue
+                args = Namespace(CPU_BUDGET=budget)
+                run.split_threads(args, jobs_tot)
+                per_job = args.BCL_PROC_THREADS + args.BCL_LOADING_THREADS + args.BCL_WRITING_THREADS
+                assert per_job * jobs_tot <= budget, (budget, jobs_tot, per_job)
+        args = Namespace(CPU_BUDGET=16)
+        run.split_threads(args, 2)
+        assert (args.BCL_PROC_THREADS, args.BCL_LOADING_THREADS, args.BCL_WRITING_THREADS) == (4, 2, 2)
+
+    def test_lease_counts_every_thread(self):
+        args = Namespace(BCL_PROC_THREADS=8, BCL_LOADING_THREADS=False, BCL_WRITING_THREADS=False)
+        assert run.bcl2fastq_threads(args) == 8
+        args = Namespace(BCL_PROC_THREADS=4, BCL_LOADING_THREADS=2, BCL_WRITING_THREADS=2)
+        assert run.bcl2fastq_threads(args) == 8
+
+if __name__ == '__main__':
+    unittest.main()
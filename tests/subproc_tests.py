@@ -0,0 +1,30 @@
+import unittest
+import odybcl2fastq.subproc as subproc
+from odybcl2fastq.metrics import RunMetrics
+
+class SubprocTests(unittest.TestCase):
+
+    def test_run_captures_output_and_usage(self):
+        metrics = RunMetrics('test')
+        code, out, err, usage = subproc.run('echo out; echo err >&2; exit 3',
+                name='test', metrics=metrics)
+        assert code == 3
+        assert out == b'out\n'
+        assert err == b'err\n'
+        assert usage['exit_status'] == 3
+        assert usage['max_rss_kb'] > 0
+        assert metrics.to_dict()['children'] == [usage]
+
+    def test_run_streams_lines(self):
+        lines = []
+        code, out, err, usage = subproc.run('echo a; echo b >&2',
+                stderr_to_stdout=True, line_callback=lines.append)
+        assert code == 0
+        assert lines == [b'a\n', b'b\n']
+
+    def test_signal_exit_code(self):
+        code, out, err, usage = subproc.run('kill -9 $$')
+        assert code == -9
+
+if __name__ == '__main__':
+    unittest.main()
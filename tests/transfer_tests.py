@@ -0,0 +1,104 @@
+import unittest
+import os
+import stat
+import shutil
+import hashlib
+import tempfile
+import odybcl2fastq.transfer as transfer
+
+class TransferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'output')
+        self.dest = os.path.join(self.tmp_dir, 'final')
+        os.makedirs(os.path.join(self.src, 'proj'))
+        self.files = {
+            'md5sum.txt': b'abc  proj/sample.fastq.gz\n',
+            'proj/sample.fastq.gz': b'ACGT' * 10000,
+        }
+        for rel, data in self.files.items():
+            self._write(self.src, rel, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, root, rel, data):
+        with open(os.path.join(root, rel), 'wb') as fh:
+            fh.write(data)
+
+    def _read(self, root, rel):
+        with open(os.path.join(root, rel), 'rb') as fh:
+            return fh.read()
+
+    def test_sync_copies_tree(self):
+        stats = transfer.sync_tree(self.src, self.dest, threads=2)
+        assert stats['copied'] == 2
+        for rel, data in self.files.items():
+            assert self._read(self.dest, rel) == data
+
+    def test_sync_skips_unchanged(self):
+        transfer.sync_tree(self.src, self.dest)
+        self._write(self.src, 'md5sum.txt', b'changed')
+        self._write(self.dest, 'stale.txt', b'old')
+        stats = transfer.sync_tree(self.src, self.dest)
+        assert stats['copied'] == 1
+        assert stats['skipped'] == 1
+        assert stats['removed'] == 1
+        assert self._read(self.dest, 'md5sum.txt') == b'changed'
+        assert not os.path.exists(os.path.join(self.dest, 'stale.txt'))
+
+    def test_resume_partial_copy(self):
+        rel = 'proj/sample.fastq.gz'
+        os.makedirs(os.path.join(self.dest, 'proj'))
+        dest_path = os.path.join(self.dest, rel)
+        # simulate an interrupted copy of the first half of the file
+        self._write(self.dest, os.path.relpath(transfer.tmp_path(dest_path),
+            self.dest), self.files[rel][:20000])
+        copied, digests = transfer.copy_file(os.path.join(self.src, rel),
+                dest_path, algorithms=['md5'])
+        assert copied == 20000
+        assert digests['md5'] == hashlib.md5(self.files[rel]).hexdigest()
+        assert self._read(self.dest, rel) == self.files[rel]
+        assert not os.path.exists(transfer.tmp_path(dest_path))
+
+    def test_corrupt_partial_copy_restarts(self):
+        rel = 'proj/sample.fastq.gz'
+        os.makedirs(os.path.join(self.dest, 'proj'))
+        dest_path = os.path.join(self.dest, rel)
+        self._write(self.dest, os.path.relpath(transfer.tmp_path(dest_path),
+            self.dest), b'N' * 20000)
+        copied, digests = transfer.copy_file(os.path.join(self.src, rel),
+                dest_path, algorithms=['md5'])
+        assert copied == len(self.files[rel])
+        assert self._read(self.dest, rel) == self.files[rel]
+
+    def test_symlinks_not_recopied(self):
+        os.symlink('sample.fastq.gz', os.path.join(self.src, 'proj', 'link.fastq.gz'))
+        stats = transfer.sync_tree(self.src, self.dest)
+        assert os.readlink(os.path.join(self.dest, 'proj', 'link.fastq.gz')) == 'sample.fastq.gz'
+        stats = transfer.sync_tree(self.src, self.dest)
+        assert stats['copied'] == 0
+
+    def test_deliver_checksums_and_permissions(self):
+        stats = transfer.deliver_tree(self.src, self.dest, 0o640, 0o750, threads=2)
+        rel = 'proj/sample.fastq.gz'
+        line = '%s  %s\n' % (hashlib.md5(self.files[rel]).hexdigest(), rel)
+        # md5sum.txt in the source is replaced by the generated manifest
+        assert stats['copied'] == 1
+        assert stats['checksummed'] == 1
+        assert self._read(self.src, 'md5sum.txt') == line.encode()
+        assert self._read(self.dest, 'md5sum.txt') == line.encode()
+        assert stat.S_IMODE(os.stat(os.path.join(self.dest, rel)).st_mode) == 0o640
+        assert stat.S_IMODE(os.stat(os.path.join(self.dest, 'proj')).st_mode) == 0o750
+        stats = transfer.deliver_tree(self.src, self.dest, 0o640, 0o750)
+        assert stats['copied'] == 0
+        assert self._read(self.dest, 'md5sum.txt') == line.encode()
+        # run metrics are not delivered
+        self._write(self.src, 'run.metrics.json', b'{}')
+        stats = transfer.deliver_tree(self.src, self.dest, 0o640, 0o750)
+        assert stats['copied'] == 0
+        assert not os.path.exists(os.path.join(self.dest, 'run.metrics.json'))
+
+if __name__ == '__main__':
+    unittest.main()